@@ -2,15 +2,35 @@ import requests
 import sys
 import os
 import datetime as dt
-from typing import Optional
+from typing import Optional, Tuple, Callable, TypeVar, Set, Iterator
 import base64
 import hashlib
+import time
+import threading
+import atexit
+import asyncio
+import random
+import concurrent.futures
+import codecs
 
+import metrics
 
-REQUEST_TIMEOUT = os.getenv("AIMS_TIMEOUT") or 60
+
+REQUEST_TIMEOUT = float(os.getenv("AIMS_TIMEOUT") or 60)
+SESSION_MAX_AGE = int(os.getenv("AIMS_SESSION_MAX_AGE") or 900)
+POOL_SIZE = 10
+RETRIES = int(os.getenv("AIMS_RETRIES") or 2)
+BACKOFF = float(os.getenv("AIMS_BACKOFF") or 0.5)
+HEDGE_AFTER = float(os.getenv("AIMS_HEDGE_AFTER") or 0) or None
+CHUNK_SIZE = 16384
+
+T = TypeVar("T")
 
 _session = None
 _aims_url:Optional[str] = None
+_session_started:Optional[float] = None
+_credentials:Optional[Tuple[str, str]] = None
+_login_lock = threading.Lock()
 
 
 def _check_response(r: requests.Response, *args, **kwargs) -> None:
@@ -34,6 +54,9 @@ def _initialise_session() -> None:
     """Set up headers and hooks."""
     global _session
     _session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=POOL_SIZE)
+    _session.mount("https://", adapter)
     _session.hooks['response'].append(_check_response)
     _session.headers.update({
         "User-Agent":
@@ -41,8 +64,17 @@ def _initialise_session() -> None:
         "Gecko/20100101 Firefox/64.0"})
 
 
-def _login(username:str, password:str, recurse: bool = True) -> None:
-    global _session, _aims_url
+def _request_timeout(deadline: Optional[float]) -> float:
+    """REQUEST_TIMEOUT, cut short if the deadline (a time.monotonic value)
+    is nearer."""
+    if deadline is None:
+        return REQUEST_TIMEOUT
+    return max(0.1, min(REQUEST_TIMEOUT, deadline - time.monotonic()))
+
+
+def _login(username:str, password:str, recurse: bool = True,
+           deadline: Optional[float] = None) -> None:
+    global _session, _aims_url, _session_started, _credentials
     ecrew_url = "https://ecrew.easyjet.com/wtouch/wtouch.exe/verify"
     encoded_id = base64.b64encode(username.encode()).decode()
     encoded_pw = hashlib.md5(password.encode()).hexdigest()
@@ -50,20 +82,59 @@ def _login(username:str, password:str, recurse: bool = True) -> None:
     assert(_session)
     r = _session.post(ecrew_url,
                       {"Crew_Id": encoded_id, "Crm": encoded_pw},
-                      timeout=REQUEST_TIMEOUT)
+                      timeout=_request_timeout(deadline))
     _aims_url = r.url.split("wtouch.exe")[0]
+    _session_started = time.monotonic()
+    _credentials = (username, password)
     #If already logged in, need to logout then login again
     if r.text.find("Please log out and try again.") != -1:
-        logout(False)
-        if recurse: _login(username, password, False)
+        logout(False, deadline)
+        if recurse: _login(username, password, False, deadline)
+
 
+class _PageStream:
+    """Iterate over the decoded text of a streamed response.
+
+    While iterating, watches for the login form that ecrew returns instead of
+    the requested page when a session has expired, setting the expired
+    attribute if it is found.
+    """
 
-def connect(username:str, password:str) -> None:
+    LOGIN_MARKER = "Crew_Id"
+
+    def __init__(self, r: requests.Response) -> None:
+        self._r = r
+        self.expired = False
+
+    def __iter__(self) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder(
+            self._r.encoding or "utf-8")(errors="replace")
+        #the end of the text seen so far, kept so that a marker split across
+        #chunks, however small, is still found
+        tail = ""
+        def check(text: str) -> None:
+            nonlocal tail
+            if self.LOGIN_MARKER in tail + text:
+                self.expired = True
+            tail = (tail + text)[-len(self.LOGIN_MARKER):]
+        for chunk in self._r.iter_content(CHUNK_SIZE):
+            text = decoder.decode(chunk)
+            check(text)
+            yield text
+        text = decoder.decode(b"", True)
+        check(text)
+        yield text
+
+
+def connect(username:str, password:str,
+            deadline: Optional[float] = None) -> None:
     """Connects to AIMS server ecrew server.
 
     Args:
         username: AIMS username (e.g. 001234)
         password: AIMS password (8 digit or less numeric password)
+        deadline: A time.monotonic value by which logging in must be
+            done, or None to allow REQUEST_TIMEOUT for each request.
 
     Raises:
         requests.ConnectionError:
@@ -79,51 +150,249 @@ def connect(username:str, password:str) -> None:
     """
     global _session, _aims_url
     _fprint("Connecting ")
-    _login(username, password)
+    with metrics.stage("aims_login"):
+        _login(username, password, deadline=deadline)
     _fprint(" Done\n")
 
 
-def logout(msg: bool = True) -> None:
+def ensure_session(username:str, password:str,
+                   deadline: Optional[float] = None) -> None:
+    """Connects to AIMS server unless a usable session already exists.
+
+    Args:
+        username: AIMS username (e.g. 001234)
+        password: AIMS password (8 digit or less numeric password)
+        deadline: As for connect.
+
+    Raises:
+        As for connect.
+
+    The session is kept alive between calls, so a long running process or a
+    warm lambda container only logs in again if the credentials change or the
+    session is older than SESSION_MAX_AGE seconds. Sessions that expire
+    sooner than this are detected and renewed by flight_info. The session is
+    logged out when the interpreter exits.
+    """
+    with _login_lock:
+        if (_session and _aims_url and _session_started is not None and
+            _credentials == (username, password) and
+            time.monotonic() - _session_started < SESSION_MAX_AGE):
+            return
+        connect(username, password, deadline)
+
+
+def _renew_session(expired_session: requests.Session,
+                   deadline: Optional[float] = None) -> None:
+    """Log in again after a session has been found to have expired.
+
+    If another thread has already renewed the session, nothing is done.
+    """
+    with _login_lock:
+        if _session is expired_session and _credentials:
+            _fprint("Session expired, reconnecting ")
+            _login(*_credentials, deadline=deadline)
+            _fprint(" Done\n")
+
+
+def invalidate() -> None:
+    """Forget the current session without contacting the server.
+
+    Used when a session is in an unknown state, so that the next
+    ensure_session starts afresh.
+    """
+    global _session, _aims_url, _session_started
+    _session, _aims_url, _session_started = None, None, None
+
+
+def logout(msg: bool = True, deadline: Optional[float] = None) -> None:
     """Logout of AIMS server
 
     Args:
         msg: Display "Logging out . Done"
+        deadline: As for connect.
     """
     global _session, _aims_url
     if _session and _aims_url:
         if msg: _fprint("\nLogging out ")
         _session.post(_aims_url + "perinfo.exe/AjAction?LOGOUT=1",
-                      {"AjaxOperation": "0"}, timeout=REQUEST_TIMEOUT)
-        _aims_url, _session = None, None
+                      {"AjaxOperation": "0"},
+                      timeout=_request_timeout(deadline))
+        _aims_url, _session, _session_started = None, None, None
         if msg: _fprint(" Done\n")
 
 
-def flight_info(d: dt.date, type_: str, airport: str="brs") -> str:
-    """Get HTML of flight info page
+def flight_info_stream(d: dt.date, type_: str,
+                       consumer: Callable[[Iterator[str]], T],
+                       airport: str="brs",
+                       timeout: Optional[float] = None) -> T:
+    """Stream the HTML of flight info page to a consumer as it arrives
 
     Args:
         d: Date to retrieve data for
         type_: "A" for arrivals or "D" for departures
+        consumer: Called with an iterator over the text of the page, in
+            chunks, as it is received.
+        airport: The airport to retrieve data for
+        timeout: Request timeout in seconds. Defaults to REQUEST_TIMEOUT.
+
+    Returns:
+        The value returned by consumer.
+
+    If AIMS responds with the login page because the session has expired, the
+    consumer's result is discarded, a new session is started and the request
+    is retried once. Logging in again must be done within timeout seconds of
+    the call.
     """
-    global _session, _aims_url
-    assert(_session)
-    assert(_aims_url)
     assert(type_ == "A" or type_ == "D")
+    deadline = None if timeout is None else time.monotonic() + timeout
     dstr = dt.date.strftime(d, "%d/%m/%Y")
-    url = _aims_url + "fltinfo.exe/AjAction"
     deps = "1" if type_ == "D" else "2"
-    r = _session.post(
-        url, {
-        "AjaxOperation": "2",
-        "cal1": dstr,
-        "Airport": airport,
-        "ACRegistration": "",
-        "Deps": deps,
-        "Flight": "",
-        "times_format": "2",
-        },
-        timeout=REQUEST_TIMEOUT)
-    return r.text
+    for attempt in range(2):
+        session, aims_url = _session, _aims_url
+        assert(session)
+        assert(aims_url)
+        with session.post(
+            aims_url + "fltinfo.exe/AjAction", {
+            "AjaxOperation": "2",
+            "cal1": dstr,
+            "Airport": airport,
+            "ACRegistration": "",
+            "Deps": deps,
+            "Flight": "",
+            "times_format": "2",
+            },
+            timeout=timeout or REQUEST_TIMEOUT,
+            stream=True) as r:
+            page = _PageStream(r)
+            chunks = iter(page)
+            result = consumer(chunks)
+            for _ in chunks: pass #check the rest of the page for expiry
+        if attempt or not page.expired:
+            break
+        _renew_session(session, deadline)
+    return result
+
+
+def flight_info(d: dt.date, type_: str, airport: str="brs",
+                timeout: Optional[float] = None) -> str:
+    """Get HTML of flight info page
+
+    Args:
+        d: Date to retrieve data for
+        type_: "A" for arrivals or "D" for departures
+        airport: The airport to retrieve data for
+        timeout: Request timeout in seconds. Defaults to REQUEST_TIMEOUT.
+
+    If AIMS responds with the login page because the session has expired,
+    logs in again and retries once.
+    """
+    return flight_info_stream(d, type_, "".join, airport, timeout)
+
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given retry attempt."""
+    return random.uniform(0, BACKOFF * 2 ** attempt)
+
+
+def _retryable(err: Exception) -> bool:
+    """Network errors, timeouts and server errors are worth retrying."""
+    if isinstance(err, requests.HTTPError):
+        return err.response is None or err.response.status_code >= 500
+    return isinstance(err, requests.RequestException)
+
+
+class AsyncClient:
+    """Run blocking AIMS requests from asyncio code.
+
+    Requests run on a dedicated thread pool and share the module's keep-alive
+    session, so they must be made after connect or ensure_session. Failed
+    requests are retried with jittered exponential backoff. If hedge_after is
+    set, a duplicate request is sent when the first has not completed within
+    that many seconds, and whichever completes first is used. No retry is
+    started that could not complete before the deadline.
+
+    Args:
+        max_concurrent: Maximum number of calls in progress at once.
+        retries: Number of retries after the first attempt.
+        hedge_after: Seconds to wait before hedging, or None for no hedging.
+        deadline: Seconds from creation that the client may use, or None.
+    """
+
+    def __init__(self, max_concurrent: int = 4, retries: int = RETRIES,
+                 hedge_after: Optional[float] = HEDGE_AFTER,
+                 deadline: Optional[float] = None) -> None:
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.hedge_after = hedge_after
+        self.deadline = (None if deadline is None
+                         else time.monotonic() + deadline)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_concurrent * (2 if hedge_after else 1))
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline, or None if there is no deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    async def call(self, func: Callable[..., T], *args) -> T:
+        """Call func(*args) in a worker thread with retries and hedging.
+
+        Raises:
+            The last exception raised by func if all attempts fail.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self._semaphore:
+            attempt = 0
+            while True:
+                try:
+                    return await self._hedged(func, args)
+                except requests.RequestException as err:
+                    delay = _backoff(attempt)
+                    remaining = self.remaining()
+                    if (attempt >= self.retries or not _retryable(err) or
+                        (remaining is not None and remaining <= delay)):
+                        raise
+                    _fprint("r")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+
+    async def _hedged(self, func: Callable[..., T], args: tuple) -> T:
+        loop = asyncio.get_running_loop()
+        tasks: Set[asyncio.Future] = {
+            loop.run_in_executor(self._executor, func, *args)}
+        if self.hedge_after is not None:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                _fprint("h")
+                tasks.add(loop.run_in_executor(self._executor, func, *args))
+        error: Optional[BaseException] = None
+        while tasks:
+            done, tasks = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for t in tasks: t.cancel()
+                    return task.result()
+                error = task.exception()
+        assert(error)
+        raise error
+
+    def close(self) -> None:
+        """Release the thread pool without waiting for abandoned requests."""
+        self._executor.shutdown(wait=False)
+
+
+def _logout_at_exit() -> None:
+    try:
+        logout(False)
+    except requests.RequestException:
+        pass
+
+
+atexit.register(_logout_at_exit)
 
 
 if __name__ == "__main__":
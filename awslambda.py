@@ -1,37 +1,193 @@
 #!/usr/bin/python3
 
+import datetime
+import json
+import gzip
+from typing import Optional, Dict, Any
 import boto3
+import botocore.exceptions
 import mayfly
+import metrics
 
 s3 = boto3.client('s3');
 BUCKET = 'ezybrs.hursts.org.uk'
 
-def lambda_handler(event, context):
-    global BUCKET
+#(Content-Encoding, key) of the page variants to upload. S3 cannot negotiate
+#encodings, so the main page is served gzipped, which every browser accepts.
+#The brotli variant is for a CDN or edge function that can select it.
+UPLOADS = [('gzip', 'mayfly.html'), ('br', 'mayfly.html.br')]
+UPDATED_KEY = 'mayfly-updated.json'
+FEED_KEY = 'mayfly.json'
+DELTA_KEY = 'mayfly-delta.json'
+
+#The parsed schedule and the ETag of the mayfly.csv it was parsed from are kept
+#between invocations of a warm container.
+_schedule = mayfly.ServiceTable()
+_schedule_etag: Optional[str] = None
+#Rendered bins are also kept, so only bins that have changed are re-rendered.
+_bin_cache = mayfly.BinCache()
+#Digest of the last page uploaded, ignoring the update time.
+_published_digest: Optional[str] = None
+#The last data feed uploaded, which the next delta is calculated from.
+_published_feed: Optional[Dict[str, Any]] = None
+
+
+def _get_schedule() -> mayfly.ServiceTable:
+    """Get the full schedule, downloading mayfly.csv only if it has changed.
+
+    A conditional GET is sent with the ETag of the last download. If S3
+    responds with 304 Not Modified the schedule parsed on a previous
+    invocation is reused.
+
+    :returns: A ServiceTable of all the services in mayfly.csv.
+    """
+    global _schedule, _schedule_etag
     print("Downloading csv")
-    s3.download_file(BUCKET, 'mayfly.csv', "/tmp/mayfly.csv")
+    conditions = {"IfNoneMatch": _schedule_etag} if _schedule_etag else {}
+    with metrics.stage("s3_download"):
+        try:
+            r = s3.get_object(Bucket=BUCKET, Key='mayfly.csv', **conditions)
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] not in ("304", "NotModified"):
+                raise
+            print("csv file unchanged")
+            return _schedule
+        with open('/tmp/mayfly.csv', "wb") as f:
+            for chunk in r["Body"].iter_chunks():
+                f.write(chunk)
     print("csv file downloaded")
-    with open('/tmp/mayfly.csv') as f:
-        services = mayfly.process_csv(f.readlines())
-        updated_services = mayfly.update_services_from_AIMS(services)
+    with metrics.stage("csv_parse"):
+        with open('/tmp/mayfly.csv') as f:
+            _schedule = mayfly.process_csv_table(f)
+    _schedule_etag = r["ETag"]
+    return _schedule
+
+
+def _get_published_digest() -> Optional[str]:
+    """Get the digest of the page currently published.
+
+    A cold container reads it from the metadata of the uploaded page.
+    """
+    global _published_digest
+    if _published_digest is None:
+        try:
+            head = s3.head_object(Bucket=BUCKET, Key='mayfly.html')
+            _published_digest = head["Metadata"].get("digest")
+        except botocore.exceptions.ClientError:
+            pass
+    return _published_digest
+
+
+def _get_published_feed() -> Optional[Dict[str, Any]]:
+    """Get the data feed currently published.
+
+    A cold container downloads it. None is returned if there is no feed.
+    """
+    global _published_feed
+    if _published_feed is None:
+        try:
+            r = s3.get_object(Bucket=BUCKET, Key=FEED_KEY)
+            _published_feed = json.loads(gzip.decompress(r["Body"].read()))
+        except (botocore.exceptions.ClientError, OSError, ValueError):
+            pass
+    return _published_feed
+
+
+def _feed_content(feed: Dict[str, Any]) -> Dict[str, Any]:
+    """The feed without its update stamp and version, as it would be after
+    a round trip through JSON, for comparison with the published feed."""
+    return json.loads(json.dumps(
+        {K: V for K, V in feed.items() if K not in ("updated", "version")}))
+
+
+def _upload_feed(feed: Dict[str, Any]) -> None:
+    """Upload the data feed and the delta from the previous feed.
+
+    If no delta can be calculated, a delta with a null base is uploaded so
+    that polling clients know to fetch the full feed. If the feed is the same
+    as the one published, apart from its update stamp and version, nothing is
+    uploaded and the published version is kept, so that clients polling the
+    delta do not fetch an empty one.
+    """
+    global _published_feed
+    published = _get_published_feed()
+    if published and _feed_content(published) == _feed_content(feed):
+        print("feed unchanged, upload skipped")
+        return
+    print("Uploading feed")
+    delta = (mayfly.build_delta(published, feed) or
+             {"version": feed["version"], "base": None})
+    for key, obj in ((FEED_KEY, feed), (DELTA_KEY, delta)):
+        files = mayfly.write_json_files('/tmp/' + key, obj)
+        s3.upload_file(files["gzip"], BUCKET, key, ExtraArgs={
+            'ACL': 'public-read',
+            'ContentType': 'application/json',
+            'CacheControl': 'no-cache',
+            'ContentEncoding': 'gzip'
+        })
+    _published_feed = feed
+
+
+def lambda_handler(event, context):
+    global BUCKET
+    try:
+        start = mayfly.window_start()
+        end = start + datetime.timedelta(hours=mayfly.MAYFLY_WINDOW)
+        margin = datetime.timedelta(days=1)
+        table = _get_schedule().window(start - margin, end + margin)
+        updated_table = mayfly.update_table_from_AIMS(table)
         updated = False
-        if updated_services:
-            services = updated_services
+        if updated_table:
+            table = updated_table
             updated = True
-        bins = mayfly.split_into_bins(services)
-        with open('/tmp/mayfly.html', "w") as o:
-            o.write(mayfly.build_page(bins, updated=updated))
-            print("Uploading html")
-            s3.upload_file(
-                '/tmp/mayfly.html',
-                BUCKET, 'mayfly.html',
-                ExtraArgs={
-                    'ACL': 'public-read',
-                    'ContentType': 'text/html',
-                    'CacheControl': 'no-cache'
-                }
-            )
-            print("html uploaded")
+        with metrics.stage("binning"):
+            rollup = mayfly.BinRollup.from_table(table)
+        with metrics.stage("rendering"):
+            files = mayfly.write_page_files(
+                '/tmp/mayfly.html', rollup, updated=updated,
+                bin_cache=_bin_cache)
+            published = _get_published_feed()
+            feed = mayfly.build_feed(
+                rollup, updated=updated,
+                version=published["version"] + 1 if published else 1)
+        with metrics.stage("upload"):
+            _upload(files, mayfly.update_stamp(updated))
+            _upload_feed(feed)
+    finally:
+        #metrics of a failed refresh are the ones most needed
+        metrics.flush()
+
+
+def _upload(files: Dict[Optional[str], str], stamp: str) -> None:
+    """Upload the page variants unless the page is unchanged.
+
+    The update stamp is always uploaded as a small JSON object so that the
+    page can show when the data was last checked, even if the page itself
+    was not re-uploaded.
+    """
+    global _published_digest
+    s3.put_object(
+        Bucket=BUCKET, Key=UPDATED_KEY,
+        Body=json.dumps({"updated": stamp}).encode(),
+        ACL='public-read', ContentType='application/json',
+        CacheControl='no-cache')
+    digest = mayfly.page_digest(files[None])
+    if digest == _get_published_digest():
+        print("html unchanged, upload skipped")
+        return
+    print("Uploading html")
+    for encoding, key in UPLOADS:
+        if encoding not in files:
+            continue
+        s3.upload_file(files[encoding], BUCKET, key, ExtraArgs={
+            'ACL': 'public-read',
+            'ContentType': 'text/html; charset=utf-8',
+            'CacheControl': 'no-cache',
+            'ContentEncoding': encoding,
+            'Metadata': {'digest': digest}
+        })
+    _published_digest = digest
+    print("html uploaded")
 
 
 def staging_lambda_handler(event, context):
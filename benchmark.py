@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+"""Benchmarks for the stages of the Mayfly pipeline.
+
+Synthetic Mayfly csv files and AIMS flight info pages are generated at a
+number of sizes, each stage is timed and its peak memory recorded, and the
+results are written as JSON so that runs from different commits can be
+compared.
+"""
+
+import sys
+import os
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from typing import List, Dict, Callable, Any, Tuple, Optional, NamedTuple
+
+import mayfly
+import flight_info
+
+
+class Size(NamedTuple):
+    """A benchmark size.
+
+    :var airports: The number of airports, each with its own schedule.
+    :var days: The number of days in each schedule.
+    :var movements: The number of arrivals plus departures per airport-day.
+    """
+    airports: int
+    days: int
+    movements: int
+
+
+SIZES = {
+    "day": Size(airports=1, days=1, movements=200),
+    "season": Size(airports=1, days=214, movements=200),
+    "network": Size(airports=25, days=7, movements=200),
+}
+
+_OPERATORS = ["EZY"] * 14 + ["EJU", "EZS", "TOM", "RYR", "KLM", "LOG"]
+_AIRPORTS = ["NCL", "EDI", "GLA", "BFS", "AMS", "CDG", "GVA", "BCN", "MAD",
+             "AGP", "ALC", "FAO", "LIS", "PMI", "IBZ", "TFS", "ACE", "FCO",
+             "VCE", "PRG", "BUD", "KRK", "DBV", "HER", "LCA"]
+
+
+def make_csv(d: datetime.date, size: Size, seed: int = 0) -> List[List[str]]:
+    """Generate synthetic Mayfly csv files.
+
+    :param d: The first date of each schedule.
+    :param size: The size of the schedules to generate.
+    :param seed: Seed for the random number generator.
+
+    :returns: A list with a list of csv lines for each airport.
+    """
+    rng = random.Random(seed)
+    schedules = []
+    for _ in range(size.airports):
+        lines = []
+        for n in range(size.days):
+            date = (d + datetime.timedelta(days=n)).strftime("%d/%m/%Y")
+            for c in range(size.movements):
+                dest = rng.choice(_AIRPORTS)
+                lines.append(
+                    "{},{},{},{},{},XXXX,{},XXXX,320,186,{:02d}{:02d},"
+                    "J,GB,04DEC2019 1403\n".format(
+                        date, "A" if c % 2 else "D",
+                        rng.choice(_OPERATORS), rng.randint(1, 9999),
+                        dest, dest, rng.randint(5, 23), rng.randint(0, 59)))
+        schedules.append(lines)
+    return schedules
+
+
+def make_aims_html(d: datetime.date, type_: str,
+                   services: List[mayfly.Service],
+                   airport: str = "BRS", seed: int = 0) -> str:
+    """Generate a synthetic AIMS flight info page from a schedule.
+
+    The page lists the easyJet services of the schedule of the given type
+    on the given (UTC) date, as AIMS would, so that joining the flights to
+    the schedule finds them. Most are delayed by a few minutes, some are
+    cancelled and some have been retimed since the schedule was published.
+
+    :param d: The date of the page.
+    :param type_: "A" for arrivals or "D" for departures.
+    :param services: The services of the schedule, from process_csv.
+    :param airport: The airport the page is for.
+    :param seed: Seed for the random number generator.
+
+    :returns: The html of the page.
+    """
+    rng = random.Random(seed)
+    row_template = (
+        "<tr><td>{} {}</td><td>{}</td><td>{}</td><td>320</td><td>{}</td>"
+        "<td>&nbsp;</td><td>{:%H:%M}Z</td><td>{:%H:%M}Z</td>"
+        "<td>{:%H:%M}Z</td><td>{:%H:%M}Z</td></tr>\n")
+    end_of_day = datetime.datetime.combine(d, datetime.time(23, 59))
+    output = ["<table>\n"]
+    for s in services:
+        if (s.type_ != type_ or s.dt.date() != d
+                or s.operator_id not in mayfly.ezy_operator_ids):
+            continue
+        sched = s.dt
+        if rng.random() < 0.1:
+            sched = min(max(sched + datetime.timedelta(
+                minutes=rng.randint(-10, 10)),
+                datetime.datetime.combine(d, datetime.time())), end_of_day)
+        #every time on a page is taken to be on the date of the page
+        delay = min(datetime.timedelta(minutes=max(0, int(rng.gauss(5, 20)))),
+                    end_of_day - sched)
+        flight_time = datetime.timedelta(minutes=rng.randint(60, 180))
+        if type_ == "D":
+            from_, to = airport, s.dest_or_orig
+            sched_off, sched_on = sched, sched + flight_time
+        else:
+            from_, to = s.dest_or_orig, airport
+            sched_off, sched_on = sched - flight_time, sched
+        output.append(row_template.format(
+            s.operator_id, s.service_id, from_, to,
+            rng.choice(["G-EZBV"] * 9 + ["X-CAN"]),
+            sched_off, sched_on, sched_off + delay, sched_on + delay))
+    output.append("</table>\n")
+    return "".join(output)
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Time a function and measure its peak memory.
+
+    The function is timed over repeat runs, then run once more under
+    tracemalloc so that tracing does not distort the timings.
+
+    :returns: A dictionary with the best and mean times in seconds and the
+              peak traced memory in bytes.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"best": min(times), "mean": sum(times) / len(times),
+            "peak_bytes": peak}
+
+
+def refresh_services(table: mayfly.ServiceTable,
+                     flights: List[flight_info.Flight],
+                     start: datetime.datetime) -> Any:
+    """The work of a refresh from the schedule to the bins of the page.
+
+    The windowed schedule is converted to Service objects, joined with the
+    AIMS flights and rolled up, then the bins and heat of the page are
+    found.
+
+    :param table: The whole schedule.
+    :param flights: The flights retrieved from AIMS.
+    :param start: The start of the page.
+
+    :returns: The bins and the heat of each bin.
+    """
+    margin = datetime.timedelta(days=1)
+    services = table.window(
+        start - margin,
+        start + datetime.timedelta(hours=mayfly.MAYFLY_WINDOW) + margin
+    ).to_services()
+    rollup = mayfly.BinRollup(mayfly.join_AIMS_updates(services, flights)[0])
+    count = mayfly.MAYFLY_WINDOW * 2
+    return (rollup.bins(start, count, 30),
+            rollup.heat_levels(start, count, (0.6, 3.5, 4.74)))
+
+
+def refresh_table(table: mayfly.ServiceTable,
+                  flights: List[flight_info.Flight],
+                  start: datetime.datetime) -> Any:
+    """As refresh_services, but joining and rolling up the table's columns.
+
+    Only the services in the bins of the page are converted to Service
+    objects.
+    """
+    margin = datetime.timedelta(days=1)
+    window = table.window(
+        start - margin,
+        start + datetime.timedelta(hours=mayfly.MAYFLY_WINDOW) + margin)
+    rollup = mayfly.BinRollup.from_table(
+        mayfly.join_AIMS_updates_table(window, flights)[0])
+    count = mayfly.MAYFLY_WINDOW * 2
+    return (rollup.bins(start, count, 30),
+            rollup.heat_levels(start, count, (0.6, 3.5, 4.74)))
+
+
+def run(sizes: List[str], repeat: int) -> List[Dict[str, Any]]:
+    """Run the benchmarks.
+
+    :param sizes: The names of the sizes (keys of SIZES) to run.
+    :param repeat: The number of timed runs of each stage.
+
+    :returns: A list of result dictionaries, one per size and stage.
+    """
+    #the schedule starts on the first day shown, and AIMS is queried for
+    #that day and the next, as a refresh would
+    today = mayfly.window_start().date()
+    results = []
+    for name in sizes:
+        size = SIZES[name]
+        schedules = make_csv(today, size)
+        services = [mayfly.process_csv(X) for X in schedules]
+        tables = [mayfly.process_csv_table(X) for X in schedules]
+        pages = [(today + datetime.timedelta(days=n), type_,
+                  make_aims_html(today + datetime.timedelta(days=n), type_,
+                                 services[a], seed=a * 4 + n))
+                 for a in range(size.airports)
+                 for type_ in ("A", "D") for n in range(2)]
+        start = datetime.datetime.combine(today, datetime.time())
+        window = datetime.timedelta(days=2)
+        page_start = mayfly.window_start()
+        rollups = [mayfly.BinRollup(X) for X in services]
+        #caches holding every bin of the page, as after the first refresh
+        caches = [mayfly.BinCache() for _ in rollups]
+        for r, c in zip(rollups, caches):
+            mayfly.build_page(r, bin_cache=c)
+        flights = [flight_info.parse_flight_info_html(html, d)
+                   for d, _, html in pages]
+        #one list of flights per airport, as get_AIMS_flights would return
+        flights = [sum(flights[c:c + 4], [])
+                   for c in range(0, len(flights), 4)]
+        stages: List[Tuple[str, Callable[[], Any]]] = [
+            ("process_csv",
+             lambda: [mayfly.process_csv(X) for X in schedules]),
+            ("process_csv_table",
+             lambda: [mayfly.process_csv_table(X) for X in schedules]),
+            ("split_into_bins",
+             lambda: [mayfly.split_into_bins(X) for X in services]),
+            ("bin_rollup",
+             lambda: [[R.bins(start, 2880 // W, W) for W in (10, 15, 30, 60)]
+                      for R in [mayfly.BinRollup(X, start, start + window)
+                                for X in services]]),
+            ("build_page",
+             lambda: [mayfly.build_page(X) for X in rollups]),
+            ("build_page_cached",
+             lambda: [mayfly.build_page(X, bin_cache=C)
+                      for X, C in zip(rollups, caches)]),
+            ("build_feed",
+             lambda: [mayfly.build_feed(X) for X in rollups]),
+            ("parse_flight_info_html",
+             lambda: [flight_info.parse_flight_info_html(html, d)
+                      for d, _, html in pages]),
+            ("make_update_dict",
+             lambda: [mayfly._make_update_dict(X) for X in flights]),
+            ("join_AIMS_updates",
+             lambda: [mayfly.join_AIMS_updates(S, F)
+                      for S, F in zip(services, flights)]),
+            ("join_AIMS_updates_table",
+             lambda: [mayfly.join_AIMS_updates_table(T, F)
+                      for T, F in zip(tables, flights)]),
+            ("refresh_services",
+             lambda: [refresh_services(T, F, page_start)
+                      for T, F in zip(tables, flights)]),
+            ("refresh_table",
+             lambda: [refresh_table(T, F, page_start)
+                      for T, F in zip(tables, flights)]),
+        ]
+        for stage, func in stages:
+            result: Dict[str, Any] = {"size": name, "stage": stage}
+            result.update(size._asdict())
+            result.update(measure(func, repeat))
+            results.append(result)
+            print("{:8} {:24} {:10.4f}s {:12,d} bytes".format(
+                name, stage, result["best"], result["peak_bytes"]),
+                  file=sys.stderr)
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    """Print the ratio of new to old best times and peak memory per stage."""
+    old_results = {(R["size"], R["stage"]): R for R in old["results"]}
+    for r in new["results"]:
+        o = old_results.get((r["size"], r["stage"]))
+        if o is None:
+            continue
+        print("{:8} {:24} time x{:.2f} memory x{:.2f}".format(
+            r["size"], r["stage"],
+            r["best"] / o["best"] if o["best"] else float("nan"),
+            (r["peak_bytes"] / o["peak_bytes"]
+             if o["peak_bytes"] else float("nan"))))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    #argparse checks an empty nargs="*" list against choices as a whole,
+    #so the sizes are checked here instead
+    parser.add_argument("sizes", nargs="*", metavar="SIZE",
+                        help="sizes to run, from {} (default: day season)"
+                        .format(", ".join(SIZES)))
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="timed runs per stage (default: 3)")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="results file (default: benchmark.json)")
+    parser.add_argument("-c", "--compare", metavar="FILE",
+                        help="compare results with an earlier results file")
+    args = parser.parse_args()
+    sizes = args.sizes or ["day", "season"]
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("invalid size: {!r} (choose from {})".format(
+                size, ", ".join(SIZES)))
+    output = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "results": run(sizes, args.repeat),
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,9 +21,15 @@ fi
 if [ "$1" = "html" -o "$1" = "all" ]
 then
 aws s3 cp --region=eu-west-2 ${BUCKET}/mayfly.csv ${PROJ_DIR}/mayfly.csv
-./mayfly.py mayfly.csv mayfly.html
-aws s3 cp $STDOPTS --content-type="text/html" mayfly.html $BUCKET
-rm mayfly.csv mayfly.html
+./mayfly.py --feed mayfly.json --shell mayfly-app.html mayfly.csv mayfly.html
+gzip -9 -n mayfly.html mayfly.json
+aws s3 cp $STDOPTS --content-type="text/html; charset=utf-8" \
+    --content-encoding=gzip mayfly.html.gz ${BUCKET}/mayfly.html
+aws s3 cp $STDOPTS --content-type="application/json" \
+    --content-encoding=gzip mayfly.json.gz ${BUCKET}/mayfly.json
+aws s3 cp $STDOPTS --content-type="text/html; charset=utf-8" \
+    mayfly-app.html ${BUCKET}/mayfly-app.html
+rm mayfly.csv mayfly.html.gz mayfly.json.gz mayfly-app.html
 fi
 
 if [ "$1" = "js" -o "$1" = "all" ]
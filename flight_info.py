@@ -1,12 +1,21 @@
 #!/usr/bin/python3
 
 import sys
-from bs4 import BeautifulSoup # type: ignore
-from typing import NamedTuple, Optional, List
+import os
+import asyncio
+import time
+from html.parser import HTMLParser
+from typing import (NamedTuple, Optional, List, Tuple, Iterable, Iterator,
+                    Union, Dict, Any)
 import datetime as dt
 import getpass
 
 import aims
+import metrics
+
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("AIMS_MAX_CONCURRENT") or 4)
+DEADLINE = float(os.getenv("AIMS_DEADLINE") or 50)
 
 
 class Flight(NamedTuple):
@@ -40,6 +49,152 @@ def _to_dt(s:str, d: dt.date) -> dt.datetime:
         d, dt.datetime.strptime(s, "%H:%M").time())
 
 
+class _RowParser(HTMLParser):
+    """Incrementally extract the cell text of table rows from html.
+
+    Each row is a list with an entry for each <td> within the <tr>, being the
+    whitespace stripped text nodes of the cell joined together. Open elements
+    are tracked as BeautifulSoup's html.parser tree builder tracks them, so
+    unclosed and nested elements give the same rows as soup.find_all("tr")
+    would. Rows are available from pop_rows in document order as soon as
+    they, and any rows that started before them, are complete.
+    """
+
+    VOID_ELEMENTS = {
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen",
+        "link", "menuitem", "meta", "param", "source", "track", "wbr",
+        "basefont", "bgsound", "command", "frame", "image", "isindex",
+        "nextid", "spacer"}
+    NON_TEXT_ELEMENTS = {"script", "style", "template"}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self._rows: List[Tuple[List[List[str]], List[bool]]] = []
+        self._open: List[
+            Tuple[str, Union[List[List[str]], List[str], None]]] = []
+        self._text: List[str] = []
+
+    def _flush_text(self) -> None:
+        if not self._text:
+            return
+        text = "".join(self._text).strip()
+        self._text = []
+        if self._open and self._open[-1][0] in self.NON_TEXT_ELEMENTS:
+            return
+        if text:
+            for tag, data in self._open:
+                if tag == "td":
+                    data.append(text) # type: ignore
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_text()
+        data: Union[List[List[str]], List[str], None] = None
+        if tag == "tr":
+            data = []
+            self._rows.append((data, [False]))
+        elif tag == "td":
+            data = []
+            for open_tag, open_data in self._open:
+                if open_tag == "tr":
+                    open_data.append(data) # type: ignore
+        if tag not in self.VOID_ELEMENTS:
+            self._open.append((tag, data))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._flush_text()
+        if tag not in [T for T, _ in self._open]:
+            return
+        while True:
+            open_tag, data = self._open.pop()
+            if open_tag == "tr":
+                for cells, complete in self._rows:
+                    if cells is data:
+                        complete[0] = True
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        self._text.append(data)
+
+    def handle_comment(self, data):
+        self._flush_text()
+
+    def handle_decl(self, decl):
+        self._flush_text()
+
+    def unknown_decl(self, data):
+        self._flush_text()
+        if data.startswith("CDATA["):
+            self._text.append(data[6:])
+            self._flush_text()
+
+    def handle_pi(self, data):
+        self._flush_text()
+
+    def close(self) -> None:
+        super().close()
+        self._flush_text()
+        self._open = []
+        for _, complete in self._rows:
+            complete[0] = True
+
+    def pop_rows(self) -> List[List[str]]:
+        """Remove and return the rows completed so far."""
+        count = 0
+        while count < len(self._rows) and self._rows[count][1][0]:
+            count += 1
+        rows = [["".join(C) for C in R] for R, _ in self._rows[:count]]
+        del self._rows[:count]
+        return rows
+
+
+def _row_to_flight(data: List[str], d: dt.date) -> Optional[Flight]:
+    try:
+        l = data[0].split()
+        return Flight(
+            operator = l[0] if len(l) == 2 else "EZY",
+            flight_num = l[-1],
+            from_ = data[1],
+            to = data[2],
+            type_ = data[3],
+            reg = data[4],
+            sched_off = _to_dt(data[6].split("Z")[0], d),
+            sched_on = _to_dt(data[7].split("Z")[0], d),
+            off = _to_dt(data[8].split("Z")[0], d),
+            on = _to_dt(data[9].split("Z")[0], d),
+        )
+    except ValueError as err:
+        print(str(err), file=sys.stderr)
+        return None
+
+
+def iter_flights(chunks: Iterable[str], d: dt.date) -> Iterator[Flight]:
+    """Extract flight data from AIMS html as it arrives.
+
+    :param chunks: The html from the AIMS flight info table, in pieces. The
+        pieces may be split at any point.
+    :param d: The date of the flights in the table.
+
+    :returns: An iterator of Flight objects corresponding to the lines of the
+              table, each produced as soon as its line is complete.
+    """
+    parser = _RowParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        for row in parser.pop_rows():
+            flight = _row_to_flight(row, d)
+            if flight: yield flight
+    parser.close()
+    for row in parser.pop_rows():
+        flight = _row_to_flight(row, d)
+        if flight: yield flight
+
+
 def parse_flight_info_html(html:str, d: dt.date
 ) -> List[Flight]:
     """Extract flight data from AIMS html.
@@ -48,49 +203,141 @@ def parse_flight_info_html(html:str, d: dt.date
 
     :returns: A list of Flight objects corresponding to the lines of the table.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    info = []
-    for row in soup.find_all("tr"):
-        data = ["".join(X.stripped_strings)
-                for X in row.find_all("td")]
-        try:
-            l = data[0].split()
-            info.append(Flight(
-                operator = l[0] if len(l) == 2 else "EZY",
-                flight_num = l[-1],
-                from_ = data[1],
-                to = data[2],
-                type_ = data[3],
-                reg = data[4],
-                sched_off = _to_dt(data[6].split("Z")[0], d),
-                sched_on = _to_dt(data[7].split("Z")[0], d),
-                off = _to_dt(data[8].split("Z")[0], d),
-                on = _to_dt(data[9].split("Z")[0], d),
-            ))
-        except ValueError as err:
-            print(str(err), file=sys.stderr)
-    return info
-
-
-def get_AIMS_flights(pw: str, d: dt.date, count: int = 1) -> List[Flight]:
+    return list(iter_flights([html], d))
+
+
+def _fetch_flights(d: dt.date, type_: str, airport: str,
+                   deadline: Optional[float]
+) -> List[Flight]:
+    """Retrieve and parse a single AIMS flight info page.
+
+    Runs in a worker thread. The page is parsed as it streams in, so parsing
+    overlaps the transfer. The request timeout is cut short if the deadline
+    (a time.monotonic value) is nearer.
+    """
+    timeout = aims._request_timeout(deadline)
+    page: Dict[str, Any] = {
+        "date": d.isoformat(), "type": type_, "airport": airport}
+    def consumer(chunks: Iterator[str]) -> List[Flight]:
+        waiting = 0.0
+        def timed_chunks() -> Iterator[str]:
+            #time spent waiting for the network is not parse time
+            nonlocal waiting
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                waiting += time.perf_counter() - start
+                if chunk is None:
+                    return
+                yield chunk
+        start = time.perf_counter()
+        flights = list(iter_flights(timed_chunks(), d))
+        metrics.record("html_parse",
+                       (time.perf_counter() - start - waiting) * 1000, **page)
+        return flights
+    with metrics.stage("page_fetch", **page):
+        return aims.flight_info_stream(
+            d, type_, consumer, airport=airport.lower(), timeout=timeout)
+
+
+async def _fetch_all(pages: List[Tuple[dt.date, str, str]],
+                     client: aims.AsyncClient
+) -> List[Optional[List[Flight]]]:
+    """Retrieve and parse AIMS pages concurrently.
+
+    :param pages: A list of (date, type_, airport) tuples identifying the
+        pages.
+    :param client: The aims.AsyncClient to make the requests with.
+
+    :returns: A list of lists of Flight objects, in the same order as pages.
+              Pages that failed or were not complete by the client's deadline
+              are None.
+
+    :raises: The first error encountered if no pages could be retrieved.
+    """
+    tasks = [asyncio.ensure_future(
+                 client.call(_fetch_flights, d, type_, airport,
+                             client.deadline))
+             for d, type_, airport in pages]
+    done, pending = await asyncio.wait(tasks, timeout=client.remaining())
+    for task in pending:
+        task.cancel()
+    errors = [E for E in (T.exception() for T in tasks if T in done)
+              if E is not None]
+    for err in errors:
+        print(err, file=sys.stderr)
+    results = [T.result() if T in done and T.exception() is None else None
+               for T in tasks]
+    if pending:
+        print(f"AIMS deadline reached with {len(pending)} of {len(tasks)} "
+              "pages incomplete", file=sys.stderr)
+    if all(R is None for R in results):
+        if errors:
+            raise errors[0]
+        raise TimeoutError("No AIMS pages retrieved before deadline")
+    return results
+
+
+def get_AIMS_flights(pw: str, d: dt.date, count: int = 1,
+                     max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+                     deadline: Optional[float] = DEADLINE
+) -> List[Flight]:
     """Get specified flights from AIMS.
 
+    All the required pages are requested concurrently over a single logged in
+    session. The session is kept for reuse by later calls. Failed requests
+    are retried as described for aims.AsyncClient.
+
     :param pw: AIMS password.
     :param d: The first date required.
     :param count: The number of days required.
+    :param max_concurrent: The maximum number of page requests to have in
+        flight at any one time.
+    :param deadline: The number of seconds the whole run, including logging
+        in, may take, or None for no limit. Pages not retrieved by the
+        deadline are left out of the result.
 
     :returns: A list of Flight objects including arrivals and departures for all
-              the specified dates.
+              the pages that were retrieved.
+    """
+    return get_AIMS_flights_multi(
+        pw, ["BRS"], d, count, max_concurrent, deadline)["BRS"]
+
+
+def get_AIMS_flights_multi(pw: str, airports: List[str], d: dt.date,
+                           count: int = 1,
+                           max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+                           deadline: Optional[float] = DEADLINE
+) -> Dict[str, List[Flight]]:
+    """Get specified flights for several airports from AIMS.
+
+    As get_AIMS_flights, but the pages for all the airports are requested
+    concurrently over the one session.
+
+    :param airports: The three letter codes of the airports, e.g. "BRS".
+
+    :returns: A dictionary with the airport code as key and a list of
+              Flight objects for that airport as data.
     """
     assert(count > 0)
-    aims.connect("009448", pw)
-    flights: List[Flight] = []
-    for type_ in ("A", "D"):
-        for n in range(count):
-            date = dt.date.today() + dt.timedelta(days=n)
-            html = aims.flight_info(date, type_)
-            flights.extend(parse_flight_info_html(html, date))
-    aims.logout(True)
+    assert(max_concurrent > 0)
+    client = aims.AsyncClient(max_concurrent, deadline=deadline)
+    pages = [(d + dt.timedelta(days=n), type_, airport)
+             for airport in airports
+             for type_ in ("A", "D")
+             for n in range(count)]
+    try:
+        aims.ensure_session("009448", pw, client.deadline)
+        results = asyncio.run(_fetch_all(pages, client))
+    except Exception:
+        aims.invalidate()
+        raise
+    finally:
+        client.close()
+    flights: Dict[str, List[Flight]] = {X: [] for X in airports}
+    for (_, _, airport), page in zip(pages, results):
+        if page is not None:
+            flights[airport].extend(page)
     return flights
 
 
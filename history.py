@@ -0,0 +1,208 @@
+"""A persistent history of the delays and cancellations seen in AIMS.
+
+Each refresh records the AIMS flights it retrieved. A flight's estimated
+times change as the day goes on, so a row is kept for each distinct delay
+seen for each flight, with the times it was first and last seen. Recording
+the same flights again only updates the last seen times, so recording is
+idempotent.
+
+The history is held in an SQLite database, indexed for queries by service,
+by route and by time of day over a range of dates. All times are UTC.
+"""
+
+import sqlite3
+import datetime
+from typing import NamedTuple, Optional, List, Iterable, Tuple, Any
+
+import flight_info
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    airport TEXT NOT NULL,
+    operator_id TEXT NOT NULL,
+    service_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    sched INTEGER NOT NULL,
+    cancelled INTEGER NOT NULL,
+    delay INTEGER NOT NULL,
+    dest_or_orig TEXT NOT NULL,
+    time_of_day INTEGER NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    PRIMARY KEY (airport, operator_id, service_id, type, sched, cancelled,
+                 delay)
+);
+CREATE INDEX IF NOT EXISTS observations_route
+    ON observations (airport, dest_or_orig, sched);
+CREATE INDEX IF NOT EXISTS observations_time_of_day
+    ON observations (airport, time_of_day, sched);
+"""
+
+_COLUMNS = ("airport, operator_id, service_id, type, sched, cancelled, delay, "
+            "dest_or_orig, first_seen, last_seen")
+
+
+class Observation(NamedTuple):
+    """A delay, or cancellation, seen in AIMS for a flight.
+
+    :var airport: The airport the flight is an arrival to or departure from.
+    :var type_: Either 'A' for an arrival or 'D' for a departure.
+    :var sched: The scheduled time of arrival or departure in AIMS.
+    :var operator_id: The operator, e.g. "EZY".
+    :var service_id: The flight number, e.g. "570".
+    :var dest_or_orig: For arrivals, the origin of the flight, for departures
+        the destination of the flight.
+    :var delay: The delay in minutes, or None if the flight was cancelled.
+    :var first_seen: When this delay was first seen.
+    :var last_seen: When this delay was last seen.
+    """
+    airport: str
+    type_: str
+    sched: datetime.datetime
+    operator_id: str
+    service_id: str
+    dest_or_orig: str
+    delay: Optional[int]
+    first_seen: datetime.datetime
+    last_seen: datetime.datetime
+
+
+def _to_seconds(dt: datetime.datetime) -> int:
+    return int((dt - _EPOCH).total_seconds())
+
+
+def _from_seconds(seconds: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def _row(f: flight_info.Flight, airport: str, seen: int
+) -> Tuple[Any, ...]:
+    if f.from_ == airport:
+        type_, sched, actual, dest_or_orig = "D", f.sched_off, f.off, f.to
+    else:
+        type_, sched, actual, dest_or_orig = "A", f.sched_on, f.on, f.from_
+    cancelled = f.reg[:5] == "X-CAN"
+    delay = 0 if cancelled else int((actual - sched).total_seconds() / 60)
+    return (airport, f.operator, f.flight_num, type_, _to_seconds(sched),
+            int(cancelled), delay, dest_or_orig, seen, seen)
+
+
+class DelayHistory:
+    """The delay history store.
+
+    :param filename: The SQLite database file. It is created if it does not
+        exist.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self._db = sqlite3.connect(filename, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def record(self, flights: Iterable[flight_info.Flight],
+               airport: str = "BRS",
+               seen: Optional[datetime.datetime] = None) -> int:
+        """Record the delays of flights retrieved from AIMS.
+
+        :param flights: The flights retrieved from AIMS for the airport.
+        :param airport: The airport the flights are for.
+        :param seen: The time the flights were retrieved, or None for now.
+
+        :returns: The number of new observations, i.e. flights not seen
+                  before with the same delay.
+        """
+        seen_seconds = _to_seconds(seen or datetime.datetime.utcnow())
+        rows = [_row(F, airport, seen_seconds) for F in flights]
+        with self._db:
+            before = self._db.total_changes
+            self._db.executemany(
+                f"INSERT OR IGNORE INTO observations ({_COLUMNS}, "
+                "time_of_day) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                "?5 / 60 % 1440)", rows)
+            inserted = self._db.total_changes - before
+            self._db.executemany(
+                "UPDATE observations "
+                "SET first_seen = min(first_seen, ?9), "
+                "last_seen = max(last_seen, ?10) "
+                "WHERE airport = ?1 AND operator_id = ?2 AND service_id = ?3 "
+                "AND type = ?4 AND sched = ?5 AND cancelled = ?6 "
+                "AND delay = ?7", rows)
+        return inserted
+
+    def _query(self, where: str, params: Tuple[Any, ...],
+               start: datetime.datetime, end: datetime.datetime
+    ) -> List[Observation]:
+        cursor = self._db.execute(
+            f"SELECT {_COLUMNS} FROM observations WHERE {where} "
+            "AND sched >= ? AND sched < ? ORDER BY sched, first_seen",
+            params + (_to_seconds(start), _to_seconds(end)))
+        return [Observation(
+                    airport=airport, type_=type_,
+                    sched=_from_seconds(sched),
+                    operator_id=operator_id, service_id=service_id,
+                    dest_or_orig=dest_or_orig,
+                    delay=None if cancelled else delay,
+                    first_seen=_from_seconds(first_seen),
+                    last_seen=_from_seconds(last_seen))
+                for (airport, operator_id, service_id, type_, sched,
+                     cancelled, delay, dest_or_orig, first_seen, last_seen)
+                in cursor]
+
+    def service(self, operator_id: str, service_id: str,
+                start: datetime.datetime, end: datetime.datetime,
+                airport: str = "BRS") -> List[Observation]:
+        """Find the observations of a service.
+
+        :param operator_id: The operator, e.g. "EZY".
+        :param service_id: The flight number, e.g. "570".
+        :param start: Only include flights scheduled at or after this time.
+        :param end: Only include flights scheduled before this time.
+        :param airport: The airport.
+
+        :returns: A list of Observation objects in scheduled time order.
+        """
+        return self._query(
+            "airport = ? AND operator_id = ? AND service_id = ?",
+            (airport, operator_id, service_id), start, end)
+
+    def route(self, dest_or_orig: str,
+              start: datetime.datetime, end: datetime.datetime,
+              airport: str = "BRS") -> List[Observation]:
+        """Find the observations of flights to or from another airport.
+
+        :param dest_or_orig: The other airport, e.g. "NCL".
+
+        The other parameters and the return value are as for service.
+        """
+        return self._query("airport = ? AND dest_or_orig = ?",
+                           (airport, dest_or_orig), start, end)
+
+    def time_of_day(self, first: datetime.time, last: datetime.time,
+                    start: datetime.datetime, end: datetime.datetime,
+                    airport: str = "BRS") -> List[Observation]:
+        """Find the observations of flights scheduled at a time of day.
+
+        :param first: Only include flights scheduled at or after this time
+            of day.
+        :param last: Only include flights scheduled before this time of day.
+            If last is earlier than first, the range is taken to span
+            midnight.
+
+        The other parameters and the return value are as for service.
+        """
+        first_minute = first.hour * 60 + first.minute
+        last_minute = last.hour * 60 + last.minute
+        where = "airport = ? AND time_of_day >= ? AND time_of_day < ?"
+        if last_minute < first_minute:
+            where = ("airport = ? AND (time_of_day >= ? "
+                     "OR time_of_day < ?)")
+        return self._query(where, (airport, first_minute, last_minute),
+                           start, end)
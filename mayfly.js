@@ -2,6 +2,7 @@
 
 function register_service_worker() {
     if (!'serviceWorker' in navigator) return;
+    navigator.serviceWorker.addEventListener("message", service_worker_message);
     navigator.serviceWorker.register('/sw.js').then(
         function(registration) {
             // Registration was successful
@@ -14,39 +15,302 @@ function register_service_worker() {
         });
 }
 
+//The service worker serves pages and data from its cache and tells us if it
+//finds a newer version when it revalidates them.
+function service_worker_message(event) {
+    if(!event.data || event.data.type !== "updated") return;
+    var url = event.data.url;
+    var resolve = function(u) {return new URL(u, location.href).href;};
+    var feed_table = document.getElementById("feed_table");
+    if(feed_table) {
+        if(url === resolve(feed_table.dataset.feed)) load_feed(feed_table);
+        else if(url === resolve(feed_table.dataset.delta) && feed)
+            poll_delta(feed_table);
+    } else if(url === location.href.split("#")[0]) {
+        var updated = document.getElementById("updated");
+        updated.textContent = "Newer data available: tap to refresh";
+        updated.classList.add("newer");
+        updated.addEventListener("click", function() {location.reload();});
+    } else if(url === resolve("mayfly-updated.json")) {
+        refresh_updated();
+    }
+}
+
+
+//lookup maps service numbers to the ordinals of the bins they are in, and
+//highlighted is the set of ordinals of the bins currently highlighted
 var lookup;
+var highlighted = {};
+var feed = null;
+var POLL_INTERVAL = 60000;
+
+var DAYS = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday",
+            "Friday", "Saturday"];
+var MONTHS = ["January", "February", "March", "April", "May", "June", "July",
+              "August", "September", "October", "November", "December"];
+
+
+function pad(n) {
+    return (n < 10 ? "0" : "") + n;
+}
+
+
+function bar_width(count, max_scale) {
+    var w = Math.floor(count * 100 / max_scale);
+    return (w > 100 ? 100 : w) + "%";
+}
+
+
+//These functions mirror the templates in templates.py, so that a page
+//rendered from the data feed looks the same as a page rendered by mayfly.py
+function build_service_list(services, ezy) {
+    var items = [];
+    for(var c = 0; c < services.length; c++) {
+        var s = services[c];
+        var item = '<li class="' + (ezy.indexOf(s[1]) >= 0 ? "ezy" : "nonezy") +
+            '"><span class="time">' + s[0] + '</span>:\n' +
+            '<span class="service">' + s[1] + s[2] + " " + s[3] + "</span>";
+        if(ezy.indexOf(s[1]) >= 0) {
+            var delay = s[4];
+            if(delay === null) {
+                item += '\n<span class="delay_unknown"></span>';
+            } else {
+                item += '\n<span class="' + (delay > 0 ? "late" : "not_late") +
+                    '">(' + (delay >= 0 ? "+" : "") + delay + ")</span>";
+            }
+        }
+        items.push(item + "</li>\n");
+    }
+    return "<ul>" + items.join("") + "</ul>\n";
+}
+
+
+function build_bin(c, bin, start, max_scale) {
+    var arrivals = bin[1].length, departures = bin[2].length;
+    return '<tr id="bin' + c + '" class="bin">\n' +
+        '<th class="time"><span>' + pad(start.getUTCHours()) + ":" +
+        pad(start.getUTCMinutes()) + "</span></th>\n" +
+        '<td class="bin_data w' + bin[0] + '">\n' +
+        '<p class="arr" style="width:' + bar_width(arrivals, max_scale) +
+        '">' + (arrivals || " ") + "</p>\n" +
+        '<div class="arr_svc hidden" data-bin="' + c + '" data-type="1"></div>\n' +
+        '<p class="dep" style="width:' + bar_width(departures, max_scale) +
+        '">' + (departures || " ") + "</p>\n" +
+        '<div class="dep_svc hidden" data-bin="' + c + '" data-type="2"></div>\n' +
+        "</td>\n</tr>\n";
+}
+
+
+function render_feed(container) {
+    var rows = ['<table>\n<colgroup>\n<col style="width:3em;"/><col/>\n' +
+                "</colgroup>\n"];
+    for(var c = 0; c < feed.bins.length; c++) {
+        var b = bin_start(c);
+        if(c === 0 || (b.getUTCHours() === 0 && b.getUTCMinutes() === 0)) {
+            rows.push('<tr><th colspan="2">' + DAYS[b.getUTCDay()] + " " +
+                      pad(b.getUTCDate()) + " " + MONTHS[b.getUTCMonth()] +
+                      "</th></tr>\n");
+        }
+        rows.push(build_bin(c, feed.bins[c], b, feed.max_scale));
+    }
+    rows.push("</table>\n");
+    container.innerHTML = rows.join("");
+    //feed.lookup is only correct for the feed as loaded, not once deltas
+    //have been applied to it
+    make_lookup();
+    highlighted = {};
+    document.getElementById("updated").textContent = feed.updated;
+    add_listing_listeners(container);
+    services_box_changed();
+}
+
+
+function bin_start(c) {
+    return new Date(Date.parse(feed.start) + c * feed.bin_minutes * 60000);
+}
+
+
+//must match mayfly._feed_keys
+function service_key(type, rec, c) {
+    return "AD"[type - 1] + rec[1] + rec[2] + "@" +
+        bin_start(c).toISOString().slice(0, 10);
+}
+
+
+function make_lookup() {
+    lookup = {};
+    for(var c = 0; c < feed.bins.length; c++) {
+        for(var t = 1; t <= 2; t++) {
+            var services = feed.bins[c][t];
+            for(var e = 0; e < services.length; e++) {
+                if(feed.ezy.indexOf(services[e][1]) < 0) continue;
+                var sid = services[e][2];
+                if(!(sid in lookup)) lookup[sid] = [];
+                if(lookup[sid][lookup[sid].length - 1] !== c)
+                    lookup[sid].push(c);
+            }
+        }
+    }
+}
+
+
+function apply_delta(container, delta) {
+    var c, t, e;
+    var count = feed.bins.length;
+    var touched = {};
+    if(delta.shift) {
+        feed.bins = feed.bins.slice(delta.shift);
+        while(feed.bins.length < count) feed.bins.push([0, [], []]);
+    }
+    feed.start = delta.start;
+    //changed services are removed from their old bins, then re-inserted
+    var gone = {};
+    for(c = 0; c < delta.removed.length; c++) gone[delta.removed[c]] = true;
+    for(c = 0; c < delta.changed.length; c++) {
+        var change = delta.changed[c];
+        gone[service_key(change[1], change.slice(2), change[0])] = true;
+    }
+    for(c = 0; c < count; c++) {
+        for(t = 1; t <= 2; t++) {
+            var kept = [];
+            for(e = 0; e < feed.bins[c][t].length; e++) {
+                if(!(service_key(t, feed.bins[c][t][e], c) in gone))
+                    kept.push(feed.bins[c][t][e]);
+            }
+            if(kept.length !== feed.bins[c][t].length) {
+                feed.bins[c][t] = kept;
+                touched[c] = true;
+            }
+        }
+    }
+    for(c = 0; c < delta.changed.length; c++) {
+        var bin = feed.bins[delta.changed[c][0]];
+        var services = bin[delta.changed[c][1]];
+        services.push(delta.changed[c].slice(2));
+        services.sort(function(a, b) {
+            return a[0] < b[0] ? -1 : (a[0] > b[0] ? 1 : 0);
+        });
+        touched[delta.changed[c][0]] = true;
+    }
+    for(c = 0; c < delta.heat.length; c++) {
+        feed.bins[delta.heat[c][0]][0] = delta.heat[c][1];
+        touched[delta.heat[c][0]] = true;
+    }
+    feed.version = delta.version;
+    feed.updated = delta.updated;
+    if(delta.shift) {
+        render_feed(container);
+        return;
+    }
+    document.getElementById("updated").textContent = feed.updated;
+    make_lookup();
+    //patch only the rows of bins that have changed
+    for(c in touched) {
+        document.getElementById("bin" + c).outerHTML = build_bin(
+            +c, feed.bins[c], bin_start(c), feed.max_scale);
+        add_listing_listeners(document.getElementById("bin" + c));
+        delete highlighted[c];
+    }
+    services_box_changed();
+}
+
+
+function poll_delta(container) {
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        if(req.status !== 200) return;
+        var delta = JSON.parse(req.responseText);
+        if(delta.version === feed.version) return;
+        if(delta.base === feed.version) {
+            apply_delta(container, delta);
+        } else {
+            load_feed(container);
+        }
+    };
+    req.open("GET", container.dataset.delta);
+    req.send();
+}
+
+
+function load_feed(container) {
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        if(req.status !== 200) return;
+        feed = JSON.parse(req.responseText);
+        render_feed(container);
+    };
+    req.open("GET", container.dataset.feed);
+    req.send();
+}
 
 
 function services_box_changed(event) {
     var c;
-    //reset bins
-    var bins = document.getElementsByClassName("bin");
-    for(c = 0; c < bins.length; c++) {
-        bins[c].classList.remove("selected");
-    }
-    //highlight any bins associated with services
+    if(!lookup) return;
+    //find the ordinals of the bins associated with services
+    var wanted = {};
     var i = document.getElementById("services");
     var services = i.value.replace(/[^0-9]+/g, " ").trim().split(" ");
     for(c = 0; c < services.length; c++) {
         if(!services[c]) continue;
         var service = services[c];
         if(service in lookup) {
-            var id_array = lookup[service];
-            for(var e = 0; e < id_array.length; e++) {
-                var b = document.getElementById(id_array[e]);
-                b.classList.add("selected");
+            var ordinals = lookup[service];
+            for(var e = 0; e < ordinals.length; e++) {
+                wanted[ordinals[e]] = true;
             }
         }
     }
+    //only touch the bins whose highlighting has changed
+    var bins = document.getElementsByClassName("bin");
+    for(c in highlighted) {
+        if(!(c in wanted)) bins[c].classList.remove("selected");
+    }
+    for(c in wanted) {
+        if(!(c in highlighted)) bins[c].classList.add("selected");
+    }
+    highlighted = wanted;
+}
+
+
+function refresh_updated() {
+    //the page is only re-uploaded when it changes, so the time it was last
+    //checked against AIMS is published separately
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        if(req.status !== 200) return;
+        try {
+            document.getElementById("updated").textContent =
+                JSON.parse(req.responseText).updated;
+        } catch(e) {}
+    };
+    req.open("GET", "mayfly-updated.json");
+    req.send();
 }
 
 
 function toggle_service_listing(event) {
     var target = event.target.nextSibling.nextSibling;
+    //listings from the data feed are only rendered when first opened
+    if(target.dataset.bin !== undefined && !target.firstChild) {
+        target.innerHTML = build_service_list(
+            feed.bins[target.dataset.bin][target.dataset.type], feed.ezy);
+    }
     target.classList.toggle("hidden");
 }
 
 
+function add_listing_listeners(root) {
+    var c;
+    var l = root.getElementsByClassName("arr");
+    for(c = 0; c < l.length; c++)
+        l[c].addEventListener("click", toggle_service_listing);
+    l = root.getElementsByClassName("dep");
+    for(c = 0; c < l.length; c++)
+        l[c].addEventListener("click", toggle_service_listing);
+}
+
+
 window.onload = function() {
     var i = document.getElementById("services");
     i.value = "";
@@ -54,16 +318,20 @@ window.onload = function() {
     i.addEventListener("keyup", function(event) {
         if(event.keyCode === 13) i.blur();
     });
-    var c;
-    var l = document.getElementsByClassName("arr");
-    for(c = 0; c < l.length; c++)
-        l[c].addEventListener("click", toggle_service_listing);
-    l = document.getElementsByClassName("dep");
-    for(c = 0; c < l.length; c++)
-        l[c].addEventListener("click", toggle_service_listing);
+    var feed_table = document.getElementById("feed_table");
+    if(feed_table) {
+        load_feed(feed_table);
+        setInterval(function() {
+            if(feed && navigator.onLine) poll_delta(feed_table);
+        }, POLL_INTERVAL);
+    } else {
+        add_listing_listeners(document);
+    }
     if(!navigator.onLine) {
         document.getElementById("title").appendChild(
             document.createTextNode(" (offline)"));
+    } else if(!feed_table) {
+        refresh_updated();
     }
     register_service_worker();
 };
@@ -3,17 +3,46 @@
 import sys
 import os
 import csv
-from typing import NamedTuple, List, Dict, Tuple, Optional
+import argparse
+from typing import (NamedTuple, List, Dict, Tuple, Optional, BinaryIO,
+                    Iterator, Iterable, Sequence, Any, Union, Protocol, cast)
 import datetime
 import getpass
 import json
+import hashlib
+import struct
+import array
+import bisect
+import gzip
+import collections
+import concurrent.futures
+import contextlib
+import sqlite3
+import re
+import time
 import pytz
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
 
 import templates
 import flight_info
+import metrics
+import profiling
+import history
 
 ezy_operator_ids = ["EZY", "EJU", "EZS"]
 
+MAYFLY_WINDOW = 48
+AIRPORT_NAMES = {"BRS": "Bristol"}
+DEFAULT_TIMEZONE = "Europe/London"
+
+CACHE_DIR = os.getenv("MAYFLY_CACHE_DIR")
+BIN_WIDTH = int(os.getenv("MAYFLY_BIN_WIDTH") or 30)
+HEAT_WINDOW = int(os.getenv("MAYFLY_HEAT_WINDOW") or 0) or None
+HISTORY_FILE = os.getenv("MAYFLY_HISTORY")
+
 class Service(NamedTuple):
     """NamedTuple representing a service extracted from a Mayfly csv.
 
@@ -49,27 +78,83 @@ class MayflyBin(NamedTuple):
 
 
 
-def process_csv(data: List[str]) -> List[Service]:
+def _utc_offset(date_str: str, local_tz: Any
+) -> Optional[datetime.timedelta]:
+    """Find the UTC offset in force for the whole of a local date.
+
+    :param date_str: A date in the form DD/MM/YYYY.
+    :param local_tz: The pytz timezone of the schedule, e.g. Europe/London.
+
+    :returns: The offset to subtract from local time to get UTC, or None if
+              the offset changes during the day (i.e. it is a DST changeover
+              day).
+    """
+    d = datetime.datetime(
+        int(date_str[6:10]), int(date_str[3:5]), int(date_str[0:2]))
+    start = local_tz.localize(d).utcoffset()
+    end = local_tz.localize(d.replace(hour=23, minute=59)).utcoffset()
+    return start if start == end else None
+
+
+def _is_fast_date(date_str: str) -> bool:
+    """Check that a date field is in the standard DD/MM/YYYY format."""
+    return (len(date_str) == 10 and
+            date_str[2] == "/" and date_str[5] == "/" and
+            date_str[0:2].isdigit() and date_str[3:5].isdigit() and
+            date_str[6:10].isdigit())
+
+
+def _is_fast_format(date_str: str, time_str: str) -> bool:
+    """Check that date and time fields are in the standard fixed format.
+
+    Anything that does not pass this check is handed to strptime so that
+    unusual inputs are either parsed or rejected exactly as they always were.
+    """
+    return (_is_fast_date(date_str) and
+            len(time_str) == 4 and time_str.isdigit())
+
+
+def process_csv(data: List[str], timezone: str = DEFAULT_TIMEZONE
+) -> List[Service]:
     """Map a list of lines of CSV data into a list of Service tuples
 
     Example csv line is:
 
     06/01/2020,A,TOM,6751,TFS,GCTS,TFS,GCTS,73H,189,0030,C,ES,04DEC2019 1403
 
-    Interesting fields: 0: date (BRS local); 1: arrival(A) or departure(D);
-    2:operator id; 3: service id; 4: origin or destination; 10: time (BRS local)
+    Interesting fields: 0: date (local); 1: arrival(A) or departure(D);
+    2:operator id; 3: service id; 4: origin or destination; 10: time (local)
+
+    Date and time fields are sliced directly and converted to UTC using an
+    offset cached per date. Only DST changeover days and non-standard fields
+    go through the full strptime and pytz localization.
 
     :param data: List of strings representing lines of a csv file
+    :param timezone: The timezone of the local dates and times, e.g.
+        "Europe/London" for BRS.
 
     :returns: A corresponding list of Service objects
     """
     reader = csv.reader(data)
     retval: List[Service] = []
-    london_tz = pytz.timezone('Europe/London')
+    local_tz = pytz.timezone(timezone)
+    offsets: Dict[str, Optional[datetime.timedelta]] = {}
     for row in reader:
-        dt_string = row[0] + row[10]
-        dt = datetime.datetime.strptime(dt_string, "%d/%m/%Y%H%M")
-        utc_dt = london_tz.localize(dt).astimezone(pytz.utc).replace(tzinfo=None)
+        date_str, time_str = row[0], row[10]
+        offset = None
+        if _is_fast_format(date_str, time_str):
+            if date_str not in offsets:
+                offsets[date_str] = _utc_offset(date_str, local_tz)
+            offset = offsets[date_str]
+        if offset is not None:
+            utc_dt = datetime.datetime(
+                int(date_str[6:10]), int(date_str[3:5]), int(date_str[0:2]),
+                int(time_str[0:2]), int(time_str[2:4])) - offset
+        else:
+            dt = datetime.datetime.strptime(date_str + time_str,
+                                            "%d/%m/%Y%H%M")
+            utc_dt = local_tz.localize(dt).astimezone(
+                pytz.utc).replace(tzinfo=None)
         retval.append(Service(
             type_=row[1],
             dt=utc_dt,
@@ -80,18 +165,446 @@ def process_csv(data: List[str]) -> List[Service]:
 
 
 
-def _make_update_dict(flights: List[flight_info.Flight]
+CsvIndex = Dict[str, List[Tuple[int, int]]]
+
+_csv_index_cache: Dict[str, Tuple[Tuple[int, int], CsvIndex]] = {}
+
+
+def index_csv(f: BinaryIO) -> CsvIndex:
+    """Build a byte offset index of a Mayfly csv file, keyed on the date field.
+
+    Consecutive lines with the same date are merged into a single range, so
+    for a date ordered file the index has one entry per date.
+
+    :param f: The csv file, opened in binary mode.
+
+    :returns: A dictionary with the date field (usually DD/MM/YYYY) as key and
+              a list of (start, end) byte ranges as data.
+    """
+    index: CsvIndex = {}
+    offset = 0
+    last_key = None
+    for line in f:
+        key = line.split(b",", 1)[0].decode()
+        end = offset + len(line)
+        if key == last_key:
+            index[key][-1] = (index[key][-1][0], end)
+        else:
+            index.setdefault(key, []).append((offset, end))
+        last_key = key
+        offset = end
+    return index
+
+
+def read_csv_window(csv_filename: str,
+                    start: datetime.datetime,
+                    end: datetime.datetime,
+                    timezone: str = DEFAULT_TIMEZONE
+) -> List[Service]:
+    """Parse only the rows of a Mayfly csv file that may fall in a window.
+
+    The byte offset index of the file is cached between calls and is rebuilt
+    only if the file's size or modification time changes. Rows are selected
+    by local date with a day either side to allow for the difference
+    between local time and UTC. Rows whose date field is not in the standard
+    format are always included, so they are handled exactly as process_csv
+    would handle them.
+
+    :param csv_filename: The path of the csv file.
+    :param start: The start of the window (UTC).
+    :param end: The end of the window (UTC).
+    :param timezone: As for process_csv.
+
+    :returns: A list of Service objects that includes all the services in the
+              window.
+    """
+    return process_csv(_read_csv_window_lines(csv_filename, start, end),
+                       timezone)
+
+
+def _read_csv_window_lines(csv_filename: str,
+                           start: datetime.datetime,
+                           end: datetime.datetime) -> List[str]:
+    """The lines of a Mayfly csv file selected by read_csv_window."""
+    stat = os.stat(csv_filename)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with open(csv_filename, "rb") as f:
+        cached = _csv_index_cache.get(csv_filename)
+        if cached and cached[0] == signature:
+            index = cached[1]
+        else:
+            index = index_csv(f)
+            _csv_index_cache[csv_filename] = (signature, index)
+        keys = [K for K in index if not _is_fast_date(K)]
+        d = start.date() - datetime.timedelta(days=1)
+        while d <= end.date() + datetime.timedelta(days=1):
+            keys.append(d.strftime("%d/%m/%Y"))
+            d += datetime.timedelta(days=1)
+        ranges = sorted(R for K in keys for R in index.get(K, []))
+        lines: List[str] = []
+        for range_start, range_end in ranges:
+            f.seek(range_start)
+            lines.extend(
+                f.read(range_end - range_start).decode().splitlines(True))
+    return lines
+
+
+_CACHE_MAGIC = b"MAYFLYC1"
+_CACHE_HEADER = struct.Struct("<8s20sII")
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MINUTE = datetime.timedelta(minutes=1)
+#the delay of a service whose delay is unknown, i.e. None
+_NO_DELAY = -0x80000000
+
+
+def _to_minutes(dt: datetime.datetime) -> int:
+    return (dt - _EPOCH) // _MINUTE
+
+
+def csv_digest(csv_filename: str) -> bytes:
+    """Calculate the SHA1 digest of the contents of a csv file."""
+    h = hashlib.sha1()
+    with open(csv_filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+class ServiceTable:
+    """Services from the schedule held column-wise.
+
+    Each service is a row across a set of arrays: the time in minutes since
+    the epoch (UTC), and codes for type_, operator_id, service_id and
+    dest_or_orig that index a shared string table. Tables are kept in time
+    order, so that a window can be located by bisection, and a refresh can
+    join AIMS updates (join_AIMS_updates_table) and count services into bins
+    (BinRollup.from_table) on plain integers rather than Service objects and
+    datetimes. Service objects are only created for the rows that are shown.
+
+    Tables should be created with from_services, process_csv_table or load;
+    ServiceTable() is an empty table.
+
+    :var strings: The string table.
+    :var minutes: The time of each service in minutes since the epoch.
+    :var types: The string table index of each service's type_.
+    :var operators: The string table index of each service's operator_id.
+    :var service_ids: The string table index of each service's service_id.
+    :var places: The string table index of each service's dest_or_orig.
+    :var delays: The delay of each service in minutes, or _NO_DELAY if it is
+        None. Delays are not saved, since they are always None for services
+        straight from the csv.
+    """
+
+    def __init__(self) -> None:
+        self.strings: List[str] = []
+        self._codes: Dict[str, int] = {}
+        self.minutes = array.array("i")
+        self.types = array.array("I")
+        self.operators = array.array("I")
+        self.service_ids = array.array("I")
+        self.places = array.array("I")
+        self.delays = array.array("i")
+
+    def __len__(self) -> int:
+        return len(self.minutes)
+
+    def _schedule_columns(self) -> List[array.array]:
+        return [self.minutes, self.types, self.operators, self.service_ids,
+                self.places]
+
+    def _columns(self) -> List[array.array]:
+        return self._schedule_columns() + [self.delays]
+
+    def _code(self, field: str) -> int:
+        code = self._codes.get(field)
+        if code is None:
+            code = self._codes[field] = len(self.strings)
+            self.strings.append(field)
+        return code
+
+    def _append(self, type_: str, minutes: int, operator_id: str,
+                service_id: str, dest_or_orig: str,
+                delay: Optional[int] = None) -> None:
+        self.minutes.append(minutes)
+        self.types.append(self._code(type_))
+        self.operators.append(self._code(operator_id))
+        self.service_ids.append(self._code(service_id))
+        self.places.append(self._code(dest_or_orig))
+        self.delays.append(_NO_DELAY if delay is None else delay)
+
+    def _sort(self) -> "ServiceTable":
+        order = sorted(range(len(self)), key=self.minutes.__getitem__)
+        for column in self._columns():
+            column[:] = array.array(column.typecode,
+                                    [column[X] for X in order])
+        return self
+
+    def _slice(self, first: int, last: int) -> "ServiceTable":
+        table = ServiceTable()
+        table.strings, table._codes = self.strings, self._codes
+        for column, source in zip(table._columns(), self._columns()):
+            column.extend(source[first:last])
+        return table
+
+    @classmethod
+    def from_services(cls, services: List[Service]) -> "ServiceTable":
+        """Create a table from a list of Service objects."""
+        table = cls()
+        for s in services:
+            table._append(s.type_, _to_minutes(s.dt), s.operator_id,
+                          s.service_id, s.dest_or_orig, s.delay)
+        return table._sort()
+
+    def to_services(self, rows: Optional[Sequence[int]] = None
+    ) -> List[Service]:
+        """Convert the table to a list of Service objects in time order.
+
+        :param rows: If not None, only convert these rows, in this order.
+        """
+        strings = self.strings
+        columns: Iterable[Iterable[int]] = self._columns()
+        if rows is not None:
+            columns = [map(X.__getitem__, rows) for X in self._columns()]
+        return [Service(type_=strings[t],
+                        dt=_EPOCH + datetime.timedelta(minutes=m),
+                        operator_id=strings[o],
+                        service_id=strings[i],
+                        dest_or_orig=strings[p],
+                        delay=None if d == _NO_DELAY else d)
+                for m, t, o, i, p, d in zip(*columns)]
+
+    def window(self, start: Optional[datetime.datetime] = None,
+               end: Optional[datetime.datetime] = None) -> "ServiceTable":
+        """Select the services in a window.
+
+        :param start: If not None, only include services at or after this
+            time.
+        :param end: If not None, only include services before this time.
+
+        :returns: A new table. The string table is shared.
+        """
+        first, last = 0, len(self)
+        if start is not None:
+            first = bisect.bisect_left(self.minutes, _to_minutes(start))
+        if end is not None:
+            last = bisect.bisect_left(self.minutes, _to_minutes(end))
+        return self._slice(first, last)
+
+    def save(self, cache_filename: str, digest: bytes) -> None:
+        """Save the table to a compact binary cache file.
+
+        The file consists of a header (magic, csv digest, record count and
+        string table length), a NUL separated string table and then the five
+        array columns other than delays.
+
+        :param cache_filename: The path of the cache file to write.
+        :param digest: The digest of the csv file the table was parsed from.
+        """
+        string_table = "\0".join(self.strings).encode()
+        tmp_filename = cache_filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(_CACHE_HEADER.pack(
+                _CACHE_MAGIC, digest, len(self), len(string_table)))
+            f.write(string_table)
+            for column in self._schedule_columns():
+                column.tofile(f)
+        os.replace(tmp_filename, cache_filename)
+
+    @classmethod
+    def load(cls, cache_filename: str, digest: bytes
+    ) -> Optional["ServiceTable"]:
+        """Load a table from a binary cache file written by save.
+
+        :param cache_filename: The path of the cache file.
+        :param digest: The digest of the current csv file. If this does not
+            match the digest stored in the cache file, the cache is stale.
+
+        :returns: The table, or None if the cache file is missing, stale or
+                  unreadable.
+        """
+        table = cls()
+        try:
+            with open(cache_filename, "rb") as f:
+                magic, cache_digest, count, table_len = _CACHE_HEADER.unpack(
+                    f.read(_CACHE_HEADER.size))
+                if magic != _CACHE_MAGIC or cache_digest != digest:
+                    return None
+                if table_len:
+                    table.strings = f.read(table_len).decode().split("\0")
+                for column in table._schedule_columns():
+                    column.fromfile(f, count)
+        except (OSError, EOFError, struct.error, UnicodeDecodeError):
+            return None
+        table.delays = array.array("i", [_NO_DELAY]) * count
+        table._codes = {S: C for C, S in enumerate(table.strings)}
+        return table
+
+
+def heat_levels(arrivals: Sequence[float], departures: Sequence[float],
+                heat_map_params: Tuple[float, float, float]) -> List[int]:
+    """Calculate the warning level of each of a run of bins.
+
+    :param arrivals: The number of arrivals in each bin.
+    :param departures: The number of departures in each bin.
+    :param heat_map_params: As for build_bin.
+
+    :returns: A list of warning levels (0, 1 or 2), one per bin.
+    """
+    x, w1, w2 = heat_map_params
+    return [2 if h >= w2 else 1 if h >= w1 else 0
+            for h in [x * a + (1 - x) * d
+                      for a, d in zip(arrivals, departures)]]
+
+
+def process_csv_table(data: Iterable[str], timezone: str = DEFAULT_TIMEZONE
+) -> ServiceTable:
+    """Parse lines of CSV data straight into a ServiceTable.
+
+    This gives the same services as process_csv, but the times are
+    calculated as minutes since the epoch without creating a datetime for
+    each line.
+
+    :param data: The lines of a csv file.
+    :param timezone: As for process_csv.
+
+    :returns: A ServiceTable of the services.
+    """
+    table = ServiceTable()
+    local_tz = pytz.timezone(timezone)
+    #UTC minutes since the epoch at local midnight, per date
+    bases: Dict[str, Optional[int]] = {}
+    for row in csv.reader(data):
+        date_str, time_str = row[0], row[10]
+        base = None
+        if (_is_fast_format(date_str, time_str) and
+                int(time_str[0:2]) < 24 and int(time_str[2:4]) < 60):
+            if date_str not in bases:
+                offset = _utc_offset(date_str, local_tz)
+                bases[date_str] = None if offset is None else _to_minutes(
+                    datetime.datetime(int(date_str[6:10]),
+                                      int(date_str[3:5]),
+                                      int(date_str[0:2])) - offset)
+            base = bases[date_str]
+        if base is not None:
+            minutes = base + int(time_str[0:2]) * 60 + int(time_str[2:4])
+        else:
+            dt = datetime.datetime.strptime(date_str + time_str,
+                                            "%d/%m/%Y%H%M")
+            minutes = _to_minutes(local_tz.localize(dt).astimezone(
+                pytz.utc).replace(tzinfo=None))
+        table._append(row[1], minutes, row[2], row[3], row[4])
+    return table._sort()
+
+
+def save_schedule_cache(cache_filename: str, digest: bytes,
+                        services: List[Service]) -> None:
+    """Save a list of services to a compact binary cache file.
+
+    See ServiceTable.save.
+
+    :param cache_filename: The path of the cache file to write.
+    :param digest: The digest of the csv file the services were parsed from.
+    :param services: The services to save.
+    """
+    ServiceTable.from_services(services).save(cache_filename, digest)
+
+
+def load_schedule_cache(cache_filename: str, digest: bytes,
+                        start: Optional[datetime.datetime] = None,
+                        end: Optional[datetime.datetime] = None
+) -> Optional[List[Service]]:
+    """Load services from a binary cache file written by save_schedule_cache.
+
+    :param cache_filename: The path of the cache file.
+    :param digest: The digest of the current csv file. If this does not match
+        the digest stored in the cache file, the cache is stale.
+    :param start: If not None, only load services at or after this time.
+    :param end: If not None, only load services before this time.
+
+    :returns: A list of services in time order, or None if the cache file is
+              missing, stale or unreadable.
+    """
+    table = ServiceTable.load(cache_filename, digest)
+    if table is None:
+        return None
+    return table.window(start, end).to_services()
+
+
+def load_services(csv_filename: str,
+                  start: datetime.datetime,
+                  end: datetime.datetime,
+                  cache_filename: Optional[str] = None,
+                  timezone: str = DEFAULT_TIMEZONE
+) -> List[Service]:
+    """Load the services that may fall in a window from a Mayfly csv file.
+
+    Without a cache file, this is read_csv_window. With a cache file, the
+    services are loaded from the cache if it was built from a csv file with
+    the same contents, otherwise the whole csv is parsed and the cache is
+    rebuilt. As with read_csv_window, a day either side of the window is
+    included.
+
+    :param csv_filename: The path of the csv file.
+    :param start: The start of the window (UTC).
+    :param end: The end of the window (UTC).
+    :param cache_filename: The path of the binary cache file, or None to not
+        use a cache.
+    :param timezone: As for process_csv.
+
+    :returns: A list of Service objects that includes all the services in the
+              window.
+    """
+    if not cache_filename:
+        return read_csv_window(csv_filename, start, end, timezone)
+    return load_service_table(csv_filename, start, end, cache_filename,
+                              timezone).to_services()
+
+
+def load_service_table(csv_filename: str,
+                       start: datetime.datetime,
+                       end: datetime.datetime,
+                       cache_filename: Optional[str] = None,
+                       timezone: str = DEFAULT_TIMEZONE
+) -> ServiceTable:
+    """Load the services that may fall in a window as a ServiceTable.
+
+    As load_services, but no Service objects are created. The parameters
+    are as for load_services.
+
+    :returns: A table that includes all the services in the window.
+    """
+    if not cache_filename:
+        return process_csv_table(
+            _read_csv_window_lines(csv_filename, start, end), timezone)
+    digest = csv_digest(csv_filename)
+    if timezone != DEFAULT_TIMEZONE:
+        #the cached times depend on the timezone as well as the csv
+        digest = hashlib.sha1(digest + timezone.encode()).digest()
+    start -= datetime.timedelta(days=1)
+    end += datetime.timedelta(days=1)
+    table = ServiceTable.load(cache_filename, digest)
+    if table is None:
+        with open(csv_filename) as f:
+            table = process_csv_table(f, timezone)
+        table.save(cache_filename, digest)
+    return table.window(start, end)
+
+
+def _make_update_dict(flights: List[flight_info.Flight],
+                      airport: str = "BRS"
 ) -> Dict[Service, Optional[Service]]:
     """Create mappings for AIMS updates.
 
     :param flights: A list of flight_info.Flight objects
+    :param airport: The airport that the services are arrivals to or
+        departures from.
 
     :returns: A mapping from the scheduled Service object to a Service object
               with estimated or actual times.
     """
     updates: Dict[Service, Optional[Service]] = {}
     for f in flights:
-        if f.from_ == "BRS":
+        if f.from_ == airport:
             type_ = "D"
             delay = f.off - f.sched_off
             dest_or_orig = f.to
@@ -115,51 +628,337 @@ def _make_update_dict(flights: List[flight_info.Flight]
     return updates
 
 
-def update_services_from_AIMS(services: List[Service]
+def update_services_from_AIMS(services: List[Service],
+                              password: Optional[str] = None
 ) -> Optional[List[Service]]:
     """Use AIMS to update a list of Service objects.
 
     :param services: The list of services to apply the update to.
+    :param password: The AIMS password. If None, the AIMSPASSWORD
+        environment variable is used, or failing that the user is prompted.
 
     :returns: An updated list of services or None if unable to update.  The
               original input list is not changed by this function.
     """
+    flights = _get_AIMS_flights(password)
+    if flights is None:
+        return None
+    return apply_AIMS_updates(services, flights)
+
+
+def update_table_from_AIMS(table: ServiceTable,
+                           password: Optional[str] = None
+) -> Optional[ServiceTable]:
+    """Use AIMS to update a ServiceTable.
+
+    As update_services_from_AIMS, but the join is made on the table's
+    columns with join_AIMS_updates_table.
+
+    :param table: The table to apply the update to.
+    :param password: As for update_services_from_AIMS.
+
+    :returns: An updated table or None if unable to update. The original
+              table is not changed by this function.
+    """
+    flights = _get_AIMS_flights(password)
+    if flights is None:
+        return None
+    return apply_AIMS_updates_table(table, flights)
+
+
+def _get_AIMS_flights(password: Optional[str]
+) -> Optional[List[flight_info.Flight]]:
+    """Retrieve today's and tomorrow's flights from AIMS and record them.
+
+    :returns: The flights, or None if they could not be retrieved.
+    """
     try:
-        flights = flight_info.get_AIMS_flights(
-            os.getenv("AIMSPASSWORD") or getpass.getpass(),
-            datetime.date.today(), 2)
+        with metrics.stage("aims_fetch"):
+            flights = flight_info.get_AIMS_flights(
+                password or os.getenv("AIMSPASSWORD") or getpass.getpass(),
+                datetime.date.today(), 2)
     except Exception as err:
         #much can go wrong talking to AIMS, so just return None if it throws any
         #exceptions.
         print(err, file=sys.stderr)
         return None
-    updates = _make_update_dict(flights)
+    record_history({"BRS": flights})
+    return flights
+
+
+def record_history(flights: Dict[str, List[flight_info.Flight]],
+                   filename: Optional[str] = HISTORY_FILE) -> None:
+    """Add the delays of flights retrieved from AIMS to the delay history.
+
+    Nothing is done if there is no history file. Failure to record the
+    history is reported but does not stop the refresh.
+
+    :param flights: A dictionary with the airport code as key and a list of
+        the flights retrieved from AIMS for that airport as data.
+    :param filename: The history database file, or None for no history. See
+        history.DelayHistory.
+    """
+    if not filename:
+        return
+    try:
+        with metrics.stage("history"):
+            store = history.DelayHistory(filename)
+            try:
+                for airport, airport_flights in flights.items():
+                    store.record(airport_flights, airport)
+            finally:
+                store.close()
+    except sqlite3.Error as err:
+        print(err, file=sys.stderr)
+
+
+class JoinStats(NamedTuple):
+    """Counts from joining AIMS flights to scheduled services.
+
+    :var matched: The number of services matched to an AIMS flight.
+    :var retimed: The number of matched services whose AIMS scheduled time
+        differs from the time in the schedule.
+    :var cancelled: The number of matched services that AIMS shows as
+        cancelled.
+    :var unmatched: The number of services with no AIMS flight.
+    :var unused: The number of AIMS flights that matched no service.
+    """
+    matched: int
+    retimed: int
+    cancelled: int
+    unmatched: int
+    unused: int
+
+
+def _make_update_index(flights: List[flight_info.Flight],
+                       airport: str = "BRS"
+) -> Dict[Tuple[str, str, str, datetime.date],
+          List[Tuple[datetime.datetime, Optional[Service]]]]:
+    """Index AIMS updates by flight and day.
+
+    :param flights: A list of flight_info.Flight objects
+    :param airport: The airport that the services are arrivals to or
+        departures from.
+
+    :returns: A mapping from (operator_id, service_id, type_, date) to a list
+              of (scheduled time, update) tuples, the update being as for
+              _make_update_dict. The date is the UTC date of the scheduled
+              time. There is usually one entry in each list, but a flight
+              number may be used more than once in a day.
+    """
+    index: Dict[Tuple[str, str, str, datetime.date],
+                List[Tuple[datetime.datetime, Optional[Service]]]] = {}
+    for orig, update in _make_update_dict(flights, airport).items():
+        key = (orig.operator_id, orig.service_id, orig.type_, orig.dt.date())
+        index.setdefault(key, []).append((orig.dt, update))
+    return index
+
+
+def join_AIMS_updates(services: List[Service],
+                      flights: List[flight_info.Flight],
+                      airport: str = "BRS"
+) -> Tuple[List[Service], JoinStats]:
+    """Apply flight data retrieved from AIMS to a list of Service objects.
+
+    Services are matched to AIMS flights by operator, flight number, type
+    and date rather than by exact scheduled time, so that flights that have
+    been retimed since the schedule was published are still updated. Where
+    a flight number is used more than once in a day, each service takes the
+    unmatched flight whose scheduled time is nearest its own.
+
+    :param services: The list of services to apply the update to.
+    :param flights: The flights retrieved from AIMS for the airport.
+    :param airport: The airport the services are for.
+
+    :returns: A tuple of the updated list of services and the statistics of
+              the join. Cancelled services are removed. The original input
+              list is not changed by this function.
+    """
+    index = _make_update_index(flights, airport)
     retval: List[Service] = []
+    matched = retimed = cancelled = 0
     for s in services:
-        if s in updates:
-            update = updates[s]
-            if update is not None:
-                retval.append(update)
-        else:
+        candidates = index.get(
+            (s.operator_id, s.service_id, s.type_, s.dt.date()))
+        if not candidates:
             retval.append(s)
+            continue
+        nearest = min(range(len(candidates)),
+                      key=lambda X: abs(candidates[X][0] - s.dt))
+        sched, update = candidates.pop(nearest)
+        matched += 1
+        if sched != s.dt:
+            retimed += 1
+        if update is None:
+            cancelled += 1
+        else:
+            retval.append(update)
+    stats = JoinStats(matched, retimed, cancelled, len(services) - matched,
+                      sum(len(X) for X in index.values()))
+    return retval, stats
+
+
+def join_AIMS_updates_table(table: ServiceTable,
+                            flights: List[flight_info.Flight],
+                            airport: str = "BRS"
+) -> Tuple[ServiceTable, JoinStats]:
+    """Apply flight data retrieved from AIMS to a ServiceTable.
+
+    The services are matched as join_AIMS_updates matches them, but the
+    AIMS flights are translated into the table's string codes and minutes
+    once, so the table's rows are only read as integers. The columns are
+    copied, the matched rows updated in place, and then the rows are put
+    back in time order.
+
+    :param table: The table to apply the update to.
+    :param flights: The flights retrieved from AIMS for the airport.
+    :param airport: The airport the services are for.
+
+    :returns: A tuple of the updated table, in time order, and the
+              statistics of the join. Cancelled services are removed. The
+              original table is not changed by this function.
+    """
+    retval = ServiceTable()
+    retval.strings, retval._codes = list(table.strings), dict(table._codes)
+    codes = table._codes
+    #as _make_update_dict, keyed by the codes of the operator, flight number
+    #and type, the day, the scheduled time and the code of dest_or_orig;
+    #each update is None for a cancelled flight, or its new time, delay and
+    #dest_or_orig code
+    updates: Dict[Tuple[Optional[int], Optional[int], Optional[int],
+                        int, int, int],
+                  Optional[Tuple[int, int, int]]] = {}
+    for f in flights:
+        if f.from_ == airport:
+            type_, sched, new, place = "D", f.sched_off, f.off, f.to
+        else:
+            type_, sched, new, place = "A", f.sched_on, f.on, f.from_
+        sched_minutes = _to_minutes(sched)
+        place_code = retval._code(place)
+        updates[(codes.get(f.operator), codes.get(f.flight_num),
+                 codes.get(type_), sched_minutes // 1440, sched_minutes,
+                 place_code)] = (
+            None if f.reg[:5] == "X-CAN" else
+            (_to_minutes(new), int((new - sched).total_seconds() / 60),
+             place_code))
+    #as _make_update_index
+    index: Dict[Tuple[Optional[int], ...],
+                List[Tuple[int, Optional[Tuple[int, int, int]]]]] = {}
+    unused = 0
+    for key, update in updates.items():
+        if None in key:
+            unused += 1
+        else:
+            index.setdefault(key[:4], []).append((key[4], update))
+    minutes = array.array("i", table.minutes)
+    places = array.array("I", table.places)
+    delays = array.array("i", table.delays)
+    types, operators, service_ids = (
+        table.types, table.operators, table.service_ids)
+    wanted = {X[1] for X in index}
+    rows = [R for R in range(len(table))
+            if service_ids[R] in wanted and
+            (operators[R], service_ids[R], types[R], minutes[R] // 1440)
+            in index]
+    matched = retimed = 0
+    cancelled: List[int] = []
+    for r in rows:
+        candidates = index[
+            (operators[r], service_ids[r], types[r], minutes[r] // 1440)]
+        if not candidates:
+            continue
+        nearest = min(range(len(candidates)),
+                      key=lambda X: abs(candidates[X][0] - minutes[r]))
+        sched_minutes, update = candidates.pop(nearest)
+        matched += 1
+        if sched_minutes != minutes[r]:
+            retimed += 1
+        if update is None:
+            cancelled.append(r)
+        else:
+            minutes[r], delays[r], places[r] = update
+    kept: Iterable[int] = range(len(table))
+    if cancelled:
+        dropped = set(cancelled)
+        kept = [R for R in kept if R not in dropped]
+    order = sorted(kept, key=minutes.__getitem__)
+    for column, source in zip(retval._columns(),
+                              [minutes, types, operators, service_ids,
+                               places, delays]):
+        column.extend(map(source.__getitem__, order))
+    stats = JoinStats(matched, retimed, len(cancelled),
+                      len(table) - matched,
+                      unused + sum(len(X) for X in index.values()))
+    return retval, stats
+
+
+def apply_AIMS_updates(services: List[Service],
+                       flights: List[flight_info.Flight],
+                       airport: str = "BRS"
+) -> List[Service]:
+    """Apply flight data retrieved from AIMS to a list of Service objects.
+
+    As join_AIMS_updates, but the statistics of the join are recorded as
+    properties of the update_join stage.
+
+    :param services: The list of services to apply the update to.
+    :param flights: The flights retrieved from AIMS for the airport.
+    :param airport: The airport the services are for.
+
+    :returns: An updated list of services. Cancelled services are removed.
+              The original input list is not changed by this function.
+    """
+    start = time.perf_counter()
+    retval, stats = join_AIMS_updates(services, flights, airport)
+    metrics.record("update_join", (time.perf_counter() - start) * 1000,
+                   airport=airport, **stats._asdict())
     return retval
 
 
-def split_into_bins(services: List[Service]
+def apply_AIMS_updates_table(table: ServiceTable,
+                             flights: List[flight_info.Flight],
+                             airport: str = "BRS"
+) -> ServiceTable:
+    """Apply flight data retrieved from AIMS to a ServiceTable.
+
+    As join_AIMS_updates_table, but the statistics of the join are recorded
+    as properties of the update_join stage, as apply_AIMS_updates does.
+
+    :returns: The updated table.
+    """
+    start = time.perf_counter()
+    retval, stats = join_AIMS_updates_table(table, flights, airport)
+    metrics.record("update_join", (time.perf_counter() - start) * 1000,
+                   airport=airport, **stats._asdict())
+    return retval
+
+
+def _bin_start(dt: datetime.datetime, width: int) -> datetime.datetime:
+    """The start of the bin of the given width, in minutes, containing dt.
+
+    Bins are aligned to midnight, so the width must divide a day.
+    """
+    if width <= 0 or 1440 % width:
+        raise ValueError(f"Bin width of {width} minutes does not divide a day")
+    minutes = dt.hour * 60 + dt.minute
+    return datetime.datetime.combine(dt.date(), datetime.time(
+        *divmod(minutes - minutes % width, 60)))
+
+
+def split_into_bins(services: List[Service], width: int = BIN_WIDTH
 ) -> Dict[datetime.datetime, MayflyBin]:
-    """Organise Service objects into 30 minute bins.
+    """Organise Service objects into bins.
 
     :param services: A list of Service objects.
+    :param width: The width of each bin in minutes. Bins are aligned to
+        midnight, so this must divide a day.
 
     :returns: A dictionary with bin label (start datetime of the bin) as key and
               a MayflyBin object as data.
     """
     retval: Dict[datetime.datetime, MayflyBin] = {}
     for service in services:
-        if service.dt.minute < 30:
-            bin_id = service.dt.replace(minute=0)
-        else:
-            bin_id = service.dt.replace(minute=30)
+        bin_id = _bin_start(service.dt, width)
         if bin_id not in retval:
             retval[bin_id] = MayflyBin([], [])
         if service.type_ == "A":
@@ -169,6 +968,199 @@ def split_into_bins(services: List[Service]
     return retval
 
 
+class BinRollup:
+    """Arrivals and departures indexed by minute for range queries.
+
+    The arrivals and departures are each held in time order alongside a
+    cumulative count of them at every minute of the range covered. The
+    number of services in any range, and the services themselves, can then
+    be found with two lookups rather than a scan. This allows bins of any
+    width, and heat over windows other than a single bin, to be produced
+    from one pass over the services, so one rollup built on each refresh
+    can be shared by the page and the feed.
+
+    :param services: The services. Those outside the range covered are
+        ignored.
+    :param start: The start of the range covered, or None to start at
+        midnight before the earliest service.
+    :param end: The end of the range covered, or None to end just after the
+        latest service.
+    """
+
+    def __init__(self, services: Iterable[Service],
+                 start: Optional[datetime.datetime] = None,
+                 end: Optional[datetime.datetime] = None) -> None:
+        services = list(services)
+        if start is None:
+            start = (_bin_start(min(X.dt for X in services), 1440)
+                     if services else window_start())
+        if end is None:
+            end = (max(X.dt for X in services) + _MINUTE
+                   if services else start)
+        self.start = start
+        self.end = end
+        self._span = max((end - start) // _MINUTE, 0)
+        by_type: Dict[str, List[Service]] = {"A": [], "D": []}
+        for s in services:
+            if start <= s.dt < end and s.type_ in by_type:
+                by_type[s.type_].append(s)
+        #for a rollup of a table, the rows of each type, and the services
+        #with None for the rows that have not yet been converted
+        self._table = ServiceTable()
+        self._rows: Dict[str, List[int]] = {}
+        self._services: Dict[str, List[Optional[Service]]] = {}
+        self._index: Dict[str, array.array] = {}
+        for type_, type_services in by_type.items():
+            type_services.sort(key=lambda X: X.dt)
+            self._services[type_] = list(type_services)
+            self._index[type_] = self._make_index(
+                [(X.dt - start) // _MINUTE for X in type_services])
+
+    @classmethod
+    def from_table(cls, table: ServiceTable,
+                   start: Optional[datetime.datetime] = None,
+                   end: Optional[datetime.datetime] = None) -> "BinRollup":
+        """Build a rollup straight from the columns of a ServiceTable.
+
+        The index is counted from the table's minutes and types, and a
+        Service object is only created for a row when the bin it is in is
+        asked for, so rendering a page converts only the rows it shows.
+
+        :param table: The services.
+        :param start: As for BinRollup.
+        :param end: As for BinRollup.
+        """
+        if start is None:
+            start = (_bin_start(_EPOCH + table.minutes[0] * _MINUTE, 1440)
+                     if len(table) else window_start())
+        if end is None:
+            end = (_EPOCH + (table.minutes[-1] + 1) * _MINUTE
+                   if len(table) else start)
+        rollup = cls([], start, end)
+        rollup._table = table
+        base = _to_minutes(start)
+        first = bisect.bisect_left(table.minutes, base)
+        last = bisect.bisect_left(table.minutes, _to_minutes(end))
+        minutes, types = table.minutes, table.types
+        for type_ in ("A", "D"):
+            code = table._codes.get(type_)
+            rows = [R for R in range(first, last) if types[R] == code]
+            rollup._rows[type_] = rows
+            rollup._services[type_] = [None] * len(rows)
+            rollup._index[type_] = rollup._make_index(
+                [minutes[R] - base for R in rows])
+        return rollup
+
+    def _make_index(self, offsets: List[int]) -> array.array:
+        #offsets are the minutes of the services from the start of the range,
+        #in order; the nth entry of the index is the number of services
+        #before the nth minute, and is filled in runs between services
+        index = array.array("i")
+        for count, offset in enumerate(offsets):
+            if offset >= len(index):
+                index.extend(array.array("i", [count]) *
+                             (offset + 1 - len(index)))
+        index.extend(array.array("i", [len(offsets)]) *
+                     (self._span + 1 - len(index)))
+        return index
+
+    def _convert(self, type_: str, first: int, last: int) -> None:
+        #convert the rows of the table from the first up to the last
+        #position of a type that have not been converted before
+        services = self._services[type_]
+        if self._rows and None in services[first:last]:
+            rows = self._rows[type_]
+            missing = [X for X in range(first, last) if services[X] is None]
+            for n, s in zip(missing, self._table.to_services(
+                    [rows[X] for X in missing])):
+                services[n] = s
+
+    def _select(self, type_: str, first: int, last: int) -> List[Service]:
+        self._convert(type_, first, last)
+        return cast(List[Service], self._services[type_][first:last])
+
+    def _minutes(self, dt: datetime.datetime) -> int:
+        return min(max((dt - self.start) // _MINUTE, 0), self._span)
+
+    def counts(self, start: datetime.datetime, end: datetime.datetime
+    ) -> Tuple[int, int]:
+        """Count the arrivals and departures from start up to end.
+
+        :returns: A tuple of the number of arrivals and departures.
+        """
+        first, last = self._minutes(start), self._minutes(end)
+        arrivals, departures = self._index["A"], self._index["D"]
+        return (arrivals[last] - arrivals[first],
+                departures[last] - departures[first])
+
+    def services(self, start: datetime.datetime, end: datetime.datetime
+    ) -> MayflyBin:
+        """Find the arrivals and departures from start up to end."""
+        first, last = self._minutes(start), self._minutes(end)
+        return MayflyBin(*[
+            self._select(T, self._index[T][first], self._index[T][last])
+            for T in ("A", "D")])
+
+    def bins(self, start: Optional[datetime.datetime] = None,
+             count: Optional[int] = None,
+             width: int = BIN_WIDTH) -> Dict[datetime.datetime, MayflyBin]:
+        """Organise the services in a run of bins as split_into_bins does.
+
+        :param start: The start of the first bin, or None for the bin
+            containing the start of the range covered.
+        :param count: The number of bins, or None for as many as reach the
+            end of the range covered.
+        :param width: The width of each bin in minutes.
+
+        :returns: As for split_into_bins. Empty bins are left out.
+        """
+        if start is None:
+            start = _bin_start(self.start, width)
+        if count is None:
+            count = -(-(self.end - start) // datetime.timedelta(minutes=width))
+        retval: Dict[datetime.datetime, MayflyBin] = {}
+        step = datetime.timedelta(minutes=width)
+        #convert the rows of all the bins at once
+        first, last = self._minutes(start), self._minutes(start + count * step)
+        for type_, index in self._index.items():
+            self._convert(type_, index[first], index[last])
+        for c in range(count):
+            b = self.services(start + c * step, start + (c + 1) * step)
+            if b.arrivals or b.departures:
+                retval[start + c * step] = b
+        return retval
+
+    def heat_levels(self, start: datetime.datetime, count: int,
+                    heat_map_params: Tuple[float, float, float],
+                    width: int = BIN_WIDTH,
+                    heat_window: Optional[int] = None) -> List[int]:
+        """Calculate the warning level of each of a run of bins.
+
+        The heat of a bin is calculated over the heat_window minutes from the
+        start of the bin, e.g. the next 90 minutes. The counts are scaled to
+        a 30 minute window, so that the heat_map_params thresholds mean the
+        same whatever the window.
+
+        :param start: The start of the first bin.
+        :param count: The number of bins.
+        :param heat_map_params: As for build_bin.
+        :param width: The width of each bin in minutes.
+        :param heat_window: The length of the window in minutes, or None to
+            use the width of the bin.
+
+        :returns: A list of warning levels (0, 1 or 2), one per bin.
+        """
+        heat_window = heat_window or width
+        arrivals, departures = [], []
+        for c in range(count):
+            bin_start = start + datetime.timedelta(minutes=c * width)
+            a, d = self.counts(
+                bin_start, bin_start + datetime.timedelta(minutes=heat_window))
+            arrivals.append(a * 30 / heat_window)
+            departures.append(d * 30 / heat_window)
+        return heat_levels(arrivals, departures, heat_map_params)
+
+
 def _make_id(dt: datetime.datetime) -> str:
     return "id" + dt.strftime("%y%m%d%H%M")
 
@@ -220,7 +1212,8 @@ def build_service_list(services: List[Service]
 def build_bin(current_bin: datetime.datetime,
               data: Optional[MayflyBin],
               max_scale: int,
-              heat_map_params: Tuple[float, float, float]
+              heat_map_params: Tuple[float, float, float],
+              heat: Optional[int] = None
 ) -> str:
     """Produce an html table row from a MayflyBin.
 
@@ -238,6 +1231,8 @@ def build_bin(current_bin: datetime.datetime,
         are supposed to indicate that inbound delays are unlikely, between w1
         and w2 that moderate inbound delays are likely and above w2 that
         significant inbound delays are likely.
+    :param heat: The warning level of the bin, or None to calculate it from
+        data using heat_map_params.
 
     :returns: The html of a table row.
     """
@@ -258,25 +1253,243 @@ def build_bin(current_bin: datetime.datetime,
         t_dict["departures_width"] = "100%" if d > 100 else str(d) + "%"
         t_dict["arrivals_listing"] = build_service_list(data.arrivals)
         t_dict["departures_listing"] = build_service_list(data.departures)
-        x, w1, w2 = heat_map_params
-        h = x * len(data.arrivals) + (1 - x) * len(data.departures)
-        if h >= w1: t_dict["heat"] = "w1"
-        if h >= w2: t_dict["heat"] = "w2"
+        t_dict["heat"] = "w{}".format(_heat(data, heat_map_params))
+    if heat is not None:
+        t_dict["heat"] = "w{}".format(heat)
     return templates.bin_template.format(**t_dict)
 
 
+def _heat(data: MayflyBin, heat_map_params: Tuple[float, float, float]
+) -> int:
+    """The warning level (0, 1 or 2) of a bin. See build_bin."""
+    return heat_levels([len(data.arrivals)], [len(data.departures)],
+                       heat_map_params)[0]
+
+
+def window_start() -> datetime.datetime:
+    """The start of the first bin displayed, i.e. the start of the last hour."""
+    return (datetime.datetime.utcnow().replace(
+        minute=0, second=0, microsecond=0) -
+            datetime.timedelta(hours=1))
+
+
+#a digest of the templates used by build_bin, so that cached bins are not
+#used with templates they were not rendered with
+_BIN_TEMPLATES_DIGEST = hashlib.sha1("\0".join([
+    templates.bin_template, templates.service_list_template,
+    templates.ezy_service_template, templates.nonezy_service_template
+]).encode()).hexdigest()
+
+
+def _bin_cache_services(services: List[Service]) -> str:
+    #the fields of the services that are rendered, the time as the minute
+    #of the day since the bin gives the date
+    return ";".join([
+        f"{S.operator_id},{S.service_id},{S.dest_or_orig},"
+        f"{S.dt.hour * 60 + S.dt.minute},{S.delay}" for S in services])
+
+
+class BinCache:
+    """A bounded LRU cache of rendered bins, optionally persisted to a file.
+
+    The key for a bin is a digest of everything that affects its html: the bin
+    identifier, the rendered fields of its services, max_scale,
+    heat_map_params, heat, ezy_operator_ids and the templates themselves. A
+    bin whose services, times and delays have not changed is therefore served
+    from the cache. The key is built from plain strings and numbers, and the
+    templates are digested once at import, so that finding a bin in the
+    cache is much cheaper than rendering it.
+
+    :param filename: A file to load the cache from and save it to, or None
+        to keep the cache in memory only.
+    :param max_entries: The maximum number of bins to keep. When full, the
+        least recently used bin is discarded.
+    """
+
+    def __init__(self, filename: Optional[str] = None,
+                 max_entries: int = 2048) -> None:
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[str, str]" = (
+            collections.OrderedDict())
+        if filename:
+            try:
+                with open(filename) as f:
+                    self._entries.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def render(self,
+               current_bin: datetime.datetime,
+               data: Optional[MayflyBin],
+               max_scale: int,
+               heat_map_params: Tuple[float, float, float],
+               heat: Optional[int] = None
+    ) -> str:
+        """Return the html for a bin, rendering it with build_bin if needed.
+
+        The parameters are as for build_bin.
+        """
+        key = hashlib.sha1((
+            f"{_BIN_TEMPLATES_DIGEST}|{_to_minutes(current_bin)}|"
+            f"{max_scale}|{heat_map_params}|{heat}|{ezy_operator_ids}|" + (
+                _bin_cache_services(data.arrivals) + "|" +
+                _bin_cache_services(data.departures) if data else "")
+        ).encode()).hexdigest()
+        html = self._entries.get(key)
+        if html is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return html
+        self.misses += 1
+        html = build_bin(current_bin, data, max_scale, heat_map_params, heat)
+        self._entries[key] = html
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return html
+
+    def save(self) -> None:
+        """Save the cache to its file, if it has one."""
+        if not self.filename:
+            return
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_filename, self.filename)
+
+
+def update_stamp(updated: bool) -> str:
+    """The text describing when the page was last updated from AIMS."""
+    return (f"Updated from AIMS at {datetime.datetime.utcnow():%H:%Mz}"
+            if updated else "AIMS update not available")
+
+
+def page_digest(html_filename: str) -> str:
+    """Calculate a digest of a rendered page that ignores the update time.
+
+    Two pages with the same digest differ at most in the time shown in the
+    "Updated from AIMS at" stamp, so there is no need to publish the second
+    if the first has already been published.
+
+    :param html_filename: The filename of the uncompressed page.
+
+    :returns: The SHA256 digest of the page as a hex string.
+    """
+    with open(html_filename, "rb") as f:
+        html = f.read()
+    return hashlib.sha256(re.sub(
+        rb"Updated from AIMS at \d\d:\d\dz", b"Updated from AIMS",
+        html)).hexdigest()
+
+
+def _page_bins(start_bin: datetime.datetime, mayfly_window: int,
+               width: int = BIN_WIDTH
+) -> Iterator[datetime.datetime]:
+    """Iterate over the bin identifiers of a page."""
+    end_bin = start_bin + datetime.timedelta(hours=mayfly_window)
+    current_bin = start_bin
+    while current_bin < end_bin:
+        yield current_bin
+        current_bin = current_bin + datetime.timedelta(minutes=width)
+
+
+def _page_rollup(data: Union[BinRollup, Dict[datetime.datetime, MayflyBin]]
+) -> BinRollup:
+    """The rollup of a page's data, building it if data is a dictionary."""
+    if isinstance(data, BinRollup):
+        return data
+    return BinRollup(S for B in data.values()
+                     for S in B.arrivals + B.departures)
+
+
+def _make_lookup(data: Dict[datetime.datetime, MayflyBin],
+                 page_bins: List[datetime.datetime]
+) -> Dict[str, List[int]]:
+    """Map easyJet service numbers to the indices of the bins they are in.
+
+    Each index appears at most once per service number, in ascending order.
+    """
+    lookup: Dict[str, List[int]] = {}
+    for c, current_bin in enumerate(page_bins):
+        if current_bin in data:
+            for sid in [X.service_id for X in
+                        data[current_bin].arrivals +
+                        data[current_bin].departures
+                        if X.operator_id in ezy_operator_ids]:
+                if sid not in lookup: lookup[sid] = []
+                if not lookup[sid] or lookup[sid][-1] != c:
+                    lookup[sid].append(c)
+    return lookup
+
+
+def iter_page(
+        data: Union[BinRollup, Dict[datetime.datetime, MayflyBin]],
+        max_scale: int = 10,
+        heat_map_params: Tuple[float, float, float] = (0.6, 3.5, 4.74),
+        mayfly_window: int = MAYFLY_WINDOW,
+        updated:bool = False,
+        bin_cache: Optional[BinCache] = None,
+        title: str = "Bristol Mayfly",
+        bin_width: int = BIN_WIDTH,
+        heat_window: Optional[int] = HEAT_WINDOW
+) -> Iterator[str]:
+    """Render an html page from a dictionary of MayflyBin objects in chunks.
+
+    The parameters are as for build_page. Only the lookup table is built
+    before output starts; each bin is rendered and yielded in turn, so the
+    memory used does not grow with the size of the page.
+
+    :return: An iterator over chunks of the html page, in document order.
+    """
+    rollup = _page_rollup(data)
+    start_bin = _bin_start(window_start(), bin_width)
+    page_bins = list(_page_bins(start_bin, mayfly_window, bin_width))
+    bins = rollup.bins(start_bin, len(page_bins), bin_width)
+    heats = rollup.heat_levels(start_bin, len(page_bins), heat_map_params,
+                               bin_width, heat_window)
+    #Create a dictionary to serialize and insert as the 'lookup' javascript
+    #variable. Key is service number, value is a list of the ordinals of the
+    #bins in which flights with that service number may be found.
+    lookup = _make_lookup(bins, page_bins)
+    yield templates.page_start.format(
+        lookup=json.dumps(lookup, separators=(",", ":")),
+        updated=update_stamp(updated), title=title)
+    yield templates.table_start
+    for current_bin, heat in zip(page_bins, heats):
+        if current_bin == start_bin or (
+                current_bin.hour == 0 and current_bin.minute == 0):
+            yield templates.header.format(
+                    current_bin.strftime("%A %d %B"))
+        render = bin_cache.render if bin_cache is not None else build_bin
+        yield render(current_bin, bins.get(current_bin, None),
+                     max_scale, heat_map_params, heat)
+    yield "\n" + templates.table_end
+    yield templates.page_end
+
+
 def build_page(
-        data: Dict[datetime.datetime, MayflyBin],
+        data: Union[BinRollup, Dict[datetime.datetime, MayflyBin]],
         max_scale: int = 10,
         heat_map_params: Tuple[float, float, float] = (0.6, 3.5, 4.74),
-        mayfly_window: int = 48,
-        updated:bool = False
+        mayfly_window: int = MAYFLY_WINDOW,
+        updated:bool = False,
+        bin_cache: Optional[BinCache] = None,
+        title: str = "Bristol Mayfly",
+        bin_width: int = BIN_WIDTH,
+        heat_window: Optional[int] = HEAT_WINDOW
 ) -> str:
     """Create an html page from a dictionary of MayflyBin objects.
 
-    :param data: The dictionary containing the source data.  Keys are bin
-        identifiers in the form of datetime objects (the start time of the bin),
-        values are MayflyBin objects.
+    :param data: The source data, either a BinRollup of the services or a
+        dictionary as returned by split_into_bins. Keys are bin identifiers
+        in the form of datetime objects (the start time of the bin), values
+        are MayflyBin objects. A dictionary is rolled up before rendering,
+        so callers that also build the feed should pass a BinRollup.
     :param max_scale: The number of arrivals or departures that will cause the
         bar to be full width.  If the number of arrivals or depatures is greater
         than max_scale, the bar will be shown full width with but labelled with
@@ -287,62 +1500,494 @@ def build_page(
     :param mayfly_window: The number of hours worth of bins to output.
     :param updated: If True, indicates that the mayfly data has been updated
         with AIMS data.
+    :param bin_cache: If not None, a BinCache used to avoid re-rendering bins
+        that have not changed since they were last rendered.
+    :param title: The title of the page.
+    :param bin_width: The width of each bin in minutes. This must divide a
+        day.
+    :param heat_window: The number of minutes from the start of each bin
+        over which its heat is calculated, e.g. 90 to colour each bin by the
+        traffic over the next hour and a half. None calculates the heat of
+        each bin from its own services. Either way, the heat is scaled to a
+        30 minute rate; see BinRollup.heat_levels.
 
     :return: The html page.  This contains a table with the bins and a
              javascript variable, lookup, that can be used to quickly lookup in
-             which bins a particular flight number occurs.
+             which bins a particular flight number occurs. The bins are
+             identified by their ordinal, i.e. their position in the table.
+    """
+    return "".join(iter_page(data, max_scale, heat_map_params,
+                             mayfly_window, updated, bin_cache, title,
+                             bin_width, heat_window))
+
+
+class _TextWriter(Protocol):
+    """Anything with a write method accepting str, as write_page needs."""
+
+    def write(self, s: str) -> Any: ...
+
+
+def write_page(f: _TextWriter,
+               data: Union[BinRollup, Dict[datetime.datetime, MayflyBin]],
+               **kwargs: Any) -> None:
+    """Render an html page straight to a file-like object.
+
+    :param f: A text file-like object, e.g. an open file, a gzip stream
+        opened in text mode or an io.StringIO upload buffer.
+    :param data: As for build_page.
+    :param kwargs: Other parameters as for build_page.
+    """
+    for chunk in iter_page(data, **kwargs):
+        f.write(chunk)
+
+
+class _CompressingWriter:
+    """A text file-like object that writes plain and precompressed files.
+
+    Each chunk is encoded once and written to the plain file, a gzip file
+    and, if the brotli module is available, a brotli file.
     """
-    start_bin = (
-        datetime.datetime.utcnow().replace(
-            minute=0, second=0, microsecond=0) -
-        datetime.timedelta(hours=1))
-    end_bin = start_bin + datetime.timedelta(hours=mayfly_window)
-    bin_list = []
-    lookup: Dict[str, List[str]] = {}
-    current_bin = start_bin
-    while current_bin != end_bin:
-        if current_bin == start_bin or (
-                current_bin.hour == 0 and current_bin.minute == 0):
-            h = templates.header.format(
-                    current_bin.strftime("%A %d %B"))
-            bin_list.append(h)
-        bin_list.append(
-            build_bin(current_bin, data.get(current_bin, None),
-                      max_scale, heat_map_params))
-        #Create a dictionary to serialize and insert as the 'lookup' javascript
-        #variable. Key is service number, value is a list of bin identifiers in
-        #which flights with that service number may be found.
-        if current_bin in data:
-            for sid in [X.service_id for X in
-                        data[current_bin].arrivals +
-                        data[current_bin].departures
-                        if X.operator_id in ezy_operator_ids]:
-                if sid not in lookup: lookup[sid] = []
-                lookup[sid].append(_make_id(current_bin))
-        current_bin = current_bin + datetime.timedelta(minutes=30)
-    return (templates.page_template.format(
-        json.dumps(lookup),
-        (f"Updated from AIMS at {datetime.datetime.utcnow():%H:%Mz}"
-         if updated else "AIMS update not available"),
-        templates.table_template.format(
-            "".join(bin_list))))
-
-
-def main(csv_filename: str, html_filename: str) -> None:
-    with open(csv_filename) as f:
-        services = process_csv(f.readlines())
-        updated_services = update_services_from_AIMS(services)
-        updated = False
-        if updated_services:
-            services = updated_services
-            updated = True
-        bins = split_into_bins(services)
-        with open(html_filename, "w") as o:
-            o.write(build_page(bins, updated=updated))
+
+    def __init__(self, filename: str) -> None:
+        self.filenames: Dict[Optional[str], str] = {
+            None: filename, "gzip": filename + ".gz"}
+        self._plain = open(filename, "wb")
+        self._gzip = gzip.GzipFile(filename + ".gz", "wb", 9, mtime=0)
+        self._brotli = None
+        if brotli:
+            self.filenames["br"] = filename + ".br"
+            self._brotli_file = open(filename + ".br", "wb")
+            self._brotli = brotli.Compressor(mode=brotli.MODE_TEXT)
+
+    def write(self, chunk: str) -> None:
+        data = chunk.encode()
+        self._plain.write(data)
+        self._gzip.write(data)
+        if self._brotli:
+            self._brotli_file.write(self._brotli.process(data))
+
+    def close(self) -> None:
+        self._plain.close()
+        self._gzip.close()
+        if self._brotli:
+            self._brotli_file.write(self._brotli.finish())
+            self._brotli_file.close()
+
+
+def write_page_files(filename: str,
+                     data: Union[BinRollup,
+                                 Dict[datetime.datetime, MayflyBin]],
+                     **kwargs: Any) -> Dict[Optional[str], str]:
+    """Render an html page to a file and precompressed copies of it.
+
+    The page is rendered once, and the compressed copies are produced as it
+    is rendered. A gzip copy is always produced, with ".gz" appended to the
+    filename. A brotli copy, with ".br" appended, is produced if the brotli
+    module is installed.
+
+    :param filename: The filename of the uncompressed page.
+    :param data: As for build_page.
+    :param kwargs: Other parameters as for build_page.
+
+    :returns: A dictionary with the content encoding as key ("gzip", "br" or
+              None for uncompressed) and the filename as data.
+    """
+    writer = _CompressingWriter(filename)
+    try:
+        write_page(writer, data, **kwargs)
+    finally:
+        writer.close()
+    return writer.filenames
+
+
+def _feed_services(services: List[Service]) -> List[List[Any]]:
+    return [[s.dt.strftime("%H:%M"), s.operator_id, s.service_id,
+             s.dest_or_orig, s.delay]
+            for s in sorted(services, key=lambda x: x.dt)]
+
+
+def build_feed(
+        data: Union[BinRollup, Dict[datetime.datetime, MayflyBin]],
+        max_scale: int = 10,
+        heat_map_params: Tuple[float, float, float] = (0.6, 3.5, 4.74),
+        mayfly_window: int = MAYFLY_WINDOW,
+        updated: bool = False,
+        version: int = 0,
+        bin_width: int = BIN_WIDTH,
+        heat_window: Optional[int] = HEAT_WINDOW
+) -> Dict[str, Any]:
+    """Create the data feed rendered client side by mayfly.js.
+
+    The feed carries the same information as the page built by build_page,
+    but without any html, so it is much smaller. The service listings are
+    only expanded into html when a user opens them.
+
+    :param data: As for build_page.
+    :param max_scale: As for build_page.
+    :param heat_map_params: As for build_page.
+    :param mayfly_window: As for build_page.
+    :param updated: As for build_page.
+    :param version: The version of the feed. Each feed published should have
+        a higher version than the last, so that clients can tell whether a
+        delta (see build_delta) applies to the feed they have.
+    :param bin_width: As for build_page.
+    :param heat_window: As for build_page.
+
+    :returns: A JSON serializable dictionary with the following keys:
+
+        * "version": The version parameter.
+
+        * "updated": The update stamp, as shown on the page.
+
+        * "start": The start of the first bin, as an ISO 8601 UTC time.
+
+        * "bin_minutes": The width of each bin in minutes.
+
+        * "max_scale": The max_scale parameter.
+
+        * "ezy": The operator ids that are shown as easyJet services.
+
+        * "bins": A list with an entry for each bin, in time order. Each
+          entry is [warning level, arrivals, departures], where arrivals and
+          departures are lists of [time, operator_id, service_id,
+          dest_or_orig, delay] in time order. The delay is null if unknown.
+
+        * "lookup": A mapping from easyJet service number to a list of the
+          indices of the bins in which it is found.
+    """
+    rollup = _page_rollup(data)
+    start_bin = _bin_start(window_start(), bin_width)
+    page_bins = list(_page_bins(start_bin, mayfly_window, bin_width))
+    page_data = rollup.bins(start_bin, len(page_bins), bin_width)
+    heats = rollup.heat_levels(start_bin, len(page_bins), heat_map_params,
+                               bin_width, heat_window)
+    bins: List[List[Any]] = []
+    for current_bin, heat in zip(page_bins, heats):
+        b = page_data.get(current_bin)
+        if b:
+            bins.append([heat, _feed_services(b.arrivals),
+                         _feed_services(b.departures)])
+        else:
+            bins.append([heat, [], []])
+    return {
+        "version": version,
+        "updated": update_stamp(updated),
+        "start": f"{start_bin:%Y-%m-%dT%H:%MZ}",
+        "bin_minutes": bin_width,
+        "max_scale": max_scale,
+        "ezy": ezy_operator_ids,
+        "bins": bins,
+        "lookup": _make_lookup(page_data, page_bins),
+    }
+
+
+def _feed_keys(feed: Dict[str, Any]
+) -> Optional[Dict[str, Tuple[int, int, List[Any]]]]:
+    """Map the key of each service in a feed to its position and record.
+
+    The key is the movement type, operator, service number and UTC date,
+    e.g. "AEZY610@2020-01-30". The position is (bin index, 1 for arrivals or
+    2 for departures). None is returned if any key is not unique.
+    """
+    start = datetime.datetime.strptime(feed["start"], "%Y-%m-%dT%H:%MZ")
+    width = datetime.timedelta(minutes=feed["bin_minutes"])
+    keys: Dict[str, Tuple[int, int, List[Any]]] = {}
+    for c, b in enumerate(feed["bins"]):
+        date = (start + c * width).strftime("%Y-%m-%d")
+        for type_ in (1, 2):
+            for rec in b[type_]:
+                key = f"{'AD'[type_ - 1]}{rec[1]}{rec[2]}@{date}"
+                if key in keys:
+                    return None
+                keys[key] = (c, type_, rec)
+    return keys
+
+
+def build_delta(old_feed: Optional[Dict[str, Any]], new_feed: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Describe the changes between two versions of the data feed.
+
+    A client holding old_feed can apply the delta to reach new_feed, so it
+    only needs to fetch the services that have changed rather than the
+    whole feed.
+
+    :param old_feed: The feed the client has, as returned by build_feed.
+    :param new_feed: The new feed.
+
+    :returns: None if the delta cannot be expressed, in which case clients
+        must fetch the full feed. Otherwise a JSON serializable dictionary with
+        the following keys:
+
+        * "version", "start", "updated": As for new_feed.
+
+        * "base": The version of old_feed.
+
+        * "shift": The number of bins to drop from the start of the old feed.
+          The same number of empty bins are added at the end.
+
+        * "changed": A list of [bin index, type, *service] for services that
+          are new or whose time or delay has changed, where the bin index is
+          that in the new feed, type is 1 for arrivals or 2 for departures
+          and service is as for the services in a feed.
+
+        * "removed": A list of the keys of services that have been cancelled
+          or are otherwise no longer present. See _feed_keys.
+
+        * "heat": A list of [bin index, warning level] for bins whose warning
+          level has changed.
+    """
+    if (old_feed is None or
+            any(old_feed[X] != new_feed[X]
+                for X in ("bin_minutes", "max_scale", "ezy")) or
+            len(old_feed["bins"]) != len(new_feed["bins"])):
+        return None
+    width = datetime.timedelta(minutes=new_feed["bin_minutes"])
+    shift, rem = divmod(
+        datetime.datetime.strptime(new_feed["start"], "%Y-%m-%dT%H:%MZ") -
+        datetime.datetime.strptime(old_feed["start"], "%Y-%m-%dT%H:%MZ"),
+        width)
+    old_keys, new_keys = _feed_keys(old_feed), _feed_keys(new_feed)
+    if shift < 0 or rem or old_keys is None or new_keys is None:
+        return None
+    changed: List[List[Any]] = []
+    for key, (c, type_, rec) in new_keys.items():
+        old = old_keys.get(key)
+        if old is None or old[0] - shift != c or old[2] != rec:
+            changed.append([c, type_] + rec)
+    removed = [K for K, (c, _, _) in old_keys.items()
+               if K not in new_keys and c >= shift]
+    count = len(new_feed["bins"])
+    heat = [[c, new_feed["bins"][c][0]] for c in range(count)
+            if new_feed["bins"][c][0] !=
+            (old_feed["bins"][c + shift][0] if c + shift < count else 0)]
+    return {
+        "version": new_feed["version"],
+        "base": old_feed["version"],
+        "start": new_feed["start"],
+        "updated": new_feed["updated"],
+        "shift": shift,
+        "changed": changed,
+        "removed": removed,
+        "heat": heat,
+    }
+
+
+def write_json_files(filename: str, obj: Any) -> Dict[Optional[str], str]:
+    """Write a JSON document, such as the data feed, and precompressed copies.
+
+    :param filename: The filename of the uncompressed document.
+    :param obj: The JSON serializable object to write.
+
+    :returns: As for write_page_files.
+    """
+    writer = _CompressingWriter(filename)
+    try:
+        writer.write(json.dumps(obj, separators=(",", ":")))
+    finally:
+        writer.close()
+    return writer.filenames
+
+
+def build_shell(feed_url: str = "mayfly.json",
+                delta_url: str = "mayfly-delta.json",
+                title: str = "Bristol Mayfly") -> str:
+    """Create the static page that mayfly.js renders the data feed into.
+
+    :param feed_url: The url of the data feed, relative to the page.
+    :param delta_url: The url of the latest delta (see build_delta), which
+        is polled for changes, relative to the page.
+    :param title: The title of the page.
+
+    :returns: The html page.
+    """
+    return (templates.page_start.format(
+                lookup="null", updated="Loading\u2026", title=title) +
+            templates.feed_table.format(feed_url, delta_url) +
+            templates.page_end)
+
+
+class BatchJob(NamedTuple):
+    """An airport to be refreshed.
+
+    :var airport: The three letter code of the airport, e.g. "BRS".
+    :var csv_filename: The Mayfly csv file with the airport's schedule.
+    :var html_filename: The file to write the airport's page to.
+    :var feed_filename: The file to write the airport's data feed to, or None
+        to not write a data feed.
+    :var timezone: The timezone of the local times in the csv file, e.g.
+        "Europe/London".
+    """
+    airport: str
+    csv_filename: str
+    html_filename: str
+    feed_filename: Optional[str] = None
+    timezone: str = DEFAULT_TIMEZONE
+
+
+def page_title(airport: str) -> str:
+    """The title of the page for an airport."""
+    return f"{AIRPORT_NAMES.get(airport, airport)} Mayfly"
+
+
+def _cache_filename(name: str, airport: str) -> Optional[str]:
+    if not CACHE_DIR:
+        return None
+    if airport != "BRS":
+        name = f"{airport.lower()}_{name}"
+    return os.path.join(CACHE_DIR, name)
+
+
+def _load_job(job: BatchJob) -> ServiceTable:
+    start = window_start()
+    with metrics.stage("csv_parse", airport=job.airport):
+        return load_service_table(
+            job.csv_filename, start,
+            start + datetime.timedelta(hours=MAYFLY_WINDOW),
+            _cache_filename("schedule.cache", job.airport), job.timezone)
+
+
+def _render_job(job: BatchJob, table: ServiceTable, updated: bool
+) -> None:
+    with metrics.stage("binning", airport=job.airport):
+        rollup = BinRollup.from_table(table)
+    with metrics.stage("rendering", airport=job.airport):
+        bin_cache_filename = _cache_filename("bins.cache", job.airport)
+        bin_cache = BinCache(bin_cache_filename) if bin_cache_filename else None
+        with open(job.html_filename, "w") as o:
+            write_page(o, rollup, updated=updated, bin_cache=bin_cache,
+                       title=page_title(job.airport))
+        if bin_cache is not None: bin_cache.save()
+        if job.feed_filename:
+            with open(job.feed_filename, "w") as o:
+                json.dump(build_feed(rollup, updated=updated,
+                                     version=int(time.time())),
+                          o, separators=(",", ":"))
+
+
+def _run_job(job: BatchJob, flights: Optional[List[flight_info.Flight]]
+) -> List[metrics.StageRecord]:
+    """Refresh one airport's page in a worker process.
+
+    :param job: The airport to refresh.
+    :param flights: The flights retrieved from AIMS for the airport, or None
+        if AIMS could not be reached.
+
+    :returns: The measurements made, to be recorded by the parent process.
+    """
+    table = _load_job(job)
+    if flights is not None:
+        table = apply_AIMS_updates_table(table, flights, job.airport)
+    _render_job(job, table, flights is not None)
+    return metrics.pop_records()
+
+
+def batch(jobs: List[BatchJob], processes: Optional[int] = None) -> None:
+    """Refresh the pages of several airports.
+
+    The AIMS pages for all the airports are retrieved concurrently over one
+    session, then each airport's schedule is loaded and its page rendered in
+    a separate worker process.
+
+    :param jobs: The airports to refresh.
+    :param processes: The maximum number of worker processes, or None for
+        one per CPU.
+    """
+    flights: Dict[str, List[flight_info.Flight]] = {}
+    try:
+        with metrics.stage("aims_fetch"):
+            flights = flight_info.get_AIMS_flights_multi(
+                os.getenv("AIMSPASSWORD") or getpass.getpass(),
+                [X.airport for X in jobs], datetime.date.today(), 2)
+    except Exception as err:
+        #as for update_services_from_AIMS, pages are still produced if AIMS
+        #is not available
+        print(err, file=sys.stderr)
+    record_history(flights)
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_run_job, X, flights.get(X.airport))
+                   for X in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                for r in future.result():
+                    metrics.record(r.stage, r.duration, r.allocated,
+                                   **r.properties)
+            except Exception as err:
+                print(f"{job.airport}: {err}", file=sys.stderr)
+    metrics.flush(sys.stderr)
+
+
+def main(csv_filename: str, html_filename: str,
+         feed_filename: Optional[str] = None) -> None:
+    job = BatchJob("BRS", csv_filename, html_filename, feed_filename)
+    table = _load_job(job)
+    updated_table = update_table_from_AIMS(table)
+    updated = False
+    if updated_table:
+        table = updated_table
+        updated = True
+    _render_job(job, table, updated)
+    metrics.flush(sys.stderr)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        main(sys.argv[1], sys.argv[2])
-    else:
-        print("usage:", sys.argv[0], "csv_file html_file")
+    parser = argparse.ArgumentParser(
+        description="Build the Mayfly page from a Mayfly csv file.")
+    parser.add_argument("csv_file", nargs="?")
+    parser.add_argument("html_file", nargs="?")
+    parser.add_argument("--feed", metavar="JSON_FILE",
+                        help="also write the data feed to JSON_FILE")
+    parser.add_argument("--shell", metavar="HTML_FILE",
+                        help="also write the static page that renders the "
+                        "data feed to HTML_FILE")
+    parser.add_argument("--batch", nargs=3, action="append",
+                        metavar=("AIRPORT", "CSV_FILE", "HTML_FILE"),
+                        help="build the page for AIRPORT from CSV_FILE; may "
+                        "be repeated to build several airports' pages in "
+                        "parallel, instead of csv_file and html_file")
+    parser.add_argument("--timezone", nargs=2, action="append", default=[],
+                        metavar=("AIRPORT", "ZONE"),
+                        help="the timezone of the local times in the csv file "
+                        "for a --batch AIRPORT, e.g. Europe/Amsterdam "
+                        f"(default: {DEFAULT_TIMEZONE})")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="run under cProfile and tracemalloc, writing a "
+                        "report to stderr and PREFIX.txt and the profile to "
+                        "PREFIX.pstats")
+    parser.add_argument("--record-aims", metavar="DIR",
+                        help="save the AIMS pages retrieved to DIR")
+    parser.add_argument("--replay-aims", metavar="DIR",
+                        help="use AIMS pages saved by --record-aims from DIR "
+                        "instead of connecting to AIMS")
+    args = parser.parse_args()
+    if args.batch and (args.csv_file or args.feed or args.profile):
+        parser.error("--batch cannot be used with csv_file, --feed or "
+                     "--profile")
+    if not args.batch and not args.html_file:
+        parser.error("csv_file and html_file are required")
+    if args.record_aims and args.replay_aims:
+        parser.error("--record-aims cannot be used with --replay-aims")
+    timezones = {A.upper(): Z for A, Z in args.timezone}
+    for airport, zone in timezones.items():
+        if airport not in [A.upper() for A, _, _ in args.batch or []]:
+            parser.error(f"--timezone given for {airport}, which is not a "
+                         "--batch airport")
+        if zone not in pytz.all_timezones_set:
+            parser.error(f"unknown timezone {zone}")
+    if args.shell:
+        with open(args.shell, "w") as o:
+            o.write(build_shell(os.path.basename(args.feed or "mayfly.json")))
+    with contextlib.ExitStack() as stack:
+        if args.record_aims:
+            stack.enter_context(profiling.record_aims(args.record_aims))
+        if args.replay_aims:
+            stack.enter_context(profiling.replay_aims(args.replay_aims))
+        if args.batch:
+            batch([BatchJob(A.upper(), C, H, timezone=timezones.get(
+                       A.upper(), DEFAULT_TIMEZONE))
+                   for A, C, H in args.batch])
+        elif args.profile:
+            profiling.profile(
+                lambda: main(args.csv_file, args.html_file, args.feed),
+                args.profile)
+        else:
+            main(args.csv_file, args.html_file, args.feed)
@@ -0,0 +1,173 @@
+"""Per-stage timing and memory instrumentation.
+
+Stages of a refresh are timed with the stage context manager (or recorded
+directly with record) and emitted by flush as JSON lines in CloudWatch
+Embedded Metric Format, so that the Lambda logs can be turned into metrics
+without any further processing.
+
+If the MAYFLY_TRACE_MEMORY environment variable is set, tracemalloc is used
+to record the peak memory allocated during each stage. Stages that run
+concurrently (e.g. page fetches) share tracemalloc's peak, so their figures
+are only indicative.
+"""
+
+import sys
+import os
+import time
+import json
+import threading
+import tracemalloc
+import contextlib
+import itertools
+import resource
+from typing import NamedTuple, Optional, List, Dict, Any, Iterator, TextIO
+
+
+NAMESPACE = os.getenv("MAYFLY_METRICS_NAMESPACE") or "Mayfly"
+TRACE_MEMORY = bool(os.getenv("MAYFLY_TRACE_MEMORY"))
+
+
+class StageRecord(NamedTuple):
+    """The measurements for one run of a stage.
+
+    :var stage: The name of the stage, e.g. "csv_parse".
+    :var duration: The duration of the stage in milliseconds.
+    :var allocated: The peak memory allocated during the stage in bytes, or
+        None if memory is not being traced.
+    :var properties: Additional information about the stage, e.g. the page
+        fetched. These are included in the log line but are not dimensions.
+    """
+    stage: str
+    duration: float
+    allocated: Optional[int]
+    properties: Dict[str, Any]
+
+
+_records: List[StageRecord] = []
+_lock = threading.Lock()
+#The peak traced memory of each open stage, keyed by a serial number.
+#tracemalloc has only one peak, so it is folded into these before each reset.
+_open_peaks: Dict[int, int] = {}
+_stage_serial = itertools.count()
+_peak_lock = threading.Lock()
+
+
+def record(stage_name: str, duration: float,
+           allocated: Optional[int] = None, **properties: Any) -> None:
+    """Record a measurement for a stage.
+
+    :param stage_name: The name of the stage.
+    :param duration: The duration in milliseconds.
+    :param allocated: The peak memory allocated in bytes, if known.
+    :param properties: Additional information about the stage.
+    """
+    with _lock:
+        _records.append(
+            StageRecord(stage_name, duration, allocated, properties))
+
+
+def _fold_peak() -> int:
+    """Fold tracemalloc's peak into the peaks of the open stages and reset it.
+
+    Must be called with _peak_lock held.
+
+    :returns: The memory currently traced.
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    for serial, open_peak in _open_peaks.items():
+        _open_peaks[serial] = max(open_peak, peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+@contextlib.contextmanager
+def stage(stage_name: str, **properties: Any) -> Iterator[None]:
+    """Time the enclosed block and record it as a stage.
+
+    The stage is recorded even if the block raises an exception. Stages may
+    be nested, each recording the peak memory allocated while it was open.
+
+    :param stage_name: The name of the stage.
+    :param properties: Additional information about the stage.
+    """
+    if TRACE_MEMORY:
+        with _peak_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            base = _fold_peak()
+            serial = next(_stage_serial)
+            _open_peaks[serial] = base
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = (time.perf_counter() - start) * 1000
+        allocated = None
+        if TRACE_MEMORY:
+            with _peak_lock:
+                _fold_peak()
+                allocated = max(0, _open_peaks.pop(serial) - base)
+        record(stage_name, duration, allocated, **properties)
+
+
+def records() -> List[StageRecord]:
+    """Return a copy of the measurements recorded since the last flush."""
+    with _lock:
+        return list(_records)
+
+
+def pop_records() -> List[StageRecord]:
+    """Remove and return the measurements recorded since the last flush.
+
+    This allows measurements made in a worker process to be passed back and
+    recorded in the parent process.
+    """
+    with _lock:
+        current = list(_records)
+        _records.clear()
+    return current
+
+
+def _emf(r: StageRecord, timestamp: int) -> Dict[str, Any]:
+    metrics = [{"Name": "Duration", "Unit": "Milliseconds"}]
+    line: Dict[str, Any] = dict(r.properties)
+    line.update({"Stage": r.stage, "Duration": round(r.duration, 3)})
+    if r.allocated is not None:
+        metrics.append({"Name": "Allocated", "Unit": "Bytes"})
+        line["Allocated"] = r.allocated
+    line["_aws"] = {
+        "Timestamp": timestamp,
+        "CloudWatchMetrics": [{
+            "Namespace": NAMESPACE,
+            "Dimensions": [["Stage"]],
+            "Metrics": metrics,
+        }],
+    }
+    return line
+
+
+def flush(out: Optional[TextIO] = None) -> None:
+    """Write the recorded measurements as EMF JSON lines, then clear them.
+
+    A final line records the maximum resident set size of the process.
+
+    :param out: The stream to write to, by default sys.stdout at the time of
+        the call.
+    """
+    out = out or sys.stdout
+    current = pop_records()
+    timestamp = int(time.time() * 1000)
+    for r in current:
+        print(json.dumps(_emf(r, timestamp)), file=out)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({
+        "MaxRSS": max_rss,
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [[]],
+                "Metrics": [{"Name": "MaxRSS", "Unit": "Bytes"}],
+            }],
+        }}), file=out)
+    out.flush()
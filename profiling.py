@@ -0,0 +1,172 @@
+"""Profiling of a Mayfly refresh.
+
+profile runs a function under cProfile and tracemalloc and reports the
+functions that took the most time and the lines that allocated the most
+memory. The AIMS pages are fetched and parsed in worker threads. Before
+Python 3.12, cProfile only sees the thread that enabled it, so each thread
+is given its own profiler and the results are merged.
+
+So that a slow refresh can be profiled repeatedly, and without access to
+AIMS, the AIMS pages retrieved by a run can be recorded to a directory with
+record_aims, then replayed from it with replay_aims. Pages are stored by day
+relative to the day they were recorded on, so a replayed page gives the same
+times of day on the day that it is replayed.
+"""
+
+import sys
+import os
+import io
+import datetime
+import getpass
+import threading
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+from typing import Callable, Iterator, List, TypeVar, Optional, Any
+
+import aims
+
+
+TOP = int(os.getenv("MAYFLY_PROFILE_TOP") or 25)
+#From Python 3.12, cProfile uses sys.monitoring, which sees every thread but
+#allows only one profiler to be active at a time
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+T = TypeVar("T")
+
+
+def _fixture_filename(directory: str, d: datetime.date, type_: str,
+                      airport: str) -> str:
+    offset = (d - datetime.date.today()).days
+    return os.path.join(directory, f"{airport.upper()}-{type_}-{offset}.html")
+
+
+@contextlib.contextmanager
+def record_aims(directory: str) -> Iterator[None]:
+    """Save the AIMS pages retrieved within the block to directory.
+
+    :param directory: The directory to save the pages to. It is created if
+        it does not exist.
+    """
+    os.makedirs(directory, exist_ok=True)
+    original = aims.flight_info_stream
+    def recording(d: datetime.date, type_: str,
+                  consumer: Callable[[Iterator[str]], T],
+                  airport: str = "brs", timeout: Optional[float] = None
+    ) -> T:
+        def tee(chunks: Iterator[str]) -> Iterator[str]:
+            with open(_fixture_filename(directory, d, type_, airport),
+                      "w") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+        return original(d, type_, lambda C: consumer(tee(C)), airport,
+                        timeout)
+    aims.flight_info_stream = recording
+    try:
+        yield
+    finally:
+        aims.flight_info_stream = original
+
+
+@contextlib.contextmanager
+def replay_aims(directory: str) -> Iterator[None]:
+    """Serve AIMS pages requested within the block from directory.
+
+    No connection is made to AIMS and no password is asked for. A page that
+    was not recorded raises FileNotFoundError, as a failed request would
+    raise an exception.
+
+    :param directory: A directory that pages were saved to by record_aims.
+    """
+    originals = aims.ensure_session, aims.flight_info_stream, getpass.getpass
+    def replay(d: datetime.date, type_: str,
+               consumer: Callable[[Iterator[str]], T],
+               airport: str = "brs", timeout: Optional[float] = None
+    ) -> T:
+        with open(_fixture_filename(directory, d, type_, airport)) as f:
+            html = f.read()
+        return consumer(html[C:C + aims.CHUNK_SIZE]
+                        for C in range(0, len(html), aims.CHUNK_SIZE))
+    aims.ensure_session = lambda username, password, deadline=None: None
+    aims.flight_info_stream = replay
+    getpass.getpass = lambda *args, **kwargs: ""
+    try:
+        yield
+    finally:
+        aims.ensure_session, aims.flight_info_stream, getpass.getpass = (
+            originals)
+
+
+def _report(stats: pstats.Stats, snapshot: tracemalloc.Snapshot, peak: int,
+            top: int) -> str:
+    out = io.StringIO()
+    stats.stream = out # type: ignore
+    stats.strip_dirs()
+    print(f"Top {top} functions by cumulative time", file=out)
+    stats.sort_stats("cumulative").print_stats(top)
+    print(f"Top {top} functions by internal time", file=out)
+    stats.sort_stats("tottime").print_stats(top)
+    print(f"Top {top} lines by memory allocated and still held at the end "
+          f"(peak traced memory {peak:,d} bytes)\n", file=out)
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ])
+    for stat in snapshot.statistics("lineno")[:top]:
+        print(stat, file=out)
+    return out.getvalue()
+
+
+def profile(func: Callable[[], T], prefix: str, top: int = TOP) -> T:
+    """Run a function under cProfile and tracemalloc.
+
+    The report is written to stderr and to prefix + ".txt". The merged
+    profile is dumped to prefix + ".pstats", which can be loaded with the
+    pstats module or by tools such as snakeviz or flameprof to produce a
+    flame graph.
+
+    Timings are inflated by the profiling, tracemalloc especially, so should
+    be compared with each other rather than with the metrics of an
+    unprofiled run.
+
+    :param func: The function to profile. It is called with no arguments.
+    :param prefix: The path and filename prefix for the output files.
+    :param top: The number of entries in each section of the report.
+
+    :returns: The value returned by func.
+    """
+    thread_profilers: List[cProfile.Profile] = []
+    def start_thread_profiler(*args: Any) -> None:
+        #enabling the profiler replaces this function in the new thread
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            #another profiler is already active, so give up on profiling
+            #threads rather than failing in each one
+            threading.setprofile(None) # type: ignore
+            sys.setprofile(None)
+            return
+        thread_profilers.append(profiler)
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    if not PROFILES_ALL_THREADS:
+        threading.setprofile(start_thread_profiler)
+    try:
+        return profiler.runcall(func)
+    finally:
+        threading.setprofile(None) # type: ignore
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = pstats.Stats(profiler)
+        for thread_profiler in thread_profilers:
+            stats.add(thread_profiler)
+        stats.dump_stats(prefix + ".pstats")
+        report = _report(stats, snapshot, peak, top)
+        with open(prefix + ".txt", "w") as f:
+            f.write(report)
+        print(report, file=sys.stderr)
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+"""Serve the Mayfly page from a long running process.
+
+The parsed schedule, the AIMS session and the rendered bins are kept in
+memory between refreshes, so a refresh only has to fetch from AIMS and
+re-render the bins that have changed. The page is served with an ETag and,
+where the client accepts it, gzip content encoding.
+
+AIMS is polled on an adaptive schedule: the interval is reset to
+MIN_INTERVAL whenever bins near the current time change, and doubles up to
+MAX_INTERVAL while they do not. If there are no services at all in the near
+term, e.g. overnight, MAX_INTERVAL is used.
+"""
+
+import sys
+import os
+import argparse
+import datetime
+import getpass
+import gzip
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import NamedTuple, Optional, Dict
+
+import mayfly
+import metrics
+
+
+HOST = os.getenv("MAYFLY_HOST") or "127.0.0.1"
+PORT = int(os.getenv("MAYFLY_PORT") or 8080)
+MIN_INTERVAL = float(os.getenv("MAYFLY_MIN_INTERVAL") or 60)
+MAX_INTERVAL = float(os.getenv("MAYFLY_MAX_INTERVAL") or 900)
+NEAR_TERM = datetime.timedelta(hours=3)
+
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = {
+    "/mayfly.css": "text/css",
+    "/mayfly.js": "application/javascript",
+    "/sw.js": "application/javascript",
+    "/ezyheader.gif": "image/gif",
+}
+
+
+class Page(NamedTuple):
+    """A rendered page.
+
+    :var html: The page, utf-8 encoded.
+    :var gzipped: The page, gzip compressed.
+    :var etag: The ETag of the uncompressed page. The ETag of the compressed
+        page has "-gzip" appended within the quotes.
+    """
+    html: bytes
+    gzipped: bytes
+    etag: str
+
+
+def _near_term(bins: Dict[datetime.datetime, mayfly.MayflyBin],
+               now: datetime.datetime
+) -> Dict[datetime.datetime, mayfly.MayflyBin]:
+    return {K: V for K, V in bins.items()
+            if now - datetime.timedelta(hours=1) <= K < now + NEAR_TERM}
+
+
+def next_interval(previous: float,
+                  old_bins: Optional[Dict[datetime.datetime, mayfly.MayflyBin]],
+                  new_bins: Dict[datetime.datetime, mayfly.MayflyBin],
+                  now: datetime.datetime
+) -> float:
+    """Decide how long to wait before polling AIMS again.
+
+    :param previous: The previous interval in seconds.
+    :param old_bins: The bins from the previous refresh, or None if there
+        was no previous refresh.
+    :param new_bins: The bins from this refresh.
+    :param now: The current time (UTC).
+
+    :returns: The interval in seconds.
+    """
+    near_term = _near_term(new_bins, now)
+    if not any(X.arrivals or X.departures for X in near_term.values()):
+        return MAX_INTERVAL
+    if old_bins is None or _near_term(old_bins, now) != near_term:
+        return MIN_INTERVAL
+    return min(previous * 2, MAX_INTERVAL)
+
+
+class Refresher:
+    """Keeps the page up to date.
+
+    :param csv_filename: The Mayfly csv file. It is re-read if its size or
+        modification time changes.
+    :param password: The AIMS password. This should be given, since a
+        refresh otherwise prompts for it, which would block the refresh
+        thread.
+    """
+
+    def __init__(self, csv_filename: str, password: Optional[str] = None
+    ) -> None:
+        self.csv_filename = csv_filename
+        self.password = password
+        self.page: Optional[Page] = None
+        self.interval = MIN_INTERVAL
+        self.bin_cache = mayfly.BinCache()
+        self._schedule = mayfly.ServiceTable()
+        self._csv_stat: Optional[os.stat_result] = None
+        self._bins: Optional[Dict[datetime.datetime, mayfly.MayflyBin]] = None
+
+    def _get_schedule(self) -> mayfly.ServiceTable:
+        stat = os.stat(self.csv_filename)
+        if (self._csv_stat is None or
+                (stat.st_size, stat.st_mtime_ns) !=
+                (self._csv_stat.st_size, self._csv_stat.st_mtime_ns)):
+            with metrics.stage("csv_parse"):
+                with open(self.csv_filename) as f:
+                    self._schedule = mayfly.process_csv_table(f)
+            self._csv_stat = stat
+        return self._schedule
+
+    def refresh(self) -> None:
+        """Refresh the page and set the interval until the next refresh."""
+        start = mayfly.window_start()
+        end = start + datetime.timedelta(hours=mayfly.MAYFLY_WINDOW)
+        margin = datetime.timedelta(days=1)
+        table = self._get_schedule().window(start - margin, end + margin)
+        updated_table = mayfly.update_table_from_AIMS(table, self.password)
+        updated = False
+        if updated_table:
+            table = updated_table
+            updated = True
+        with metrics.stage("binning"):
+            rollup = mayfly.BinRollup.from_table(table)
+            #only the bins shown are converted to Service objects
+            bins = rollup.bins(start, mayfly.MAYFLY_WINDOW * 60 //
+                               mayfly.BIN_WIDTH)
+        with metrics.stage("rendering"):
+            html = mayfly.build_page(
+                rollup, updated=updated, bin_cache=self.bin_cache).encode()
+            self.page = Page(html, gzip.compress(html, 9, mtime=0),
+                             hashlib.sha1(html).hexdigest())
+        if updated:
+            self.interval = next_interval(
+                self.interval, self._bins, bins, datetime.datetime.utcnow())
+            self._bins = bins
+        else:
+            self.interval = MIN_INTERVAL
+        metrics.flush(sys.stderr)
+
+    def run(self, stop: threading.Event) -> None:
+        """Refresh the page repeatedly until stop is set."""
+        while not stop.is_set():
+            try:
+                self.refresh()
+            except Exception as err:
+                print(err, file=sys.stderr)
+                self.interval = MIN_INTERVAL
+            print(f"Next refresh in {self.interval:.0f}s", file=sys.stderr)
+            stop.wait(self.interval)
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows a gzip response.
+
+    The header is a comma separated list of codings, each optionally with a
+    q-value, e.g. "gzip;q=0.5, br". gzip (or x-gzip) is acceptable if it is
+    listed with a non-zero q-value or, failing that, if "*" is. A malformed
+    q-value is taken as zero.
+    """
+    qvalues: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [X.strip() for X in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.lower()] = q
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return False
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    refresher: Refresher
+
+    def _send(self, body: bytes, content_type: str, etag: str,
+              encoding: Optional[str] = None) -> None:
+        if etag in [X.strip() for X in
+                    self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        path = self.path.split("?")[0]
+        if path in ("/", "/mayfly.html"):
+            page = self.refresher.page
+            if page is None:
+                self.send_error(503, "Page not yet available")
+            elif _accepts_gzip(self.headers.get("Accept-Encoding", "")):
+                self._send(page.gzipped, "text/html; charset=utf-8",
+                           f'"{page.etag}-gzip"', "gzip")
+            else:
+                self._send(page.html, "text/html; charset=utf-8",
+                           f'"{page.etag}"')
+        elif path in STATIC_FILES:
+            try:
+                with open(os.path.join(STATIC_DIR, path[1:]), "rb") as f:
+                    body = f.read()
+            except OSError:
+                self.send_error(404)
+                return
+            self._send(body, STATIC_FILES[path],
+                       f'"{hashlib.sha1(body).hexdigest()}"')
+        else:
+            self.send_error(404)
+
+
+def make_server(refresher: Refresher, host: str = HOST, port: int = PORT
+) -> ThreadingHTTPServer:
+    """Create an http server that serves the refresher's page."""
+    handler = type("Handler", (_Handler,), {"refresher": refresher})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("csv_file")
+    parser.add_argument("--host", default=HOST,
+                        help=f"address to listen on (default: {HOST})")
+    parser.add_argument("-p", "--port", type=int, default=PORT,
+                        help=f"port to listen on (default: {PORT})")
+    args = parser.parse_args()
+    #ask for the password once, up front, rather than at every refresh
+    refresher = Refresher(args.csv_file,
+                          os.getenv("AIMSPASSWORD") or getpass.getpass())
+    stop = threading.Event()
+    thread = threading.Thread(target=refresher.run, args=(stop,), daemon=True)
+    thread.start()
+    server = make_server(refresher, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
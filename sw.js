@@ -3,6 +3,7 @@
 var CACHE_NAME = "mayfly_static";
 var CACHE_FILES = [
     '/',
+    '/mayfly-app.html',
     '/mayfly.css',
     '/mayfly.js',
     '/ezyheader.gif',
@@ -23,25 +24,64 @@ function install_sw(event) {
 }
 
 
+function notify_clients(url) {
+    self.clients.matchAll().then(function(clients) {
+        clients.forEach(function(client) {
+            client.postMessage({type: "updated", url: url});
+        });
+    });
+}
+
+
+//Fetch a request from the network, conditional on the ETag of any cached
+//response, and update the cache. Clients are told if a cached response was
+//replaced by a newer one.
+function revalidate(cache, request, cached) {
+    var headers = new Headers();
+    var etag = cached ? cached.headers.get("ETag") : null;
+    if(etag) headers.set("If-None-Match", etag);
+    return self.fetch(request.url, {headers: headers, cache: "no-store"}).then(
+        function(response) {
+            if(response.status === 304) {
+                console.log(request.url + " not modified");
+                return cached;
+            }
+            if(!response.ok) return cached || response;
+            return cache.put(request, response.clone()).then(function() {
+                console.log("Cached " + request.url);
+                if(cached) notify_clients(request.url);
+                return response;
+            });
+        });
+}
+
+
+//Stale-while-revalidate: serve from the cache immediately if possible and
+//revalidate in the background, otherwise wait for the network.
 function do_fetch(event) {
+    if(event.request.method !== "GET" ||
+       new URL(event.request.url).origin !== self.location.origin) return;
     console.log("sw fetch event triggered");
     event.respondWith(
-        self.fetch(event.request, {cache: "no-store"}).then(
-            function(response) {
-                let rclone = response.clone();
-                self.caches.open(CACHE_NAME).then(
-                    function (cache) {
-                        console.log("Cached " + event.request.url);
-                        cache.put(event.request, rclone);
-                    });
-                return response;
-            }).catch(
-                function() {
-                    console.log("Serving " + event.request.url + " from cache");
-                    return self.caches.match(event.request);
-            })
+        self.caches.open(CACHE_NAME).then(function(cache) {
+            return cache.match(event.request).then(function(cached) {
+                var network = revalidate(cache, event.request, cached);
+                if(!cached) return network;
+                console.log("Serving " + event.request.url + " from cache");
+                event.waitUntil(network.catch(function(err) {
+                    console.log("Revalidation failed: " + err);
+                }));
+                return cached;
+            });
+        })
     );
 }
 
+
+function activate_sw(event) {
+    event.waitUntil(self.clients.claim());
+}
+
 self.addEventListener('install', install_sw);
+self.addEventListener('activate', activate_sw);
 self.addEventListener('fetch', do_fetch);
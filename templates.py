@@ -14,29 +14,31 @@ bin_template = """\
 </tr>
 """
 
-table_template = """\
+table_start = """\
 <table>
 <colgroup>
 <col style="width:3em;"/><col/>
 </colgroup>
-{}
+"""
+
+table_end = """\
 </table>
 """
 
-page_template = """\
+page_start = """\
 <!DOCTYPE html>
 <html lang="en" xmlns="http://www.w3.org/1999/xhtml">
 <head>
 <meta charset="utf-8" />
 <meta name="viewport" content="width=device-width, initial-scale=1"/>
-<title>Bristol Mayfly</title>
+<title>{title}</title>
 <link href="mayfly.css" rel="stylesheet"/>
-<script>var lookup = {};</script>
+<script>var lookup = {lookup};</script>
 <script src="mayfly.js"></script>
 </head>
 <body>
-<h1 id="title">Bristol Mayfly</h1>
-<p id="updated">{}</p>
+<h1 id="title">{title}</h1>
+<p id="updated">{updated}</p>
 <div id="mayfly_chart">
 <input type="text" id="services" placeholder="Enter flight numbers here"/>
 <div id="key"><table>
@@ -46,10 +48,16 @@ page_template = """\
 <tr><td class="bin_data"><p class="arr">Arrivals</p></td>
 <td class="bin_data"><p class="dep">Departures</p></td></tr>
 </table></div>
-{}
+"""
+
+page_end = """
 </div></body></html>
 """
 
+feed_table = """\
+<div id="feed_table" data-feed="{}" data-delta="{}"></div>
+"""
+
 service_list_template = """\
 <ul>{}</ul>
 """
@@ -2,9 +2,35 @@ import unittest
 import mayfly
 import datetime
 import flight_info
+import aims
 import os
+import threading
+import time
+import tempfile
+import pytz
+import asyncio
+import requests
+import sys
+import io
+import gzip
+import json
+import re
+import metrics
 import getpass
+import server
+import profiling
+import history
+import pstats
+import cProfile
+import tracemalloc
+import concurrent.futures
+import shutil
+import subprocess
 from mayfly import MayflyBin, Service
+try:
+    import moto
+except ImportError:
+    moto = None
 
 class TestMayfly(unittest.TestCase):
 
@@ -61,6 +87,146 @@ class TestMayfly(unittest.TestCase):
             result)
 
 
+    def test_csv_import_dst(self):
+        london_tz = pytz.timezone('Europe/London')
+        data, result = [], []
+        for day in ("28/03/2020", "29/03/2020", "30/03/2020",
+                    "24/10/2020", "25/10/2020", "26/10/2020"):
+            for hour in range(24):
+                for minute in (0, 30, 59):
+                    data.append("{},D,EZY,123,NCL,EGNT,NCL,EGNT,"
+                                "319,156,{:02d}{:02d},J,GB,"
+                                "04DEC2019 1403".format(day, hour, minute))
+                    dt = datetime.datetime.strptime(
+                        day + "{:02d}{:02d}".format(hour, minute),
+                        "%d/%m/%Y%H%M")
+                    result.append(mayfly.Service(
+                        type_='D',
+                        dt=london_tz.localize(dt).astimezone(
+                            pytz.utc).replace(tzinfo=None),
+                        operator_id='EZY',
+                        service_id='123',
+                        dest_or_orig='NCL'))
+        data.append("6/1/2020,A,TOM,6751,TFS,GCTS,TFS,GCTS,"
+                    "73H,189,0030,C,ES,04DEC2019 1403")
+        result.append(mayfly.Service(
+            type_='A', dt=datetime.datetime(2020, 1, 6, 0, 30),
+            operator_id='TOM', service_id='6751', dest_or_orig='TFS'))
+        self.assertEqual(mayfly.process_csv(data), result)
+
+
+    def test_read_csv_window(self):
+        row = ("{},A,EZY,{},NCL,EGNT,NCL,EGNT,"
+               "319,156,{},J,GB,04DEC2019 1403\n")
+        rows = [row.format("29/01/2020", "100", "2330"),
+                row.format("01/02/2020", "101", "0030"),
+                row.format("02/02/2020", "102", "0030"),
+                row.format("06/02/2020", "103", "1200"),
+                row.format("01/02/2020", "104", "2330"),
+                row.format("10/02/2020", "105", "1200")]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "mayfly.csv")
+            with open(filename, "w") as f:
+                f.write("".join(rows))
+            with open(filename, "rb") as f:
+                index = mayfly.index_csv(f)
+            self.assertEqual(index["01/02/2020"], [(72, 144), (288, 360)])
+            result = mayfly.read_csv_window(
+                filename,
+                datetime.datetime(2020, 2, 2, 0, 0),
+                datetime.datetime(2020, 2, 4, 0, 0))
+            self.assertEqual([X.service_id for X in result],
+                             ["101", "102", "104"])
+            self.assertEqual(result, mayfly.process_csv(
+                [rows[1], rows[2], rows[4]]))
+
+
+    def test_schedule_cache(self):
+        row = ("{},{},{},{},NCL,EGNT,NCL,EGNT,"
+               "319,156,{},J,GB,04DEC2019 1403\n")
+        rows = [row.format("02/02/2020", "D", "EZY", "102", "0030"),
+                row.format("01/02/2020", "A", "TOM", "101", "0030"),
+                row.format("03/02/2020", "A", "EZY", "103", "1200"),
+                row.format("01/02/2020", "D", "EZY", "104", "0030")]
+        services = mayfly.process_csv(rows)
+        ordered = [services[1], services[3], services[0], services[2]]
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_filename = os.path.join(tmp, "mayfly.csv")
+            cache_filename = os.path.join(tmp, "mayfly.cache")
+            with open(csv_filename, "w") as f:
+                f.write("".join(rows))
+            digest = mayfly.csv_digest(csv_filename)
+            self.assertIsNone(
+                mayfly.load_schedule_cache(cache_filename, digest))
+            mayfly.save_schedule_cache(cache_filename, digest, services)
+            self.assertEqual(
+                mayfly.load_schedule_cache(cache_filename, digest), ordered)
+            self.assertEqual(
+                mayfly.load_schedule_cache(
+                    cache_filename, digest,
+                    datetime.datetime(2020, 2, 1, 1, 0),
+                    datetime.datetime(2020, 2, 3, 12, 0)),
+                ordered[2:3])
+            self.assertIsNone(
+                mayfly.load_schedule_cache(cache_filename, b"x" * 20))
+            #stale cache is rebuilt
+            with open(csv_filename, "w") as f:
+                f.write("".join(rows[:3]))
+            start = datetime.datetime(2020, 2, 2, 0, 0)
+            end = datetime.datetime(2020, 2, 3, 0, 0)
+            self.assertEqual(
+                mayfly.load_services(csv_filename, start, end,
+                                     cache_filename),
+                [services[1], services[0], services[2]])
+            self.assertEqual(
+                mayfly.load_schedule_cache(
+                    cache_filename, mayfly.csv_digest(csv_filename)),
+                [services[1], services[0], services[2]])
+            #a schedule in another timezone, with or without the cache
+            start = datetime.datetime(2020, 2, 4, 0, 0)
+            end = datetime.datetime(2020, 2, 4, 12, 0)
+            amsterdam = [services[2]._replace(
+                dt=services[2].dt - datetime.timedelta(hours=1))]
+            for filename in (cache_filename, cache_filename, None):
+                self.assertEqual(
+                    mayfly.load_services(csv_filename, start, end, filename,
+                                         "Europe/Amsterdam"), amsterdam)
+            self.assertEqual(
+                mayfly.load_services(csv_filename, start, end,
+                                     cache_filename), [services[2]])
+
+
+    def test_service_table(self):
+        row = ("{},{},{},{},NCL,EGNT,NCL,EGNT,"
+               "319,156,{},J,GB,04DEC2019 1403\n")
+        rows = [row.format("02/02/2020", "D", "EZY", "102", "0030"),
+                row.format("01/02/2020", "A", "TOM", "101", "0030"),
+                row.format("29/03/2020", "A", "EZY", "103", "0230"),
+                row.format("1/2/2020", "D", "EZY", "104", "0015"),
+                row.format("01/07/2020", "A", "EZY", "105", "0020")]
+        expected = sorted(mayfly.process_csv(rows), key=lambda x: x.dt)
+        table = mayfly.process_csv_table(rows)
+        self.assertEqual(len(table), 5)
+        self.assertEqual(table.to_services(), expected)
+        self.assertEqual(
+            mayfly.ServiceTable.from_services(expected).to_services(),
+            expected)
+        self.assertEqual(
+            table.window(datetime.datetime(2020, 2, 1, 0, 20),
+                         datetime.datetime(2020, 3, 29, 1, 30)).to_services(),
+            expected[1:3])
+        delayed = [X._replace(delay=C - 2) for C, X in enumerate(expected)]
+        self.assertEqual(
+            mayfly.ServiceTable.from_services(delayed).to_services(),
+            delayed)
+        self.assertEqual(
+            mayfly.ServiceTable.from_services(delayed).to_services([3, 1]),
+            [delayed[3], delayed[1]])
+        self.assertEqual(
+            mayfly.heat_levels([0, 4, 5], [1, 4, 5], (0.6, 3.5, 4.74)),
+            [0, 1, 2])
+
+
     def test_csv_import_bad_format(self):
         data = ["06/01/2020,TOM,6751,TFS,GCTS,TFS,GCTS,"
                 "73H,189,0030,C,ES,04DEC2019 1403"]
@@ -132,6 +298,65 @@ class TestMayfly(unittest.TestCase):
         flight_info.get_AIMS_flights = old
 
 
+    def test_join_AIMS_updates(self):
+        def flight(num, sched_off, off, reg="G-EZBV"):
+            return flight_info.Flight(
+                operator='EZY', flight_num=num, from_='BRS', to='NCL',
+                type_='319', reg=reg, sched_off=sched_off,
+                sched_on=sched_off + datetime.timedelta(hours=1),
+                off=off, on=off + datetime.timedelta(hours=1))
+        def service(num, dt, delay=None):
+            return mayfly.Service(type_='D', dt=dt, operator_id='EZY',
+                                  service_id=num, dest_or_orig='NCL',
+                                  delay=delay)
+        d = datetime.datetime(2020, 1, 30)
+        h = lambda X: d + datetime.timedelta(hours=X)
+        flights = [
+            #retimed from 08:00 in the schedule
+            flight('570', h(8.5), h(9)),
+            #same flight number twice in a day
+            flight('572', h(18), h(18)),
+            flight('572', h(10), h(10.25)),
+            flight('574', h(12), h(12), reg="X-CANCEL"),
+            #not in the schedule
+            flight('576', h(14), h(14)),
+            #scheduled on a different day
+            flight('578', h(40), h(40)),
+        ]
+        services = [
+            service('570', h(8)),
+            service('572', h(10)),
+            service('572', h(17)),
+            service('574', h(12)),
+            service('578', h(16)),
+        ]
+        updated, stats = mayfly.join_AIMS_updates(services, flights)
+        self.assertEqual(updated, [
+            service('570', h(9), 30),
+            service('572', h(10.25), 15),
+            service('572', h(18), 0),
+            service('578', h(16)),
+        ])
+        self.assertEqual(stats, mayfly.JoinStats(
+            matched=4, retimed=2, cancelled=1, unmatched=1, unused=2))
+        self.assertEqual(mayfly.join_AIMS_updates([], []),
+                         ([], mayfly.JoinStats(0, 0, 0, 0, 0)))
+        #the join on a table's columns gives the same services in time order
+        table, table_stats = mayfly.join_AIMS_updates_table(
+            mayfly.ServiceTable.from_services(services), flights)
+        self.assertEqual(table.to_services(),
+                         sorted(updated, key=lambda X: X.dt))
+        self.assertEqual(table_stats, stats)
+        self.assertEqual(
+            mayfly.join_AIMS_updates_table(mayfly.ServiceTable(), flights)[1],
+            mayfly.JoinStats(0, 0, 0, 0, 6))
+        metrics.pop_records()
+        mayfly.apply_AIMS_updates(services, flights)
+        record = metrics.pop_records()[0]
+        self.assertEqual(record.stage, "update_join")
+        self.assertEqual(record.properties["retimed"], 2)
+
+
     def test_split_into_bins(self):
         data = [
             mayfly.Service(type_='D', dt=datetime.datetime(2020, 1, 30, 20, 50),
@@ -175,8 +400,131 @@ class TestMayfly(unittest.TestCase):
         self.assertEqual(mayfly.split_into_bins(data), result)
 
 
+    def test_bin_rollup(self):
+        start = datetime.datetime(2020, 1, 30, 6, 0)
+        services = []
+        for c, mins in enumerate((0, 5, 14, 15, 29, 31, 59, 60, 95, 179)):
+            services.append(Service(
+                type_="AD"[c % 2], dt=start + datetime.timedelta(minutes=mins),
+                operator_id='EZY', service_id=str(600 + c),
+                dest_or_orig='NCL'))
+        end = start + datetime.timedelta(hours=3)
+        rollup = mayfly.BinRollup(reversed(services), start, end)
+        self.assertEqual(rollup.counts(start, end), (5, 5))
+        self.assertEqual(
+            rollup.counts(start + datetime.timedelta(minutes=14),
+                          start + datetime.timedelta(minutes=60)), (3, 2))
+        #ranges beyond those covered are clipped
+        self.assertEqual(rollup.counts(start - datetime.timedelta(days=1),
+                                       start + datetime.timedelta(days=1)),
+                         (5, 5))
+        for width in (10, 15, 30, 60):
+            self.assertEqual(rollup.bins(start, 180 // width, width),
+                             mayfly.split_into_bins(services, width))
+            #by default, the range covers all the services
+            self.assertEqual(mayfly.BinRollup(services).bins(width=width),
+                             mayfly.split_into_bins(services, width))
+        self.assertEqual(mayfly.BinRollup([]).bins(), {})
+        self.assertEqual(
+            list(mayfly.split_into_bins(services, 60)),
+            [start + datetime.timedelta(hours=X) for X in range(3)])
+        with self.assertRaises(ValueError):
+            mayfly.split_into_bins(services, 7)
+        #a rollup of a table converts only the rows of the bins asked for
+        table = mayfly.ServiceTable.from_services(services)
+        table_rollup = mayfly.BinRollup.from_table(table, start, end)
+        converted = []
+        table.to_services = lambda rows: converted.extend(rows) or (
+            mayfly.ServiceTable.to_services(table, rows))
+        self.assertEqual(table_rollup.counts(start, end), (5, 5))
+        self.assertEqual(converted, [])
+        self.assertEqual(table_rollup.bins(start, 1, 30),
+                         rollup.bins(start, 1, 30))
+        self.assertEqual(sorted(converted), list(range(5)))
+        #and converts each row once
+        for width in (10, 15, 30, 60):
+            self.assertEqual(table_rollup.bins(start, 180 // width, width),
+                             rollup.bins(start, 180 // width, width))
+        self.assertEqual(len(converted), 10)
+        for width in (10, 15, 30, 60):
+            self.assertEqual(
+                mayfly.BinRollup.from_table(table).bins(width=width),
+                mayfly.split_into_bins(services, width))
+        self.assertEqual(
+            mayfly.BinRollup.from_table(mayfly.ServiceTable()).bins(), {})
+        #heat over the bin itself is the same as heat_levels
+        params = (0.5, 1.5, 2.5)
+        counts = [rollup.counts(start + datetime.timedelta(minutes=X),
+                                start + datetime.timedelta(minutes=X + 30))
+                  for X in range(0, 180, 30)]
+        self.assertEqual(rollup.heat_levels(start, 6, params),
+                         mayfly.heat_levels([X[0] for X in counts],
+                                            [X[1] for X in counts], params))
+        #heat over the next 60 minutes is scaled to a 30 minute rate
+        self.assertEqual(rollup.heat_levels(start, 6, params, 30, 60),
+                         [1, 0, 0, 0, 0, 0])
+
+
+    def test_batch(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        row = ("{:%d/%m/%Y},A,EZY,{},{},XXXX,{},XXXX,"
+               "319,156,1200,J,GB,04DEC2019 1403\n")
+        #the AMS schedule is in Amsterdam local time
+        sched_on = pytz.timezone("Europe/Amsterdam").localize(
+            datetime.datetime.combine(tomorrow, datetime.time(12, 0))
+        ).astimezone(pytz.utc).replace(tzinfo=None)
+        flight = flight_info.Flight(
+            operator='EZY', flight_num='402', from_='BRS', to='AMS',
+            type_='319', reg='G-EZBV',
+            sched_off=sched_on - datetime.timedelta(hours=1),
+            sched_on=sched_on,
+            off=sched_on - datetime.timedelta(minutes=40),
+            on=sched_on + datetime.timedelta(minutes=20))
+        requested = []
+        def get_AIMS_flights_multi(_1, airports, _2, _3):
+            requested.extend(airports)
+            return {"BRS": [], "AMS": [flight]}
+        old = flight_info.get_AIMS_flights_multi
+        flight_info.get_AIMS_flights_multi = get_AIMS_flights_multi
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                jobs = []
+                for airport, sid, other, timezone in (
+                        ("BRS", "401", "NCL", "Europe/London"),
+                        ("AMS", "402", "BRS", "Europe/Amsterdam")):
+                    csv_filename = os.path.join(tmp, airport + ".csv")
+                    with open(csv_filename, "w") as f:
+                        f.write(row.format(tomorrow, sid, other, other))
+                    jobs.append(mayfly.BatchJob(
+                        airport, csv_filename,
+                        os.path.join(tmp, airport + ".html"),
+                        timezone=timezone))
+                mayfly.batch(jobs, processes=2)
+                pages = {}
+                for job in jobs:
+                    with open(job.html_filename) as f:
+                        pages[job.airport] = f.read()
+        finally:
+            flight_info.get_AIMS_flights_multi = old
+        self.assertEqual(requested, ["BRS", "AMS"])
+        self.assertIn("<title>Bristol Mayfly</title>", pages["BRS"])
+        self.assertIn("EZY401 NCL", pages["BRS"])
+        self.assertIn("<title>AMS Mayfly</title>", pages["AMS"])
+        self.assertIn('EZY402 BRS</span>\n<span class="late">(+20)', pages["AMS"])
+
+
 class TestHTMLGeneration(unittest.TestCase):
 
+    def fix_window_start(self):
+        """Fix mayfly.window_start for the rest of the test, so that the
+        test cannot straddle the start of an hour."""
+        start = datetime.datetime(2020, 1, 30, 6, 0)
+        old_window_start = mayfly.window_start
+        mayfly.window_start = lambda: start
+        self.addCleanup(setattr, mayfly, "window_start", old_window_start)
+        return start
+
+
     def test_build_service_list(self):
         data = [
             Service(type_='D', dt=datetime.datetime(2020, 1, 30, 21, 30), operator_id='EZY', service_id='610', dest_or_orig='NCL', delay=None),
@@ -321,3 +669,859 @@ class TestHTMLGeneration(unittest.TestCase):
         self.assertEqual(result, expected_result)
         #restore patch
         mayfly.build_service_list = old_sl
+
+
+
+    def test_write_page(self):
+        start = self.fix_window_start()
+        data = mayfly.split_into_bins([
+            Service(type_='A', dt=start + datetime.timedelta(minutes=95),
+                    operator_id='EZY', service_id='610',
+                    dest_or_orig='NCL'),
+            Service(type_='D', dt=start + datetime.timedelta(hours=30),
+                    operator_id='TOM', service_id='620',
+                    dest_or_orig='NCL')])
+        page = mayfly.build_page(data)
+        self.assertTrue(page.startswith("<!DOCTYPE html>"))
+        self.assertTrue(page.endswith("</table>\n\n</div></body></html>\n"))
+        self.assertEqual(page.count('class="bin"'), 96)
+        self.assertIn('var lookup = {"610":[3]};', page)
+        chunks = list(mayfly.iter_page(data))
+        self.assertGreater(len(chunks), 96)
+        self.assertEqual("".join(chunks), page)
+        buf = io.BytesIO()
+        with gzip.open(buf, "wt") as f:
+            mayfly.write_page(f, data)
+        self.assertEqual(gzip.decompress(buf.getvalue()).decode(), page)
+
+
+    def test_write_page_files(self):
+        data = mayfly.split_into_bins([
+            Service(type_='A', dt=self.fix_window_start(), operator_id='EZY',
+                    service_id='610', dest_or_orig='NCL')])
+        page = mayfly.build_page(data)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "mayfly.html")
+            files = mayfly.write_page_files(filename, data)
+            self.assertEqual(files[None], filename)
+            with open(filename) as f:
+                self.assertEqual(f.read(), page)
+            with gzip.open(files["gzip"], "rt") as f:
+                self.assertEqual(f.read(), page)
+            self.assertLess(os.path.getsize(files["gzip"]), len(page) / 5)
+            if mayfly.brotli:
+                with open(files["br"], "rb") as f:
+                    self.assertEqual(
+                        mayfly.brotli.decompress(f.read()).decode(), page)
+
+
+    def test_build_feed(self):
+        start = self.fix_window_start()
+        data = mayfly.split_into_bins([
+            Service(type_='A', dt=start + datetime.timedelta(minutes=40),
+                    operator_id='TOM', service_id='621', dest_or_orig='NCL'),
+            Service(type_='A', dt=start + datetime.timedelta(minutes=35),
+                    operator_id='EZY', service_id='610', dest_or_orig='NCL',
+                    delay=5),
+            Service(type_='D', dt=start + datetime.timedelta(minutes=30),
+                    operator_id='EZY', service_id='611', dest_or_orig='NCL'),
+        ])
+        feed = mayfly.build_feed(data, heat_map_params=(0.5, 1.5, 6.0))
+        self.assertEqual(feed["start"], start.strftime("%Y-%m-%dT%H:%MZ"))
+        self.assertEqual(len(feed["bins"]), mayfly.MAYFLY_WINDOW * 2)
+        self.assertEqual(feed["bins"][0], [0, [], []])
+        time = lambda m: (start + datetime.timedelta(minutes=m)).strftime(
+            "%H:%M")
+        self.assertEqual(feed["bins"][1], [
+            1,
+            [[time(35), "EZY", "610", "NCL", 5],
+             [time(40), "TOM", "621", "NCL", None]],
+            [[time(30), "EZY", "611", "NCL", None]]])
+        self.assertEqual(feed["lookup"], {"610": [1], "611": [1]})
+        #the page lookup refers to the same bins
+        self.assertIn('var lookup = {"610":[1],"611":[1]};',
+                      mayfly.build_page(data))
+        with tempfile.TemporaryDirectory() as tmp:
+            files = mayfly.write_json_files(
+                os.path.join(tmp, "mayfly.json"), feed)
+            with gzip.open(files["gzip"], "rt") as f:
+                self.assertEqual(json.load(f), feed)
+        shell = mayfly.build_shell()
+        self.assertIn('data-feed="mayfly.json"', shell)
+        self.assertIn("var lookup = null;", shell)
+
+
+    def test_bin_width(self):
+        start = self.fix_window_start()
+        services = [
+            Service(type_='A', dt=start + datetime.timedelta(minutes=X),
+                    operator_id='EZY', service_id=str(600 + X),
+                    dest_or_orig='NCL')
+            for X in (50, 55, 65, 70)]
+        data = mayfly.BinRollup(services)
+        feed = mayfly.build_feed(data, heat_map_params=(1.0, 1.5, 2.5),
+                                 bin_width=15)
+        self.assertEqual(feed["bin_minutes"], 15)
+        self.assertEqual(len(feed["bins"]), mayfly.MAYFLY_WINDOW * 4)
+        #two arrivals in 15 minutes is four in 30
+        self.assertEqual([X[0] for X in feed["bins"][:6]], [0, 0, 0, 2, 2, 0])
+        self.assertEqual(feed["lookup"]["650"], [3])
+        self.assertEqual(feed["lookup"]["670"], [4])
+        #heat over the next 30 minutes carries into the bins before
+        feed = mayfly.build_feed(data, heat_map_params=(1.0, 1.5, 2.5),
+                                 bin_width=15, heat_window=30)
+        self.assertEqual([X[0] for X in feed["bins"][:6]], [0, 0, 1, 2, 1, 0])
+        page = mayfly.build_page(data, heat_map_params=(1.0, 1.5, 2.5),
+                                 bin_width=15, heat_window=30)
+        self.assertEqual(page.count('class="bin"'), mayfly.MAYFLY_WINDOW * 4)
+        self.assertEqual(re.findall(r'bin_data (w\d)', page)[:6],
+                         ["w0", "w0", "w1", "w2", "w1", "w0"])
+        self.assertEqual(
+            mayfly.build_page(data, bin_width=15, bin_cache=mayfly.BinCache(),
+                              heat_window=30),
+            mayfly.build_page(data, bin_width=15, heat_window=30))
+        #binned data is rolled up again, whatever width it was binned at
+        self.assertEqual(
+            mayfly.build_page(mayfly.split_into_bins(services), bin_width=15,
+                              heat_window=30),
+            mayfly.build_page(data, bin_width=15, heat_window=30))
+        self.assertEqual(mayfly.build_feed(mayfly.split_into_bins(services)),
+                         mayfly.build_feed(data))
+
+
+    def test_build_delta(self):
+        start = self.fix_window_start()
+        def feed(services, start=start, version=1):
+            old_window_start = mayfly.window_start
+            mayfly.window_start = lambda: start
+            try:
+                return mayfly.build_feed(mayfly.split_into_bins(services),
+                                         version=version)
+            finally:
+                mayfly.window_start = old_window_start
+        minutes = lambda m: start + datetime.timedelta(minutes=m)
+        s1 = Service(type_='A', dt=minutes(70), operator_id='EZY',
+                     service_id='610', dest_or_orig='NCL')
+        s2 = Service(type_='D', dt=minutes(75), operator_id='EZY',
+                     service_id='611', dest_or_orig='NCL')
+        s3 = Service(type_='D', dt=minutes(80), operator_id='TOM',
+                     service_id='630', dest_or_orig='PMI')
+        old = feed([s1, s2, s3])
+        self.assertIsNone(mayfly.build_delta(None, old))
+        #s1 delayed into the next bin, s2 cancelled
+        new = feed([s1._replace(dt=minutes(95), delay=25), s3], version=2)
+        delta = mayfly.build_delta(old, new)
+        key = lambda s: "{}{}{}@{:%Y-%m-%d}".format(
+            s.type_, s.operator_id, s.service_id, s.dt)
+        self.assertEqual(delta["base"], 1)
+        self.assertEqual(delta["version"], 2)
+        self.assertEqual(delta["shift"], 0)
+        self.assertEqual(delta["changed"], [
+            [3, 1, minutes(95).strftime("%H:%M"), "EZY", "610", "NCL", 25]])
+        self.assertEqual(delta["removed"], [key(s2)])
+        self.assertEqual(delta["heat"], [])
+        #the window moving on by an hour shifts every bin by two
+        new = feed([s1, s2, s3], start + datetime.timedelta(hours=1))
+        delta = mayfly.build_delta(old, new)
+        self.assertEqual(delta["shift"], 2)
+        self.assertEqual(delta["changed"], [])
+        self.assertEqual(delta["removed"], [])
+        #duplicate keys cannot be expressed
+        self.assertIsNone(mayfly.build_delta(old, feed([s1, s1])))
+
+
+    @unittest.skipUnless(shutil.which("node"), "node is not installed")
+    def test_apply_shifted_delta(self):
+        start = datetime.datetime(2020, 1, 30, 6, 0)
+        services = [
+            Service(type_='A', dt=start + datetime.timedelta(minutes=70 + X),
+                    operator_id='EZY', service_id=str(610 + X),
+                    dest_or_orig='NCL')
+            for X in (0, 40)]
+        def feed(start, version):
+            old_window_start = mayfly.window_start
+            mayfly.window_start = lambda: start
+            try:
+                return mayfly.build_feed(mayfly.split_into_bins(services),
+                                         version=version)
+            finally:
+                mayfly.window_start = old_window_start
+        old = feed(start, 1)
+        new = feed(start + datetime.timedelta(hours=1), 2)
+        delta = mayfly.build_delta(old, new)
+        self.assertEqual(delta["shift"], 2)
+        #run mayfly.js against just enough of a DOM to render the feed
+        script = """
+            var vm = require("vm"), fs = require("fs");
+            function element() {
+                return {textContent: "", value: "", innerHTML: "",
+                        dataset: {}, classList: {add: function() {},
+                                                 remove: function() {}},
+                        getElementsByClassName: function() {return [];},
+                        addEventListener: function() {}};
+            }
+            global.window = {};
+            global.document = {getElementById: element,
+                               getElementsByClassName: function() {
+                                   return [];}};
+            vm.runInThisContext(fs.readFileSync(process.argv[1], "utf8"));
+            var input = JSON.parse(fs.readFileSync(0, "utf8"));
+            feed = input.feed;
+            apply_delta(element(), input.delta);
+            process.stdout.write(JSON.stringify({bins: feed.bins,
+                                                 lookup: lookup}));
+        """
+        result = subprocess.run(
+            ["node", "-e", script, os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "mayfly.js")],
+            input=json.dumps({"feed": old, "delta": delta}),
+            capture_output=True, text=True, check=True)
+        applied = json.loads(result.stdout)
+        self.assertEqual(applied["bins"], new["bins"])
+        self.assertEqual(applied["lookup"], new["lookup"])
+        self.assertNotEqual(new["lookup"], old["lookup"])
+
+
+    def test_bin_cache(self):
+        start = self.fix_window_start()
+        services = [
+            Service(type_='A', dt=start + datetime.timedelta(minutes=5 * c),
+                    operator_id='EZY', service_id=str(600 + c),
+                    dest_or_orig='NCL')
+            for c in range(24)]
+        data = mayfly.split_into_bins(services)
+        page = mayfly.build_page(data)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "bins.cache")
+            cache = mayfly.BinCache(filename)
+            self.assertEqual(mayfly.build_page(data, bin_cache=cache), page)
+            self.assertEqual((cache.hits, cache.misses), (0, 96))
+            cache.save()
+            cache = mayfly.BinCache(filename, max_entries=100)
+            self.assertEqual(len(cache), 96)
+            #one delayed service changes only its own bin
+            services[7] = services[7]._replace(delay=5)
+            data = mayfly.split_into_bins(services)
+            self.assertEqual(mayfly.build_page(data, bin_cache=cache),
+                             mayfly.build_page(data))
+            self.assertEqual((cache.hits, cache.misses), (95, 1))
+            self.assertEqual(len(cache), 97)
+            #as does a change of destination
+            services[13] = services[13]._replace(dest_or_orig='EDI')
+            data = mayfly.split_into_bins(services)
+            self.assertEqual(mayfly.build_page(data, bin_cache=cache),
+                             mayfly.build_page(data))
+            self.assertEqual((cache.hits, cache.misses), (190, 2))
+            #changing rendering parameters re-renders everything, and the
+            #least recently used entries are evicted
+            mayfly.build_page(data, max_scale=5, bin_cache=cache)
+            self.assertEqual(len(cache), 100)
+            self.assertEqual(cache.misses, 98)
+
+def _aims_row(flight, from_, to, sched_off, sched_on, off, on, reg="G-EZBV"):
+    return ("<tr><td>{}</td><td>{}</td><td>{}</td><td>319</td><td>{}</td>"
+            "<td></td><td>{}Z</td><td>{}Z</td><td>{}Z</td><td>{}Z</td></tr>"
+            ).format(flight, from_, to, reg, sched_off, sched_on, off, on)
+
+
+class TestFlightInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.aims_orig = (aims.connect, aims.flight_info_stream, aims.logout)
+        self.aims_state = (aims._session, aims._aims_url,
+                           aims._session_started, aims._credentials)
+        self.logins = 0
+        def monkey_patch_connect(username, password, deadline=None):
+            self.logins += 1
+            self.login_deadline = deadline
+            aims._session, aims._aims_url = object(), "https://aims/"
+            aims._session_started = time.monotonic()
+            aims._credentials = (username, password)
+        aims.connect = monkey_patch_connect
+        aims.logout = lambda _1=True, _2=None: None
+
+
+    def tearDown(self):
+        aims.connect, aims.flight_info_stream, aims.logout = self.aims_orig
+        (aims._session, aims._aims_url,
+         aims._session_started, aims._credentials) = self.aims_state
+
+
+    def test_parse_flight_info_html(self):
+        html = ("<table>\n" +
+                _aims_row("EZY 570", "BRS", "NCL",
+                          "20:50", "21:55", "21:50", "22:55") +
+                _aims_row("<b>EJU 6001</b>", "BRS", "AMS",
+                          "06:00", "07:05", "06:00", "07:05",
+                          "X-CAN&nbsp;") +
+                "<tr><td>EZY 1</td><td>BRS</td><td>NCL</td><td>319</td>"
+                "<td>G-EZBV</td><td></td><td>Sched</td></tr>" +
+                _aims_row("  EZY\n  571 ", "NCL", "BRS",
+                          "22:25", "23:30", "22:25", "23:35") +
+                "</table>")
+        d = datetime.date(2020, 1, 30)
+        result = [
+            flight_info.Flight(operator='EZY', flight_num='570', from_='BRS',
+                               to='NCL', type_='319', reg='G-EZBV',
+                               sched_off=datetime.datetime(2020, 1, 30, 20, 50),
+                               sched_on=datetime.datetime(2020, 1, 30, 21, 55),
+                               off=datetime.datetime(2020, 1, 30, 21, 50),
+                               on=datetime.datetime(2020, 1, 30, 22, 55)),
+            flight_info.Flight(operator='EJU', flight_num='6001', from_='BRS',
+                               to='AMS', type_='319', reg='X-CAN',
+                               sched_off=datetime.datetime(2020, 1, 30, 6, 0),
+                               sched_on=datetime.datetime(2020, 1, 30, 7, 5),
+                               off=datetime.datetime(2020, 1, 30, 6, 0),
+                               on=datetime.datetime(2020, 1, 30, 7, 5)),
+            flight_info.Flight(operator='EZY', flight_num='571', from_='NCL',
+                               to='BRS', type_='319', reg='G-EZBV',
+                               sched_off=datetime.datetime(2020, 1, 30, 22, 25),
+                               sched_on=datetime.datetime(2020, 1, 30, 23, 30),
+                               off=datetime.datetime(2020, 1, 30, 22, 25),
+                               on=datetime.datetime(2020, 1, 30, 23, 35)),
+        ]
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.assertEqual(flight_info.parse_flight_info_html(html, d),
+                             result)
+            for size in (1, 5, 64):
+                chunks = (html[c:c + size] for c in range(0, len(html), size))
+                self.assertEqual(list(flight_info.iter_flights(chunks, d)),
+                                 result)
+        finally:
+            sys.stderr = stderr
+
+
+    def test_get_AIMS_flights_concurrent(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        def monkey_patch_flight_info(d, type_, consumer, airport="brs",
+                                     timeout=None):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            from_, to = ("BRS", "NCL") if type_ == "D" else ("NCL", "BRS")
+            return consumer(iter(["<table>{}</table>".format(
+                _aims_row("EZY {}{}".format(type_, d.day), from_, to,
+                          "20:50", "21:55", "21:00", "22:05"))]))
+        aims.flight_info_stream = monkey_patch_flight_info
+        flights = flight_info.get_AIMS_flights(
+            None, datetime.date(2020, 1, 30), 3, 2)
+        self.assertEqual([f.flight_num for f in flights],
+                         ["A30", "A31", "A1", "D30", "D31", "D1"])
+        self.assertEqual(flights[2].sched_off,
+                         datetime.datetime(2020, 2, 1, 20, 50))
+        self.assertEqual(in_flight[1], 2)
+
+
+    def test_session_reuse(self):
+        aims.flight_info_stream = (
+            lambda d, type_, consumer, airport="brs", timeout=None:
+            consumer(iter([""])))
+        flight_info.get_AIMS_flights("pw", datetime.date(2020, 1, 30))
+        flight_info.get_AIMS_flights("pw", datetime.date(2020, 1, 30))
+        self.assertEqual(self.logins, 1)
+        flight_info.get_AIMS_flights("pw2", datetime.date(2020, 1, 30))
+        self.assertEqual(self.logins, 2)
+        aims._session_started -= aims.SESSION_MAX_AGE
+        flight_info.get_AIMS_flights("pw2", datetime.date(2020, 1, 30))
+        self.assertEqual(self.logins, 3)
+        def raise_exception(d, type_, consumer, airport="brs", timeout=None):
+            raise ValueError("Test exception")
+        aims.flight_info_stream = raise_exception
+        with self.assertRaises(ValueError):
+            flight_info.get_AIMS_flights("pw2", datetime.date(2020, 1, 30))
+        self.assertIsNone(aims._session)
+
+
+    def test_retries_and_deadline(self):
+        calls = []
+        def monkey_patch_flight_info(d, type_, consumer, airport="brs",
+                                     timeout=None):
+            calls.append((d.day, type_))
+            if d.day == 30 and calls.count((30, type_)) == 1:
+                raise requests.ConnectionError("Test exception")
+            if d.day == 31 and type_ == "D":
+                time.sleep(0.5)
+            return consumer(iter(["<table>{}</table>".format(
+                _aims_row("EZY {}{}".format(type_, d.day), "NCL", "BRS",
+                          "20:50", "21:55", "21:00", "22:05"))]))
+        aims.flight_info_stream = monkey_patch_flight_info
+        backoff_orig = aims.BACKOFF
+        aims.BACKOFF = 0.01
+        start = time.monotonic()
+        try:
+            flights = flight_info.get_AIMS_flights(
+                None, datetime.date(2020, 1, 30), 2, 4, 0.3)
+        finally:
+            aims.BACKOFF = backoff_orig
+        #logging in is held to the deadline too
+        self.assertLess(self.login_deadline - start, 0.31)
+        self.assertLessEqual(aims._request_timeout(self.login_deadline), 0.3)
+        self.assertEqual(aims._request_timeout(None), aims.REQUEST_TIMEOUT)
+        self.assertEqual([f.flight_num for f in flights],
+                         ["A30", "A31", "D30"])
+        self.assertEqual(calls.count((30, "A")), 2)
+        #nothing retrieved before deadline
+        aims.flight_info_stream = (
+            lambda d, type_, consumer, airport="brs", timeout=None:
+            time.sleep(0.5))
+        with self.assertRaises(TimeoutError):
+            flight_info.get_AIMS_flights(
+                None, datetime.date(2020, 1, 31), 1, 4, 0.1)
+
+
+    def test_page_stream_expiry(self):
+        class Response:
+            encoding = "utf-8"
+            def __init__(self, body, size):
+                self.chunks = [body[c:c + size]
+                               for c in range(0, len(body), size)]
+            def iter_content(self, _):
+                return iter(self.chunks)
+        login = "<form><input name=\"Crew_Id\"></form> \u00e9".encode()
+        page = "<table><tr><td>Crew</td><td>Id</td></tr></table>".encode()
+        for size in (1, 2, 5, 64):
+            stream = aims._PageStream(Response(login, size))
+            self.assertEqual("".join(stream), login.decode())
+            self.assertTrue(stream.expired)
+            stream = aims._PageStream(Response(page, size))
+            self.assertEqual("".join(stream), page.decode())
+            self.assertFalse(stream.expired)
+
+
+    def test_hedged_requests(self):
+        calls = []
+        def slow_first_call():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+        client = aims.AsyncClient(2, hedge_after=0.05)
+        start = time.monotonic()
+        self.assertEqual(asyncio.run(client.call(slow_first_call)), "fast")
+        self.assertLess(time.monotonic() - start, 0.4)
+        client.close()
+
+
+    def test_record_and_replay_aims(self):
+        today = datetime.date.today()
+        def monkey_patch_flight_info(d, type_, consumer, airport="brs",
+                                     timeout=None):
+            from_, to = ("BRS", "NCL") if type_ == "D" else ("NCL", "BRS")
+            return consumer(iter(["<table>", _aims_row(
+                "EZY {}{}".format(type_, (d - today).days), from_, to,
+                "20:50", "21:55", "21:00", "22:05"), "</table>"]))
+        aims.flight_info_stream = monkey_patch_flight_info
+        with tempfile.TemporaryDirectory() as directory:
+            with profiling.record_aims(directory):
+                recorded = flight_info.get_AIMS_flights(None, today, 2)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ["BRS-A-0.html", "BRS-A-1.html",
+                              "BRS-D-0.html", "BRS-D-1.html"])
+            aims.flight_info_stream = None
+            self.logins = 0
+            with profiling.replay_aims(directory):
+                replayed = flight_info.get_AIMS_flights(None, today, 2)
+                self.assertEqual(getpass.getpass(), "")
+            self.assertEqual(self.logins, 0)
+        self.assertEqual([F.flight_num for F in replayed],
+                         ["A0", "A1", "D0", "D1"])
+        self.assertEqual(replayed, recorded)
+
+
+    def test_profile(self):
+        def worker():
+            return sum(range(1000))
+        def func():
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+            return 42
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                prefix = os.path.join(directory, "profile")
+                self.assertEqual(profiling.profile(func, prefix, 5), 42)
+                stats = pstats.Stats(prefix + ".pstats")
+                with open(prefix + ".txt") as f:
+                    report = f.read()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("worker", [F[2] for F in stats.stats])
+        self.assertIn("func", [F[2] for F in stats.stats])
+        self.assertIn("by cumulative time", report)
+        self.assertIn("peak traced memory", report)
+
+
+    def test_profile_thread_pool(self):
+        def work(n):
+            return sum(range(n))
+        def func():
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                return sum(pool.map(work, range(100)))
+        class SingleProfiler(cProfile.Profile):
+            #as from Python 3.12, where only one profiler may be active
+            def enable(self, *args, **kwargs):
+                if threading.current_thread() is not threading.main_thread():
+                    raise ValueError("Another profiling tool is already active")
+                super().enable(*args, **kwargs)
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        profile_orig = cProfile.Profile
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                prefix = os.path.join(directory, "profile")
+                self.assertEqual(profiling.profile(func, prefix), func())
+                stats = pstats.Stats(prefix + ".pstats")
+                if not profiling.PROFILES_ALL_THREADS:
+                    self.assertIn("work", [F[2] for F in stats.stats])
+                cProfile.Profile = SingleProfiler
+                self.assertEqual(profiling.profile(func, prefix), func())
+        finally:
+            cProfile.Profile = profile_orig
+            sys.stderr = stderr
+        self.assertIsNone(sys.getprofile())
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.get_AIMS_flights_orig = flight_info.get_AIMS_flights
+        flight_info.get_AIMS_flights = lambda _1, _2, _3: []
+        self.getpass_orig = getpass.getpass
+        getpass.getpass = lambda: None
+
+
+    def tearDown(self):
+        flight_info.get_AIMS_flights = self.get_AIMS_flights_orig
+        getpass.getpass = self.getpass_orig
+
+
+    def test_next_interval(self):
+        now = datetime.datetime(2020, 1, 30, 12, 10)
+        def bins(*times):
+            return mayfly.split_into_bins([
+                Service(type_='A', dt=X, operator_id='EZY',
+                        service_id='610', dest_or_orig='NCL')
+                for X in times])
+        near = bins(datetime.datetime(2020, 1, 30, 13, 0))
+        later = datetime.datetime(2020, 1, 30, 20, 0)
+        self.assertEqual(server.next_interval(60, None, near, now),
+                         server.MIN_INTERVAL)
+        self.assertEqual(server.next_interval(60, near, near, now), 120)
+        self.assertEqual(server.next_interval(
+            server.MAX_INTERVAL, near, near, now), server.MAX_INTERVAL)
+        #changes later in the window do not speed polling up
+        self.assertEqual(server.next_interval(
+            120, near, bins(datetime.datetime(2020, 1, 30, 13, 0), later),
+            now), 240)
+        #near term changes do
+        self.assertEqual(server.next_interval(
+            240, near, bins(datetime.datetime(2020, 1, 30, 13, 40)), now),
+                         server.MIN_INTERVAL)
+        #nothing happening in the near term
+        self.assertEqual(server.next_interval(60, near, bins(later), now),
+                         server.MAX_INTERVAL)
+
+
+    def test_serve_page(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_filename = os.path.join(tmp, "mayfly.csv")
+            with open(csv_filename, "w") as f:
+                f.write(f"{tomorrow:%d/%m/%Y},A,EZY,101,NCL,EGNT,NCL,EGNT,"
+                        "319,156,1200,J,GB,04DEC2019 1403\n")
+            passwords = []
+            flight_info.get_AIMS_flights = (
+                lambda pw, _2, _3: passwords.append(pw) or [])
+            def no_prompt():
+                raise AssertionError("refresh prompted for a password")
+            getpass.getpass = no_prompt
+            refresher = server.Refresher(csv_filename, "secret")
+            refresher.refresh()
+            refresher.refresh()
+            self.assertEqual(passwords, ["secret", "secret"])
+        httpd = server.make_server(refresher, "127.0.0.1", 0)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:{}/".format(httpd.server_address[1])
+            r = requests.get(url, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(r.headers["Content-Encoding"], "gzip")
+            self.assertIn("EZY101", r.text)
+            etag = r.headers["ETag"]
+            r = requests.get(url, headers={"Accept-Encoding": "gzip",
+                                           "If-None-Match": etag})
+            self.assertEqual(r.status_code, 304)
+            r = requests.get(url, headers={"Accept-Encoding": "identity"})
+            self.assertNotIn("Content-Encoding", r.headers)
+            r = requests.get(url, headers={"Accept-Encoding": "gzip;q=0, br"})
+            self.assertNotIn("Content-Encoding", r.headers)
+            self.assertNotEqual(r.headers["ETag"], etag)
+            self.assertIn("EZY101", r.text)
+            r = requests.get(url + "mayfly.js")
+            self.assertEqual(r.headers["Content-Type"],
+                             "application/javascript")
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+
+    def test_accepts_gzip(self):
+        for header, accepted in (
+                ("gzip", True), ("deflate, gzip;q=0.5", True),
+                ("GZIP ; Q=1.0", True), ("x-gzip", True), ("*", True),
+                ("", False), ("identity", False), ("br", False),
+                ("gzip;q=0", False), ("gzip;q=0.000", False),
+                ("*, gzip;q=0", False), ("gzip;q=0, *", False),
+                ("*;q=0", False), ("gzip;q=bad", False), ("xgzip", False)):
+            self.assertEqual(server._accepts_gzip(header), accepted, header)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stage_emf(self):
+        metrics.flush(io.StringIO())
+        with metrics.stage("csv_parse", rows=2):
+            time.sleep(0.01)
+        with self.assertRaises(ValueError):
+            with metrics.stage("binning"):
+                raise ValueError("Test exception")
+        metrics.record("html_parse", 1.5)
+        self.assertEqual([R.stage for R in metrics.records()],
+                         ["csv_parse", "binning", "html_parse"])
+        out = io.StringIO()
+        metrics.flush(out)
+        self.assertEqual(metrics.records(), [])
+        lines = [json.loads(L) for L in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0]["Stage"], "csv_parse")
+        self.assertEqual(lines[0]["rows"], 2)
+        self.assertGreaterEqual(lines[0]["Duration"], 10)
+        self.assertEqual(lines[2]["Duration"], 1.5)
+        cw = lines[0]["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(cw["Dimensions"], [["Stage"]])
+        self.assertEqual(cw["Metrics"][0]["Name"], "Duration")
+        self.assertIn("MaxRSS", lines[3])
+        #the default stream is the one current when flushing, so redirected
+        #output is captured
+        stdout = sys.stdout
+        sys.stdout = out = io.StringIO()
+        try:
+            metrics.flush()
+        finally:
+            sys.stdout = stdout
+        self.assertIn("MaxRSS", out.getvalue())
+
+
+    def test_nested_stage_memory(self):
+        metrics.pop_records()
+        trace_memory = metrics.TRACE_MEMORY
+        metrics.TRACE_MEMORY = True
+        try:
+            with metrics.stage("outer"):
+                block = bytearray(1 << 20)
+                del block
+                with metrics.stage("inner"):
+                    block = bytearray(1 << 16)
+                    del block
+        finally:
+            metrics.TRACE_MEMORY = trace_memory
+            tracemalloc.stop()
+        inner, outer = metrics.pop_records()
+        #the inner stage does not lose the outer stage's earlier peak
+        self.assertGreaterEqual(outer.allocated, 1 << 20)
+        self.assertGreater(inner.allocated, 1 << 15)
+        self.assertLess(inner.allocated, 1 << 20)
+
+
+class TestHistory(unittest.TestCase):
+
+    def test_delay_history(self):
+        def flight(num, from_, to, sched_off, delay, reg="G-EZBV"):
+            off = sched_off + datetime.timedelta(minutes=delay)
+            return flight_info.Flight(
+                operator='EZY', flight_num=num, from_=from_, to=to,
+                type_='319', reg=reg, sched_off=sched_off,
+                sched_on=sched_off + datetime.timedelta(hours=1),
+                off=off, on=off + datetime.timedelta(hours=1))
+        d = datetime.datetime(2020, 1, 30)
+        h = lambda X: d + datetime.timedelta(hours=X)
+        flights = [
+            flight('570', 'BRS', 'NCL', h(20.5), 10),
+            flight('571', 'NCL', 'BRS', h(22), 0),
+            flight('572', 'BRS', 'EDI', h(6), 0, reg="X-CANCEL"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "history.db")
+            store = history.DelayHistory(filename)
+            self.assertEqual(store.record(flights, seen=h(12)), 3)
+            #recording the same delays again only updates last_seen
+            self.assertEqual(store.record(flights, seen=h(13)), 0)
+            flights[0] = flight('570', 'BRS', 'NCL', h(20.5), 25)
+            self.assertEqual(store.record(flights, seen=h(14)), 1)
+            self.assertEqual(
+                store.service('EZY', '570', d, d + datetime.timedelta(days=1)),
+                [history.Observation('BRS', 'D', h(20.5), 'EZY', '570', 'NCL',
+                                     10, h(12), h(13)),
+                 history.Observation('BRS', 'D', h(20.5), 'EZY', '570', 'NCL',
+                                     25, h(14), h(14))])
+            self.assertEqual(store.service('EZY', '570', h(21), h(24)), [])
+            self.assertEqual(
+                [(X.service_id, X.type_, X.sched, X.delay)
+                 for X in store.route('NCL', d, h(48))],
+                [('570', 'D', h(20.5), 10), ('570', 'D', h(20.5), 25),
+                 ('571', 'A', h(23), 0)])
+            self.assertEqual(
+                [(X.service_id, X.delay)
+                 for X in store.route('EDI', d, h(48))], [('572', None)])
+            self.assertEqual(
+                [X.service_id for X in store.time_of_day(
+                    datetime.time(20), datetime.time(23), d, h(48))],
+                ['570', '570'])
+            #a time of day range can span midnight
+            self.assertEqual(
+                [X.service_id for X in store.time_of_day(
+                    datetime.time(22, 30), datetime.time(7), d, h(48))],
+                ['572', '571'])
+            store.close()
+            mayfly.record_history({"BRS": flights}, filename)
+            store = history.DelayHistory(filename)
+            self.assertEqual(len(store.route('NCL', d, h(48))), 3)
+            store.close()
+
+
+@unittest.skipUnless(moto, "moto is not installed")
+class TestLambda(unittest.TestCase):
+
+    def setUp(self):
+        #boto3 needs a region to create awslambda's client at import
+        self.region_orig = os.environ.get("AWS_DEFAULT_REGION")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+        self.mock = moto.mock_aws()
+        self.mock.start()
+        import awslambda
+        import boto3
+        self.awslambda = awslambda
+        self.lambda_state = (
+            awslambda.s3, awslambda._schedule, awslambda._schedule_etag,
+            awslambda._bin_cache, awslambda._published_digest,
+            awslambda._published_feed)
+        awslambda.s3 = boto3.client("s3")
+        awslambda.s3.create_bucket(
+            Bucket=awslambda.BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        awslambda._schedule = mayfly.ServiceTable()
+        awslambda._schedule_etag = None
+        awslambda._bin_cache = mayfly.BinCache()
+        awslambda._published_digest = None
+        awslambda._published_feed = None
+        self.get_AIMS_flights_orig = flight_info.get_AIMS_flights
+        flight_info.get_AIMS_flights = lambda _1, _2, _3: []
+        self.getpass_orig = getpass.getpass
+        getpass.getpass = lambda: None
+
+
+    def tearDown(self):
+        flight_info.get_AIMS_flights = self.get_AIMS_flights_orig
+        getpass.getpass = self.getpass_orig
+        (self.awslambda.s3, self.awslambda._schedule,
+         self.awslambda._schedule_etag, self.awslambda._bin_cache,
+         self.awslambda._published_digest,
+         self.awslambda._published_feed) = self.lambda_state
+        self.mock.stop()
+        if self.region_orig is None:
+            del os.environ["AWS_DEFAULT_REGION"]
+        else:
+            os.environ["AWS_DEFAULT_REGION"] = self.region_orig
+
+
+    def test_schedule_etag(self):
+        s3, bucket = self.awslambda.s3, self.awslambda.BUCKET
+        row = ("{:%d/%m/%Y},A,EZY,{},NCL,EGNT,NCL,EGNT,"
+               "319,156,1200,J,GB,04DEC2019 1403\n")
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        s3.put_object(Bucket=bucket, Key="mayfly.csv",
+                      Body=row.format(tomorrow, "101"))
+        self.awslambda.lambda_handler(None, None)
+        schedule = self.awslambda._schedule
+        self.assertEqual([X.service_id for X in schedule.to_services()],
+                         ["101"])
+        page = s3.get_object(Bucket=bucket, Key="mayfly.html")
+        self.assertEqual(page["ContentEncoding"], "gzip")
+        self.assertIn(b"EZY101", gzip.decompress(page["Body"].read()))
+        #unchanged csv reuses the parsed schedule
+        self.awslambda.lambda_handler(None, None)
+        self.assertIs(self.awslambda._schedule, schedule)
+        #changed csv is downloaded and parsed
+        s3.put_object(Bucket=bucket, Key="mayfly.csv",
+                      Body=row.format(tomorrow, "102"))
+        self.awslambda.lambda_handler(None, None)
+        self.assertEqual(
+            [X.service_id for X in self.awslambda._schedule.to_services()],
+            ["102"])
+
+
+    def test_metrics_flushed_on_failure(self):
+        #there is no mayfly.csv to download
+        import botocore.exceptions
+        metrics.pop_records()
+        stdout = sys.stdout
+        sys.stdout = out = io.StringIO()
+        try:
+            with self.assertRaises(botocore.exceptions.ClientError):
+                self.awslambda.lambda_handler(None, None)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(metrics.records(), [])
+        self.assertIn('"Stage": "s3_download"', out.getvalue())
+
+
+    def test_unchanged_page_not_uploaded(self):
+        s3, bucket = self.awslambda.s3, self.awslambda.BUCKET
+        row = ("{:%d/%m/%Y},A,EZY,{},NCL,EGNT,NCL,EGNT,"
+               "319,156,1200,J,GB,04DEC2019 1403\n")
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        s3.put_object(Bucket=bucket, Key="mayfly.csv",
+                      Body=row.format(tomorrow, "101"))
+        uploads = []
+        upload_file = s3.upload_file
+        def counting_upload_file(filename, bucket, key, **kwargs):
+            uploads.append(key)
+            upload_file(filename, bucket, key, **kwargs)
+        s3.upload_file = counting_upload_file
+        self.awslambda.lambda_handler(None, None)
+        self.assertIn("mayfly.html", uploads)
+        #a cold container gets the published digest from the page metadata
+        #and the published feed to compare the new feed with
+        self.awslambda._published_digest = None
+        self.awslambda._published_feed = None
+        uploads.clear()
+        self.awslambda.lambda_handler(None, None)
+        #nor is an unchanged feed, which keeps its version
+        self.assertEqual(uploads, [])
+        self.assertEqual(self.awslambda._published_feed["version"], 1)
+        updated = json.load(
+            s3.get_object(Bucket=bucket, Key="mayfly-updated.json")["Body"])
+        self.assertRegex(updated["updated"], r"^Updated from AIMS at \d\d:\d\dz$")
+        #a changed page is uploaded
+        flight_info.get_AIMS_flights = lambda _1, _2, _3: [flight_info.Flight(
+            "EZY", "101", "NCL", "BRS", "319", "G-EZBV",
+            datetime.datetime.combine(tomorrow, datetime.time(10, 0)),
+            datetime.datetime.combine(tomorrow, datetime.time(11, 0)),
+            datetime.datetime.combine(tomorrow, datetime.time(10, 0)),
+            datetime.datetime.combine(tomorrow, datetime.time(11, 0)))]
+        self.awslambda.lambda_handler(None, None)
+        self.assertEqual(uploads[0], "mayfly.html")
+        self.assertEqual(uploads[-2:], ["mayfly.json", "mayfly-delta.json"])
+        delta = json.loads(gzip.decompress(s3.get_object(
+            Bucket=bucket, Key="mayfly-delta.json")["Body"].read()))
+        self.assertEqual((delta["base"], delta["version"]), (1, 2))